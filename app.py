@@ -9,6 +9,7 @@ from cdk.common_resource_stack import CommonResourceStack
 from cdk.firehose_stack import FirehoseStack
 from cdk.signout_flow_stack import SignoutFlowStack
 from cdk.signup_flow_stack import SignupFlowStack
+from cdk.watermarking_flow_stack import WatermarkingFlowStack
 from src.lib.log import logger
 
 VALID_STAGES=("dev", "prod")
@@ -29,5 +30,9 @@ common_resource = CommonResourceStack(app, f"{app_name}-CommonResourceStack-{sta
 api = ApiStack(app, f"{app_name}-ApiStack-{stage}", common_resource=common_resource, env=env)
 signup = SignupFlowStack(app, f"{app_name}-SignupFlowStack-{stage}", common_resource=common_resource, env=env)
 signout = SignoutFlowStack(app, f"{app_name}-SignoutFlowStack-{stage}", common_resource=common_resource, env=env)
-firehose = FirehoseStack(app, f"{app_name}-FirehoseStack-{stage}", common_resource=common_resource, env=env)
+watermarking = WatermarkingFlowStack(app, f"{app_name}-WatermarkingFlowStack-{stage}", common_resource=common_resource, env=env)
+firehose = FirehoseStack(
+    app, f"{app_name}-FirehoseStack-{stage}", common_resource=common_resource,
+    signup_flow=signup.flow, signout_flow=signout.flow, env=env
+)
 app.synth()
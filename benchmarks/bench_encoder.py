@@ -0,0 +1,73 @@
+"""Benchmark of the size-targeted encoder on typical illustration sizes
+
+    naive   : JPEG from quality 95 down by steps of 5, then downscaled by 10% steps at
+              quality 50, until the image fits
+    adaptive: `watermarking.encoder.encode`
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_encoder.py [--max-bytes 1000000]
+"""
+
+import argparse
+import io
+import time
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from watermarking.encoder import MAX_BLOB_BYTES, encode
+
+SIZES = [(2000, 2000), (1200, 1600), (1920, 1080), (4000, 3000)]
+
+
+def make_image(width: int, height: int, detail: int) -> Image.Image:
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 256, (height // detail, width // detail, 3), dtype=np.uint8)
+    image = Image.fromarray(noise).resize((width, height), Image.BICUBIC)
+    return image.filter(ImageFilter.GaussianBlur(1))
+
+
+def naive_encode(image: Image.Image, max_bytes: int) -> tuple:
+    attempts = 0
+    quality = 95
+    while True:
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality)
+        attempts += 1
+        if buffer.tell() <= max_bytes:
+            return buffer.getvalue(), attempts
+        if quality > 50:
+            quality -= 5
+        else:
+            image = image.resize((round(image.width * 0.9), round(image.height * 0.9)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-bytes", type=int, default=MAX_BLOB_BYTES)
+    args = parser.parse_args()
+
+    for width, height in SIZES:
+        for detail in (16, 4):
+            image = make_image(width, height, detail)
+            source = io.BytesIO()
+            image.save(source, format="PNG")
+
+            started = time.perf_counter()
+            _, naive_attempts = naive_encode(image, args.max_bytes)
+            naive_elapsed = time.perf_counter() - started
+
+            started = time.perf_counter()
+            result = encode(image, "PNG", source.tell(), args.max_bytes)
+            adaptive_elapsed = time.perf_counter() - started
+
+            print(
+                f"{width}x{height} detail 1/{detail}: "
+                f"naive {naive_elapsed * 1000:7.1f} ms {naive_attempts:2d} encodes, "
+                f"adaptive {adaptive_elapsed * 1000:7.1f} ms {result.attempts:2d} encodes "
+                f"(q{result.quality} x{result.scale:.2f} {result.bytes_per_pixel:.3f} B/px)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Benchmark of the image post detection on the created post records of a recording
+
+    model    : `models.get_or_create` for every post, as `_get_ops_by_type` did
+    fast path: `firehose.images.extract_images` on the raw record, the model only for image posts
+
+The CAR blocks are decoded beforehand, both paths get the same raw record dicts.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_image_posts.py [--recording firehose.bin] [--frames 50000]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from atproto import CAR, firehose_models, models, parse_subscribe_repos_message
+
+from firehose.images import extract_images
+from firehose.recording import read_recording, write_synthetic_recording
+
+
+def load_post_records(path: str) -> list:
+    records = []
+    for _, raw_frame in read_recording(path):
+        message = firehose_models.Frame.from_bytes(raw_frame)
+        if message.type != "#commit":
+            continue
+        commit = parse_subscribe_repos_message(message)
+        if not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit) or not commit.blocks:
+            continue
+        ops = [
+            op
+            for op in commit.ops
+            if op.action == "create" and op.path.startswith(models.ids.AppBskyFeedPost + "/")
+        ]
+        if not ops:
+            continue
+        car = CAR.from_bytes(commit.blocks)
+        records += [car.blocks[op.cid] for op in ops if op.cid in car.blocks]
+    return records
+
+
+def with_model(records: list) -> int:
+    found = 0
+    for record in records:
+        post = models.get_or_create(record, strict=False)
+        if (
+            models.is_record_type(post, models.AppBskyFeedPost)
+            and post.embed
+            and models.is_record_type(post.embed, models.AppBskyEmbedImages)
+        ):
+            found += 1
+    return found
+
+
+def with_fast_path(records: list) -> int:
+    found = 0
+    for record in records:
+        if extract_images(record):
+            post = models.get_or_create(record, strict=False)
+            if models.is_record_type(post, models.AppBskyFeedPost):
+                found += 1
+    return found
+
+
+def measure(func, records: list, rounds: int) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.perf_counter()
+        func(records)
+        best = min(best, time.perf_counter() - started)
+    return best / len(records) * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recording", help="recording of `firehose.replay`, synthetic if omitted")
+    parser.add_argument("--frames", type=int, default=50000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.recording
+        if path is None:
+            path = os.path.join(directory, "synthetic.bin")
+            write_synthetic_recording(path, args.frames)
+        records = load_post_records(path)
+
+    image_posts = sum(1 for record in records if extract_images(record))
+    print(f"posts: {len(records)}, with images: {image_posts}")
+    model = measure(with_model, records, args.rounds)
+    fast = measure(with_fast_path, records, args.rounds)
+    print(f"model    : {model:8.2f}us/post")
+    print(f"fast path: {fast:8.2f}us/post ({1 - fast / model:.0%} less)")
+
+
+if __name__ == "__main__":
+    main()
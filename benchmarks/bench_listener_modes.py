@@ -0,0 +1,82 @@
+"""Benchmark of the listener modes side by side on synthetic frames
+
+    sync : `firehose.listener` sharded worker processes, batch transport
+    async: `firehose.async_listener` asyncio pipeline with a decoding process pool
+
+Both modes get raw frames and decode them as the websocket client does.
+Logging is lowered to WARNING so that the handlers do not measure the console.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_listener_modes.py [--frames 50000] [--workers 3]
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from atproto import firehose_models
+
+from firehose.async_listener import AsyncPipeline
+from firehose.dispatcher import ShardedDispatcher
+from firehose.listener import worker_main
+from firehose.synthetic import generate_frames
+from firehose.transport import start_flusher
+from lib.log import logger
+
+
+def run_sync(raw_frames: list, workers: int) -> float:
+    dispatcher = ShardedDispatcher(
+        worker_main, workers, 10000, batch_options={"max_frames": 200, "flush_interval": 0.05}
+    )
+    dispatcher.start()
+    start_flusher(dispatcher.batchers, 0.025)
+
+    started = time.perf_counter()
+    for raw_frame in raw_frames:
+        dispatcher.dispatch(firehose_models.Frame.from_bytes(raw_frame), raw_frame)
+    dispatcher.flush()
+    last_seq = len(raw_frames)
+    while dispatcher.safe_cursor() < last_seq:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - started
+    dispatcher.stop()
+    return len(raw_frames) / elapsed
+
+
+async def _run_async(raw_frames: list, workers: int) -> float:
+    with ProcessPoolExecutor(workers) as executor:
+        # warm up the pool, the processes are started lazily
+        await asyncio.gather(
+            *(asyncio.get_running_loop().run_in_executor(executor, abs, 0) for _ in range(workers))
+        )
+        pipeline = AsyncPipeline(executor, workers * 2)
+        pipeline.start()
+
+        started = time.perf_counter()
+        for raw_frame in raw_frames:
+            await pipeline.receive(firehose_models.Frame.from_bytes(raw_frame))
+        await pipeline.join()
+        elapsed = time.perf_counter() - started
+        await pipeline.stop()
+    return len(raw_frames) / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=50000)
+    parser.add_argument("--workers", type=int, default=3)
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+
+    raw_frames = list(generate_frames(args.frames))
+    print(f"frames: {len(raw_frames)}, workers: {args.workers}")
+    sync_rate = run_sync(raw_frames, args.workers)
+    print(f"sync  (processes + batch transport): {sync_rate:10.0f} frames/s")
+    async_rate = asyncio.run(_run_async(raw_frames, args.workers))
+    print(f"async (event loop + process pool)  : {async_rate:10.0f} frames/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Overhead of the hot-path instrumentation of the firehose worker
+
+Runs the worker processing over synthetic frames twice: through the instrumented
+`process_message`, and through the same steps without any metric update.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_metrics.py [--frames 20000] [--rounds 5]
+"""
+
+import argparse
+import logging
+import time
+
+from atproto import firehose_models
+
+from firehose.listener import decode_commit, handle_ops, pre_filter, process_message
+from firehose.metrics import MetricsRegistry, metrics
+from firehose.synthetic import generate_frames
+from lib.log import logger
+
+
+def process_message_without_metrics(message: firehose_models.MessageFrame) -> None:
+    if message.type != "#commit":
+        return
+    if not pre_filter.match(message.body):
+        return
+    ops = decode_commit(message)
+    if ops:
+        handle_ops(ops)
+
+
+def measure(process, messages: list) -> float:
+    started = time.perf_counter()
+    for message in messages:
+        process(message)
+    return time.perf_counter() - started
+
+
+def measure_primitives(count: int = 1_000_000) -> float:
+    """Cost in nanoseconds of one timed histogram observation plus one counter increment"""
+    registry = MetricsRegistry()
+    histogram = registry.histogram("h")
+    counter = registry.counter("c")
+    perf_counter = time.perf_counter
+    started = perf_counter()
+    for _ in range(count):
+        t = perf_counter()
+        histogram.observe(perf_counter() - t)
+        counter.inc()
+    return (perf_counter() - started) / count * 1e9
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+
+    messages = [firehose_models.Frame.from_bytes(f) for f in generate_frames(args.frames)]
+    baseline, instrumented = [], []
+    # interleave the rounds so that both sides see the same machine noise
+    for _ in range(args.rounds):
+        baseline.append(measure(process_message_without_metrics, messages))
+        instrumented.append(measure(process_message, messages))
+
+    base, inst = min(baseline), min(instrumented)
+    print(f"frames: {len(messages)}, best of {args.rounds} rounds")
+    print(f"without metrics: {len(messages) / base:10.0f} frames/s")
+    print(f"with metrics   : {len(messages) / inst:10.0f} frames/s")
+    print(f"overhead       : {(inst - base) / base * 100:+.2f}% (end to end, noisy)")
+
+    # a dropped commit costs one counter update, a decoded one at most 3 timed observations
+    primitive_ns = measure_primitives()
+    dropped = metrics.counter("firehose_filter_dropped_total").value / args.rounds
+    decoded = len(messages) - dropped
+    instrumentation_ns = (dropped * 0.2 + decoded * 3) * primitive_ns
+    print(f"timed observation + increment: {primitive_ns:.0f}ns")
+    print(f"estimated overhead: {instrumentation_ns / (base * 1e9) * 100:.2f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Invocations and send time of the signup notifications
+
+    per item : the Map state invokes the notifier once per user, one getConvoForMembers and one
+               sendMessage each, one after the other
+    batched  : `DmNotifier` per batch of `--batch-size` users, the conversations being resolved
+               and sent to concurrently
+
+The chat service answers after `--latency-ms`.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_notifier.py [--users 100] [--batch-size 25]
+"""
+
+import argparse
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from lib.bs.notifier import ConvoCache, DmNotifier
+
+
+class SlowChat:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.chat = SimpleNamespace(
+            bsky=SimpleNamespace(
+                convo=SimpleNamespace(
+                    get_convo_for_members=self.get_convo_for_members,
+                    send_message=self.send_message,
+                )
+            )
+        )
+
+    def get_convo_for_members(self, params):
+        time.sleep(self.latency)
+        return SimpleNamespace(convo=SimpleNamespace(id=f"convo-{params.members[0]}"))
+
+    def send_message(self, data):
+        time.sleep(self.latency)
+        return SimpleNamespace(id="msg")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=25)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=30.0)
+    args = parser.parse_args()
+
+    chat = SlowChat(args.latency_ms / 1000)
+    messages = [{"did": f"did:plc:user{i}", "text": "ok"} for i in range(args.users)]
+
+    single = ThreadPoolExecutor(1)
+    started = time.perf_counter()
+    for message in messages:
+        DmNotifier(chat, ConvoCache(), single).send([message])
+    per_item = time.perf_counter() - started
+
+    executor = ThreadPoolExecutor(args.workers)
+    started = time.perf_counter()
+    for i in range(0, len(messages), args.batch_size):
+        DmNotifier(chat, ConvoCache(), executor).send(messages[i : i + args.batch_size])
+    batched = time.perf_counter() - started
+
+    batches = math.ceil(args.users / args.batch_size)
+    print(f"{args.users} users, {args.latency_ms} ms per chat request")
+    print(f"per item : {args.users:4} invocations, {per_item:6.2f} s")
+    print(f"batched  : {batches:4} invocations, {batched:6.2f} s")
+
+
+if __name__ == "__main__":
+    main()
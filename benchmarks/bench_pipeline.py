@@ -0,0 +1,143 @@
+"""Benchmark of the watermarking I/O path against local stand-ins
+
+A local HTTP server stands in for the PDS (`com.atproto.sync.getBlob`) and moto for S3. Each
+round runs the getter, the watermarker and the upload stage of the poster for a post of 4
+illustrations, with a new blob CID per round so that the result cache never hits.
+
+Reports the median latency of each stage per image, and the throughput of each handler.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_pipeline.py [--rounds 10]
+"""
+
+import argparse
+import io
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import boto3
+import numpy as np
+from atproto_client.models.blob_ref import BlobRef, IpldLink
+from moto import mock_aws
+from PIL import Image, ImageFilter
+
+from lib.bs.resolver import CachingResolver
+from watermarking import getter, poster, watermarker
+from watermarking.result_cache import ResultCache
+
+SIZES = [(2000, 2000), (1200, 1600), (1920, 1080), (1500, 1500)]
+
+
+def did_document(pds: str) -> dict:
+    return {
+        "id": "did:plc:a",
+        "alsoKnownAs": ["at://a.example"],
+        "verificationMethod": [],
+        "service": [
+            {"id": "#atproto_pds", "type": "AtprotoPersonalDataServer", "serviceEndpoint": pds}
+        ],
+    }
+
+
+def make_jpeg(width: int, height: int) -> bytes:
+    rng = np.random.default_rng(width)
+    noise = rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+    image = Image.fromarray(noise).resize((width, height), Image.BICUBIC)
+    buffer = io.BytesIO()
+    image.filter(ImageFilter.GaussianBlur(2)).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+class BlobHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    blobs: dict = {}
+
+    def do_GET(self):
+        cid = parse_qs(urlparse(self.path).query)["cid"][0]
+        blob = self.blobs[cid.split("-")[0]]
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(blob)))
+        self.end_headers()
+        self.wfile.write(blob)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    BlobHandler.blobs = {f"bafy{i}": make_jpeg(*size) for i, size in enumerate(SIZES)}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BlobHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    id_resolver = mock.Mock()
+    id_resolver.did.resolve_without_validation.return_value = did_document(
+        f"http://127.0.0.1:{server.server_address[1]}"
+    )
+    client = mock.Mock()
+    link = IpldLink(link="bafkreie5737gdxlw5i64vzichcalba3z2v5n6icifvx5xytvske7mr3hpm")
+    blob = BlobRef(mime_type="image/jpeg", size=1, ref=link)
+    client.upload_blob.return_value = SimpleNamespace(blob=blob)
+
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="org")
+        s3.create_bucket(Bucket="watermarked")
+        patches = [
+            mock.patch.object(getter, "s3", s3),
+            mock.patch.object(getter, "result_cache", ResultCache(s3, "watermarked")),
+            mock.patch.object(getter, "resolver", CachingResolver(id_resolver=id_resolver)),
+            mock.patch.object(getter, "ORG_IMAGE_BUCKET", "org"),
+            mock.patch.object(getter, "WATERMARKED_IMAGE_BUCKET", "watermarked"),
+            mock.patch.object(watermarker, "s3", s3),
+            mock.patch.object(poster, "s3", s3),
+        ]
+        for patch in patches:
+            patch.start()
+
+        stages = {}
+        throughput = {"getter": [], "watermarker": [], "poster": []}
+        for round in range(args.rounds):
+            event = {
+                "did": "did:plc:bench",
+                "images": [{"cid": f"{cid}-{round}", "alt": ""} for cid in BlobHandler.blobs],
+                "watermark": {"text": "@sheep-snow.bsky.social", "position": "tile"},
+            }
+            fetched = getter.handler(event, {})
+            throughput["getter"].append(fetched["getter"]["mb_per_second"])
+            watermarked = watermarker.handler(fetched, {})
+            throughput["watermarker"].append(watermarked["mb_per_second"])
+
+            started = time.perf_counter()
+            uploads = list(
+                poster.executor.map(
+                    lambda image: poster.upload_image(client, image), watermarked["images"]
+                )
+            )
+            elapsed = time.perf_counter() - started
+            uploaded = sum(upload["bytes"] for upload in uploads)
+            throughput["poster"].append(uploaded / 1024 / 1024 / elapsed)
+
+            timings = [("getter", image["timings"]) for image in fetched["images"]]
+            timings += [("watermarker", image["timings"]) for image in watermarked["images"]]
+            timings += [("poster", upload["timings"]) for upload in uploads]
+            for name, timing in timings:
+                for stage, ms in timing.items():
+                    stages.setdefault(f"{name}.{stage}", []).append(ms)
+
+        print(f"{len(SIZES)} images per post, {args.rounds} rounds")
+        for name, values in throughput.items():
+            print(f"  {name:<24}: {statistics.median(values):7.2f} MB/s")
+        for stage, values in stages.items():
+            print(f"  {stage:<24}: {statistics.median(values):7.1f} ms per image")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Cold start and lookup latency of the user registry
+
+    json       : one JSON object of all the users, parsed into a dict on cold start
+    registry   : `UserRegistry` snapshot, memory-mapped shards and binary search lookups
+
+Both are read from a local directory, as the shards cached under /tmp by a warm container.
+A per-user object in S3 would cost a GET, tens of milliseconds, per event instead.
+The compaction merges `--deltas` signups into the snapshot.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_registry.py [--users 200000] [--shards 16]
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from lib.registry import FileRegistryStore, UserRegistry, compact, get_shard, write_shard
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200_000)
+    parser.add_argument("--shards", type=int, default=16)
+    parser.add_argument("--deltas", type=int, default=1000)
+    parser.add_argument("--lookups", type=int, default=100_000)
+    args = parser.parse_args()
+
+    dids = [f"did:plc:{random.getrandbits(120):030x}" for _ in range(args.users)]
+    users = {did: {"text": f"@user{i}.bsky.social", "opacity": 0.4} for i, did in enumerate(dids)}
+    probes = random.choices(dids, k=args.lookups)
+
+    with tempfile.TemporaryDirectory() as directory:
+        json_path = os.path.join(directory, "users.json")
+        with open(json_path, "w") as f:
+            json.dump(users, f)
+
+        store = FileRegistryStore(os.path.join(directory, "registry"))
+        buckets = [[] for _ in range(args.shards)]
+        for did, record in users.items():
+            buckets[get_shard(did, args.shards)].append((did, record))
+        paths = [os.path.join(directory, f"{index:04d}.shard") for index in range(args.shards)]
+        counts = [write_shard(path, records) for path, records in zip(paths, buckets)]
+        manifest = {"version": 1, "shards": args.shards, "counts": counts, "delta_after": None}
+        store.publish(manifest, paths)
+
+        started = time.perf_counter()
+        with open(json_path) as f:
+            table = json.load(f)
+        json_load_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        for did in probes:
+            table.get(did)
+        json_lookup_us = (time.perf_counter() - started) / len(probes) * 1e6
+
+        started = time.perf_counter()
+        registry = UserRegistry(store)
+        registry.reload()
+        registry.snapshot.load_all()
+        registry_load_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        for did in probes:
+            registry.get(did)
+        registry_lookup_us = (time.perf_counter() - started) / len(probes) * 1e6
+
+        for i in range(args.deltas):
+            store.append(f"did:plc:new{i}", {"text": f"@new{i}.bsky.social"})
+        started = time.perf_counter()
+        manifest = compact(store, shards=args.shards, lag=0)
+        compaction_s = time.perf_counter() - started
+
+    print(f"{args.users} users, {args.shards} shards")
+    print(f"json     : load {json_load_ms:8.1f} ms, lookup {json_lookup_us:6.2f} us")
+    print(f"registry : load {registry_load_ms:8.1f} ms, lookup {registry_lookup_us:6.2f} us")
+    print(f"compaction of {args.deltas} deltas: {compaction_s:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Network resolutions and latency of the DID resolution per 1000 getter invocations
+
+    no cache   : `IdResolver()` as the getter used it, every invocation hits the network
+    memory     : `CachingResolver` without a store, the LRU dies with the container
+    with store : `CachingResolver` with a SQLite store standing in for the shared S3 object
+
+Each invocation resolves the DID of one author, authors being drawn with a Zipf-like skew,
+and lands on a new container with the probability `--cold-start-rate`. The network answers
+after `--latency-ms`.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_resolver.py [--authors 300] [--cold-start-rate 0.05]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from types import SimpleNamespace
+
+from lib.bs.resolver import CachingResolver, SqliteResolverStore
+
+
+class SlowIdResolver:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self.did = SimpleNamespace(resolve_without_validation=self._resolve_did)
+
+    def _resolve_did(self, did):
+        self.calls += 1
+        time.sleep(self.latency)
+        return {"id": did, "alsoKnownAs": [], "verificationMethod": [], "service": []}
+
+
+def percentile(samples: list, ratio: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * ratio), len(ordered) - 1)]
+
+
+def run(mode: str, args, dids: list, weights: list, directory: str) -> None:
+    random.seed(1)
+    network = SlowIdResolver(args.latency_ms / 1000)
+    path = os.path.join(directory, f"{mode}.db")
+
+    def new_resolver():
+        store = SqliteResolverStore(path) if mode == "with store" else None
+        return CachingResolver(store, network)
+
+    resolver = new_resolver()
+    latencies = []
+    for _ in range(args.invocations):
+        if random.random() < args.cold_start_rate:
+            resolver = new_resolver()
+        did = random.choices(dids, weights)[0]
+        started = time.perf_counter()
+        if mode == "no cache":
+            network.did.resolve_without_validation(did)
+        else:
+            resolver.resolve_did(did)
+        latencies.append((time.perf_counter() - started) * 1000)
+    print(
+        f"{mode:10}: {network.calls:5} network resolutions, "
+        f"p50 {percentile(latencies, 0.5):6.2f} ms, p99 {percentile(latencies, 0.99):6.2f} ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--invocations", type=int, default=1000)
+    parser.add_argument("--authors", type=int, default=300)
+    parser.add_argument("--cold-start-rate", type=float, default=0.05)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    dids = [f"did:plc:author{i}" for i in range(args.authors)]
+    weights = [1 / (i + 1) for i in range(args.authors)]
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in ("no cache", "memory", "with store"):
+            run(mode, args, dids, weights, directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Simulation of the createSession calls per 1000 Lambda invocations
+
+    before     : `Client().login()` on every invocation, as `lib.bs.client.get_client` did
+    warm only  : `SessionManager` without a store, one login per container
+    with store : `SessionManager` with a shared store, cold starts import the stored session
+
+Invocations are spread over `--concurrency` containers, as the Map states fan out, and each
+invocation lands on a new container with the probability `--cold-start-rate`.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_session.py [--concurrency 10] [--cold-start-rate 0.05]
+"""
+
+import argparse
+import base64
+import json
+import random
+import time
+
+from atproto import Session, SessionEvent
+
+from lib.bs.session import SessionManager, SessionStore
+
+
+def fake_jwt(expires_in: float) -> str:
+    def encode(data: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b"=").decode()
+
+    payload = {"exp": int(time.time() + expires_in), "sub": "did:plc:bot"}
+    return f"{encode({'alg': 'HS256'})}.{encode(payload)}.sig"
+
+
+class FakeClient:
+    def __init__(self):
+        self._session = None
+        self._callbacks = []
+
+    def on_session_change(self, callback):
+        self._callbacks.append(callback)
+
+    def login(self, login=None, password=None, session_string=None):
+        if session_string:
+            self._session = Session.decode(session_string)
+            event = SessionEvent.IMPORT
+        else:
+            self._session = Session("bot", "did:plc:bot", fake_jwt(7200), fake_jwt(60 * 86400))
+            event = SessionEvent.CREATE
+        for callback in self._callbacks:
+            callback(event, self._session)
+
+
+class MemoryStore(SessionStore):
+    session_string = None
+
+    def load(self):
+        return self.session_string
+
+    def save(self, session_string):
+        self.session_string = session_string
+
+
+def simulate(invocations: int, concurrency: int, cold_start_rate: float, store) -> tuple:
+    rng = random.Random(0)
+    containers = [None] * concurrency
+    logins = imports = 0
+    for _ in range(invocations):
+        slot = rng.randrange(concurrency)
+        if containers[slot] is None or rng.random() < cold_start_rate:
+            if containers[slot] is not None:
+                logins += containers[slot].logins
+                imports += containers[slot].imports
+            containers[slot] = SessionManager("bot", "password", store, FakeClient)
+        containers[slot].get_client()
+    logins += sum(manager.logins for manager in containers if manager)
+    imports += sum(manager.imports for manager in containers if manager)
+    return logins, imports
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--invocations", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--cold-start-rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    scale = 1000 / args.invocations
+    print(f"before    : {1000:7.1f} logins per 1000 invocations")
+    for name, store in (("warm only", None), ("with store", MemoryStore())):
+        logins, imports = simulate(args.invocations, args.concurrency, args.cold_start_rate, store)
+        print(
+            f"{name:<10}: {logins * scale:7.1f} logins, {imports * scale:7.1f} session imports "
+            "per 1000 invocations"
+        )
+
+
+if __name__ == "__main__":
+    main()
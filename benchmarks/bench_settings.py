@@ -0,0 +1,85 @@
+"""Cold start cost of the settings, each run in a fresh interpreter
+
+    before            : what importing the eager `settings` did, a new boto3 session and
+                        Secrets Manager client, `git rev-parse` and the GetSecretValue call
+    lazy, no secrets  : importing the lazy `settings` and running `hello.handler`
+    lazy, secrets     : importing the lazy `settings` and reading a secret, the first access
+                        creating the client and calling GetSecretValue
+
+GetSecretValue is simulated by sleeping `--secret-latency` seconds, the rest being real.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_settings.py [--runs 10] [--secret-latency 0.05]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BEFORE = """
+import subprocess, time
+from boto3.session import Session
+from lib.log import get_logger
+client = Session().client(service_name="secretsmanager", region_name="ap-northeast-1")
+time.sleep({latency})
+try:
+    subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL)
+except Exception:
+    pass
+"""
+
+LAZY_NO_SECRETS = """
+import settings, hello
+hello.handler(None, None)
+"""
+
+LAZY_SECRETS = """
+import time
+import settings
+from lib.aws.secrets_manager import get_client
+
+def get_secret(secret_name):
+    get_client("ap-northeast-1")
+    time.sleep({latency})
+    return {{"bot_userid": "bot.bsky.social"}}
+
+settings.settings._loader = get_secret
+settings.settings.BOT_USERID
+"""
+
+
+def run(code: str, runs: int) -> float:
+    src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+    env = {**os.environ, "PYTHONPATH": src, "AWS_DEFAULT_REGION": "ap-northeast-1"}
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True, env=env, capture_output=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--secret-latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    baseline = run("pass", args.runs)
+    cases = [
+        ("before", BEFORE.format(latency=args.secret_latency)),
+        ("lazy, no secrets", LAZY_NO_SECRETS),
+        ("lazy, secrets", LAZY_SECRETS.format(latency=args.secret_latency)),
+    ]
+    print(f"interpreter startup: {baseline * 1000:.0f}ms (median of {args.runs}, subtracted)")
+    print(f"{'case':<18} {'cold start':>10}")
+    for name, code in cases:
+        elapsed = run(code, args.runs) - baseline
+        print(f"{name:<18} {elapsed * 1000:>8.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Micro-benchmark of the frame transport between the websocket thread and a worker
+
+Compares the per-message queue (one pickled `MessageFrame` per `queue.put`) with
+length-prefixed batches of raw frame bytes decoded on the worker side.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_transport.py [--frames 50000] [--batch-frames 200]
+"""
+
+import argparse
+import multiprocessing
+import time
+
+from atproto import firehose_models
+
+from firehose.synthetic import generate_frames
+from firehose.transport import FrameBatcher, unpack_frames
+
+
+def _consume_frames(queue: multiprocessing.Queue, done: multiprocessing.Queue) -> None:
+    count = 0
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        count += 1
+    done.put(count)
+
+
+def _consume_batches(queue: multiprocessing.Queue, done: multiprocessing.Queue) -> None:
+    count = 0
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        for raw_frame in unpack_frames(item):
+            firehose_models.Frame.from_bytes(raw_frame)
+            count += 1
+    done.put(count)
+
+
+def run(raw_frames: list, batch_options: dict = None) -> float:
+    """Push all frames through a queue to a consumer process
+
+    Returns:
+        float: Frames per second
+    """
+    queue = multiprocessing.Queue(maxsize=10000)
+    done = multiprocessing.Queue()
+    consumer = _consume_frames if batch_options is None else _consume_batches
+    process = multiprocessing.Process(target=consumer, args=(queue, done))
+    process.start()
+
+    # the websocket client decodes every frame in both modes, so it is not measured
+    messages = [firehose_models.Frame.from_bytes(raw_frame) for raw_frame in raw_frames]
+
+    started = time.perf_counter()
+    if batch_options is None:
+        for message in messages:
+            queue.put(message)
+    else:
+        batcher = FrameBatcher(lambda batch, _: queue.put(batch), **batch_options)
+        for raw_frame in raw_frames:
+            batcher.add(raw_frame)
+        batcher.flush()
+    queue.put(None)
+    count = done.get()
+    elapsed = time.perf_counter() - started
+    process.join()
+    assert count == len(raw_frames)
+    return count / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=50000)
+    parser.add_argument("--batch-frames", type=int, default=200)
+    parser.add_argument("--batch-bytes", type=int, default=1024 * 1024)
+    args = parser.parse_args()
+
+    raw_frames = list(generate_frames(args.frames))
+    print(
+        f"frames: {len(raw_frames)}, avg size: {sum(map(len, raw_frames)) / len(raw_frames):.0f}B"
+    )
+
+    per_message = run(raw_frames)
+    print(f"per-message queue : {per_message:10.0f} frames/s")
+    batched = run(raw_frames, {"max_frames": args.batch_frames, "max_bytes": args.batch_bytes})
+    print(f"batched raw frames: {batched:10.0f} frames/s (x{batched / per_message:.1f})")
+
+
+if __name__ == "__main__":
+    main()
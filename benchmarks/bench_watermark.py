@@ -0,0 +1,97 @@
+"""Benchmark of the watermark compositing on typical illustration sizes
+
+    pillow : `Image.alpha_composite` of an overlay rendered for every image, the naive way
+    cold   : `WatermarkRenderer` with an empty overlay cache
+    warm   : `WatermarkRenderer` with the overlays already cached
+    thread : warm, the images of the post processed concurrently in a thread pool,
+             as `watermarking.watermarker` does. Only faster with more than one vCPU.
+
+Each round watermarks a post of 1 to 4 images.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_watermark.py [--rounds 5] [--position tile]
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from watermarking.renderer import OverlayCache, WatermarkRenderer, WatermarkSettings, render_overlay
+
+SIZES = [(2000, 2000), (1200, 1600), (1920, 1080), (800, 1000)]
+
+
+def make_images(count: int) -> list:
+    rng = np.random.default_rng(0)
+    return [
+        Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8), "RGB")
+        for w, h in SIZES[:count]
+    ]
+
+
+def pillow_apply(image: Image.Image, settings: WatermarkSettings) -> Image.Image:
+    overlay = render_overlay(settings, image.size)
+    alpha = np.minimum(256 - overlay.inverse_alpha, 255).astype(np.uint8)
+    color = (overlay.premultiplied // np.maximum(256 - overlay.inverse_alpha, 1)).astype(np.uint8)
+    layer = Image.new("RGBA", image.size)
+    stamp = Image.fromarray(np.concatenate([color, alpha], axis=2), "RGBA")
+    anchor = overlay.anchor
+    layer.paste(
+        stamp,
+        (
+            round((image.width - stamp.width) * anchor[0]),
+            round((image.height - stamp.height) * anchor[1]),
+        ),
+    )
+    return Image.alpha_composite(image.convert("RGBA"), layer).convert("RGB")
+
+
+def bench(name: str, images: list, apply, rounds: int, executor=None) -> float:
+    elapsed = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        if executor is None:
+            for image in images:
+                apply(image)
+        else:
+            list(executor.map(apply, images))
+        elapsed.append(time.perf_counter() - started)
+    best = min(elapsed)
+    print(f"  {name:<6}: {best * 1000:8.1f} ms")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--position", default="tile")
+    args = parser.parse_args()
+
+    settings = WatermarkSettings(text="@sheep-snow.bsky.social", position=args.position)
+    for count in range(1, len(SIZES) + 1):
+        images = make_images(count)
+        print(f"{count} images:")
+        bench("pillow", images, lambda image: pillow_apply(image, settings), args.rounds)
+        bench(
+            "cold",
+            images,
+            lambda image: WatermarkRenderer(OverlayCache()).apply(image, settings),
+            args.rounds,
+        )
+        renderer = WatermarkRenderer()
+        bench("warm", images, lambda image: renderer.apply(image, settings), args.rounds)
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            bench(
+                "thread",
+                images,
+                lambda image: renderer.apply(image, settings),
+                args.rounds,
+                executor,
+            )
+
+
+if __name__ == "__main__":
+    main()
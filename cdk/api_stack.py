@@ -35,7 +35,7 @@ class ApiStack(BaseStack):
     def create_entry_lambda(self) -> _lambda.DockerImageFunction:
         name: str = f"{self.stack_name}-entry"
         code = _lambda.DockerImageCode.from_image_asset(
-            directory=".", cmd=["hello.handler"]
+            directory=".", build_args=self.common_resource.build_args, cmd=["hello.handler"]
         )
         func = _lambda.DockerImageFunction(
             scope=self,
@@ -49,5 +49,5 @@ class ApiStack(BaseStack):
         )
         self._add_common_tags(func)
         # Secrets Managerの利用権限付与
-        self.common_resource.secret.grant_read(func)
+        self._grant_secret_read(func)
         return func
@@ -29,7 +29,7 @@ class BatchStack(BaseStack):
             id=f"{self.stack_name}-lambda",
             function_name=f"{self.stack_name}-lambda",
             code=aws_lambda.DockerImageCode.from_image_asset(
-                directory=".", cmd=["hello.handler"]
+                directory=".", build_args=self.common_resource.build_args, cmd=["hello.handler"]
             ),
             timeout=Duration.seconds(9),
             environment={
@@ -1,4 +1,5 @@
 import json
+import subprocess
 from logging import DEBUG
 
 import boto3
@@ -24,6 +25,9 @@ class CommonResourceStack(Stack):
     loglevel: str
     max_retries: int
     secret_name: str
+    bot_did: str
+    src_version: str
+    build_args: dict
 
     def __init__(self, scope: Construct, construct_id: str, context_json: dict, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
@@ -37,15 +41,28 @@ class CommonResourceStack(Stack):
         self.max_capacity = int(env_vars.get("max_capacity"))
         self.app_name = env_vars.get("app_name")
         self.max_retries = int(env_vars.get("max_retries"))
+        # botアカウントのDID。フォローによるサインアップの判定に使う
+        self.bot_did = env_vars.get("bot_did", "")
         self.secret_name = f"{self.app_name}-secrets-{self.stage}".lower()
         self.image_expiration_days = int(env_vars.get("image_expiration_days"))
         self.userinfo_expiration_days = int(env_vars.get("userinfo_expiration_days"))
+        # ソースのバージョンはイメージのビルド時に埋め込む
+        self.src_version = self._get_src_version()
+        self.build_args = {"SRC_VERSION": self.src_version}
         # リソースの作成
         self.create_secret_manager()
         self.create_original_image_bucket()
         self.create_transformed_image_bucket()
         self.create_userinfo_bucket()
 
+    def _get_src_version(self) -> str:
+        '''ソースコードのcommit hashをバージョンとして取得する'''
+        try:
+            revparsed = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"])
+            return revparsed.decode("utf-8").strip()
+        except Exception:
+            return "0.0.0"
+
     def _get_exists_secret_manager(self, secret_id):
         '''シークレットマネージャーが既存の場合はリソースを取得する'''
         try:
@@ -113,8 +130,9 @@ class CommonResourceStack(Stack):
 
     def create_transformed_image_bucket(self):
         '''加工済画像用バケットの作成'''
+        # results/<blob CID>/<設定のハッシュ> は加工結果のキャッシュを兼ねる。ライフサイクルで期限切れにする
         transformed_bucket_id = f"{self.app_name}-watermarked-imgs-{self.stage}-{self.aws_account}".lower()
-        self.org_image_bucket = s3.Bucket(
+        self.watermarked_image_bucket = s3.Bucket(
             scope=self,
             id=transformed_bucket_id,
             bucket_name=transformed_bucket_id,
@@ -128,13 +146,19 @@ class CommonResourceStack(Stack):
     def create_userinfo_bucket(self):
         '''ユーザバケットの作成'''
         userinfo_bucket_id = f"{self.app_name}-userinfo-files-{self.stage}-{self.aws_account}".lower()
-        self.org_image_bucket = s3.Bucket(
+        self.userinfo_bucket = s3.Bucket(
             scope=self,
             id=userinfo_bucket_id,
             bucket_name=userinfo_bucket_id,
             removal_policy=RemovalPolicy.DESTROY,
             auto_delete_objects=True,
             block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
-            lifecycle_rules=[s3.LifecycleRule(expiration=Duration.days(self.userinfo_expiration_days))],
+            # 期限切れにするのはユーザDID名のファイルだけ。
+            # registry/, sessions/, dms/, firehose/, resolver/ の状態は期限切れにしない
+            lifecycle_rules=[
+                s3.LifecycleRule(prefix="did:", expiration=Duration.days(self.userinfo_expiration_days))
+            ],
             encryption=s3.BucketEncryption.S3_MANAGED,
         )
+        # ユーザ登録情報(DID→透かし設定)のスナップショットと差分ログの保存先
+        self.user_registry_url = f"s3://{userinfo_bucket_id}/registry"
@@ -1,4 +1,7 @@
-from aws_cdk import Stack, Tags
+from aws_cdk import Duration, Stack, Tags
+from aws_cdk import aws_cloudwatch as cloudwatch
+from aws_cdk import aws_lambda as _lambda
+from aws_cdk import aws_logs as logs
 from aws_cdk import aws_secretsmanager as _sm
 from constructs import Construct
 
@@ -16,6 +19,34 @@ class BaseStack(Stack):
     def _add_common_tags(self, resource: Construct) -> None:
         Tags.of(resource).add("Application", self.common_resource.app_name)
 
+    def _grant_secret_read(self, func: _lambda.Function) -> None:
+        '''シークレットの読み取り権限を付与し、シークレット名を環境変数で渡す'''
+        self.common_resource.secret.grant_read(func)
+        func.add_environment("SECRET_NAME", self.common_resource.secret_name)
+
+    def _alarm_on_notify_failures(self, func: _lambda.Function) -> cloudwatch.Alarm:
+        '''通知できなかったユーザがいればアラームを上げる
+
+        登録・解除はgetterで反映済みのため、notifierは失敗してもフローを失敗させず、
+        "Failed to notify" (lib.bs.flows.NOTIFY_FAILED) をログに出す
+        '''
+        metric_filter = logs.MetricFilter(
+            self, "NotifyFailures",
+            log_group=func.log_group,
+            metric_namespace=self.common_resource.app_name,
+            metric_name=f"{self.stack_name}-notify-failures",
+            filter_pattern=logs.FilterPattern.literal('"Failed to notify"'),
+            metric_value="1",
+        )
+        alarm = cloudwatch.Alarm(
+            self, "NotifyFailuresAlarm",
+            metric=metric_filter.metric(statistic="Sum", period=Duration.minutes(5)),
+            threshold=1,
+            evaluation_periods=1,
+            treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING,
+        )
+        self._add_common_tags(alarm)
+        return alarm
 
     def _get_secrets_manager_resource(self, secret_name: str) -> _sm.Secret:
         ssm_arn = (
@@ -3,6 +3,7 @@ from aws_cdk import CfnOutput
 from aws_cdk import aws_ec2 as ec2
 from aws_cdk import aws_ecs as ecs
 from aws_cdk import aws_ecs_patterns as ecs_patterns
+from aws_cdk import aws_stepfunctions as sfn
 from aws_cdk.aws_ecr_assets import DockerImageAsset, DockerImageAssetInvalidationOptions
 from constructs import Construct
 
@@ -11,8 +12,18 @@ from cdk.defs import BaseStack
 
 
 class FirehoseStack(BaseStack):
-    def __init__(self, scope: Construct, construct_id: str, common_resource: CommonResourceStack, **kwargs) -> None:
+    def __init__(
+        self,
+        scope: Construct,
+        construct_id: str,
+        common_resource: CommonResourceStack,
+        signup_flow: sfn.StateMachine,
+        signout_flow: sfn.StateMachine,
+        **kwargs,
+    ) -> None:
         super().__init__(scope, construct_id, common_resource=common_resource, **kwargs)
+        self.signup_flow = signup_flow
+        self.signout_flow = signout_flow
         self.image_asset = self.build_and_push_image()
         self.create_ecs_service()
 
@@ -44,12 +55,28 @@ class FirehoseStack(BaseStack):
             cluster=cluster,
             task_image_options=ecs_patterns.NetworkLoadBalancedTaskImageOptions(
                 image=ecs.ContainerImage.fromEcrRepository(self.image_asset.image_uri, self.image_asset.image_tag),
+                # メトリクス(Prometheus形式)を公開するポート。NLBのヘルスチェックもここに届く
+                container_port=8080,
                 # TODO add secrets 
                 # container_name="firehose",
                 # execution_role=self.common_resource.ecs_task_execution_role,
                 # task_role=self.common_resource.ecs_task_role,
                 # secrets=None,
-                # environment=None,
+                environment={
+                    "FIREHOSE_METRICS_PORT": "8080",
+                    # ワーカーが詰まったらローカルディスクに退避し、リレーとの接続を維持する
+                    "FIREHOSE_OVERLOAD_POLICY": "spill",
+                    # 処理済みのseqをuserinfoバケットに保存し、再起動時にそこから再開する
+                    "FIREHOSE_CHECKPOINT_URL": (
+                        f"s3://{self.common_resource.userinfo_bucket.bucket_name}/firehose/cursor"
+                    ),
+                    # サインアップ済みユーザの登録情報。起動時にmmapで読み込み、差分を定期的に反映する
+                    "FIREHOSE_REGISTRY_URL": self.common_resource.user_registry_url,
+                    # botのフォロー/フォロー解除だけを集約し、サインアップ/サインアウトのフローに渡す
+                    "BOT_DID": self.common_resource.bot_did,
+                    "FIREHOSE_SIGNUP_STATE_MACHINE_ARN": self.signup_flow.state_machine_arn,
+                    "FIREHOSE_SIGNOUT_STATE_MACHINE_ARN": self.signout_flow.state_machine_arn,
+                },
             ),
             platform_version=ecs.FargatePlatformVersion.LATEST,
             public_load_balancer=True,
@@ -57,6 +84,12 @@ class FirehoseStack(BaseStack):
             enable_ecs_managed_tags=True,
         )
 
+        self.common_resource.userinfo_bucket.grant_read_write(
+            fargate_service.task_definition.task_role
+        )
+        self.signup_flow.grant_start_execution(fargate_service.task_definition.task_role)
+        self.signout_flow.grant_start_execution(fargate_service.task_definition.task_role)
+
         # Setup AutoScaling policy
         scaling = fargate_service.service.auto_scale_task_count(
             max_capacity=1, 
@@ -86,5 +119,6 @@ class FirehoseStack(BaseStack):
         return DockerImageAsset(self, img_name,
             directory=".",
             file="ecs.Dockerfile",
+            build_args=self.common_resource.build_args,
             invalidation=DockerImageAssetInvalidationOptions(build_args=False),
         )
@@ -13,6 +13,8 @@ from cdk.defs import BaseStack
 class SignoutFlowStack(BaseStack):
     def __init__(self, scope: Construct, construct_id: str, common_resource: CommonResourceStack, **kwargs) -> None:
         super().__init__(scope, construct_id, common_resource=common_resource, **kwargs)
+        # Blueskyのセッションを暗号化して保存し、コールドスタート時のログインを避ける
+        self.bsky_session_url = f"s3://{common_resource.userinfo_bucket.bucket_name}/sessions/bot"
         self.cronrule = self.create_eventbridge_cron_rule()
         self.executor_lambda = self.create_executor_lambda()
         self.getter_lambda = self.create_getter_lambda()
@@ -22,12 +24,24 @@ class SignoutFlowStack(BaseStack):
         # Lambda関数をEventBridgeのターゲットに追加
         self.cronrule.add_target(targets.LambdaFunction(self.executor_lambda))
         # Secrets Managerの利用権限付与
-        self.common_resource.secret.grant_read(self.executor_lambda)
-        self.common_resource.secret.grant_read(self.getter_lambda)
-        self.common_resource.secret.grant_read(self.notifier_lambda)
+        self._grant_secret_read(self.executor_lambda)
+        self._grant_secret_read(self.getter_lambda)
+        self._grant_secret_read(self.notifier_lambda)
+        # セッション保存先の利用権限付与
+        for func in (self.executor_lambda, self.getter_lambda, self.notifier_lambda):
+            self.common_resource.userinfo_bucket.grant_read_write(func, "sessions/*")
 
         # step functionの作成
         self.flow = self.create_workflow(self.getter_lambda, self.notifier_lambda)
+        # executorは新着DMのコマンドだけをitemsとしてステートマシンに渡す
+        self.executor_lambda.add_environment("STATE_MACHINE_ARN", self.flow.state_machine_arn)
+        self.flow.grant_start_execution(self.executor_lambda)
+        # 通知できなかったユーザをアラームで知らせる
+        self._alarm_on_notify_failures(self.notifier_lambda)
+        # 前回読んだチャットログの位置を保存し、新着分だけを読む
+        self.common_resource.userinfo_bucket.grant_read_write(self.executor_lambda, "dms/*")
+        # getterはユーザ登録情報の差分ログに解除を書き込む
+        self.common_resource.userinfo_bucket.grant_read_write(self.getter_lambda, "registry/delta/*")
 
     def create_workflow(self, getter_lambda, notifier_lambda):
         # Lambdaタスク定義
@@ -37,7 +51,7 @@ class SignoutFlowStack(BaseStack):
         # Mapステート定義
         map_state = sfn.Map(
             self, "MapState",
-            items_path="$.items"  # JSON配列を受け取る
+            items_path="$.items"  # コマンドのバッチ({"items": [...]})の配列を受け取る
         )
         map_state.iterator(getter_task.next(notifier_task))
 
@@ -70,7 +84,7 @@ class SignoutFlowStack(BaseStack):
     def create_executor_lambda(self) -> _lambda.DockerImageFunction:
         name: str = f"{self.stack_name}-signout-executor"
         code = _lambda.DockerImageCode.from_image_asset(
-            directory=".", cmd=["signout.executor.handler"]
+            directory=".", build_args=self.common_resource.build_args, cmd=["signout.executor.handler"]
         )
         func = _lambda.DockerImageFunction(
             scope=self,
@@ -80,6 +94,8 @@ class SignoutFlowStack(BaseStack):
             environment={
                 "LOG_LEVEL": self.common_resource.loglevel,
                 "MAX_RETRIES": str(self.common_resource.max_retries),
+                "BSKY_SESSION_URL": self.bsky_session_url,
+                "DM_CURSOR_URL": f"s3://{self.common_resource.userinfo_bucket.bucket_name}/dms/signout-cursor",
             },
         )
         self._add_common_tags(func)
@@ -88,7 +104,7 @@ class SignoutFlowStack(BaseStack):
     def create_getter_lambda(self) -> _lambda.DockerImageFunction:
         name: str = f"{self.stack_name}-signout-getter"
         code = _lambda.DockerImageCode.from_image_asset(
-            directory=".", cmd=["signout.getter.handler"]
+            directory=".", build_args=self.common_resource.build_args, cmd=["signout.getter.handler"]
         )
         func = _lambda.DockerImageFunction(
             scope=self,
@@ -98,6 +114,8 @@ class SignoutFlowStack(BaseStack):
             environment={
                 "LOG_LEVEL": self.common_resource.loglevel,
                 "MAX_RETRIES": str(self.common_resource.max_retries),
+                "BSKY_SESSION_URL": self.bsky_session_url,
+                "USER_REGISTRY_URL": self.common_resource.user_registry_url,
             },
         )
         self._add_common_tags(func)
@@ -106,7 +124,7 @@ class SignoutFlowStack(BaseStack):
     def create_notifier_lambda(self) -> _lambda.DockerImageFunction:
         name: str = f"{self.stack_name}-signout-notifier"
         code = _lambda.DockerImageCode.from_image_asset(
-            directory=".", cmd=["signout.notifier.handler"]
+            directory=".", build_args=self.common_resource.build_args, cmd=["signout.notifier.handler"]
         )
         func = _lambda.DockerImageFunction(
             scope=self,
@@ -116,6 +134,7 @@ class SignoutFlowStack(BaseStack):
             environment={
                 "LOG_LEVEL": self.common_resource.loglevel,
                 "MAX_RETRIES": str(self.common_resource.max_retries),
+                "BSKY_SESSION_URL": self.bsky_session_url,
             },
         )
         self._add_common_tags(func)
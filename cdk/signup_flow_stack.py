@@ -13,6 +13,8 @@ from cdk.defs import BaseStack
 class SignupFlowStack(BaseStack):
     def __init__(self, scope: Construct, construct_id: str, common_resource: CommonResourceStack, **kwargs) -> None:
         super().__init__(scope, construct_id, common_resource=common_resource, **kwargs)
+        # Blueskyのセッションを暗号化して保存し、コールドスタート時のログインを避ける
+        self.bsky_session_url = f"s3://{common_resource.userinfo_bucket.bucket_name}/sessions/bot"
         self.cronrule = self.create_eventbridge_cron_rule()
         self.executor_lambda = self.create_executor_lambda()
         self.getter_lambda = self.create_getter_lambda()
@@ -22,12 +24,36 @@ class SignupFlowStack(BaseStack):
         # Lambda関数をEventBridgeのターゲットに追加
         self.cronrule.add_target(targets.LambdaFunction(self.executor_lambda))
         # Secrets Managerの利用権限付与
-        self.common_resource.secret.grant_read(self.executor_lambda)
-        self.common_resource.secret.grant_read(self.getter_lambda)
-        self.common_resource.secret.grant_read(self.notifier_lambda)
+        self._grant_secret_read(self.executor_lambda)
+        self._grant_secret_read(self.getter_lambda)
+        self._grant_secret_read(self.notifier_lambda)
+        # セッション保存先の利用権限付与
+        for func in (self.executor_lambda, self.getter_lambda, self.notifier_lambda):
+            self.common_resource.userinfo_bucket.grant_read_write(func, "sessions/*")
 
         # step functionの作成
         self.flow = self.create_workflow(self.getter_lambda, self.notifier_lambda)
+        # executorは新着DMのコマンドだけをitemsとしてステートマシンに渡す
+        self.executor_lambda.add_environment("STATE_MACHINE_ARN", self.flow.state_machine_arn)
+        self.flow.grant_start_execution(self.executor_lambda)
+        # 通知できなかったユーザをアラームで知らせる
+        self._alarm_on_notify_failures(self.notifier_lambda)
+        # 前回読んだチャットログの位置を保存し、新着分だけを読む
+        self.common_resource.userinfo_bucket.grant_read_write(self.executor_lambda, "dms/*")
+        # getterはユーザ登録情報の差分ログに登録を書き込む
+        self.common_resource.userinfo_bucket.grant_read_write(self.getter_lambda, "registry/delta/*")
+        # 透かし文字列の既定値にするハンドルの解決結果を共有する
+        self.common_resource.userinfo_bucket.grant_read_write(self.getter_lambda, "resolver/*")
+
+        # ユーザ登録情報の差分ログを1時間ごとにスナップショットへ統合する
+        self.compactor_lambda = self.create_compactor_lambda()
+        self.common_resource.userinfo_bucket.grant_read_write(self.compactor_lambda, "registry/*")
+        compaction_rule = events.Rule(
+            self, "HourlyCompactionRule",
+            schedule=events.Schedule.cron(minute="0", hour="*")
+        )
+        self._add_common_tags(compaction_rule)
+        compaction_rule.add_target(targets.LambdaFunction(self.compactor_lambda))
 
     def create_workflow(self, getter_lambda, notifier_lambda) -> sfn.StateMachine:
         # Lambdaタスク定義
@@ -37,7 +63,7 @@ class SignupFlowStack(BaseStack):
         # Mapステート定義
         map_state = sfn.Map(
             self, "MapState",
-            items_path="$.items"  # JSON配列を受け取る
+            items_path="$.items"  # コマンドのバッチ({"items": [...]})の配列を受け取る
         )
         map_state.iterator(getter_task.next(notifier_task))
 
@@ -70,7 +96,7 @@ class SignupFlowStack(BaseStack):
     def create_executor_lambda(self) -> _lambda.DockerImageFunction:
         name: str = f"{self.stack_name}-signup-executor"
         code = _lambda.DockerImageCode.from_image_asset(
-            directory=".", cmd=["signup.executor.handler"]
+            directory=".", build_args=self.common_resource.build_args, cmd=["signup.executor.handler"]
         )
         func = _lambda.DockerImageFunction(
             scope=self,
@@ -80,6 +106,8 @@ class SignupFlowStack(BaseStack):
             environment={
                 "LOG_LEVEL": self.common_resource.loglevel,
                 "MAX_RETRIES": str(self.common_resource.max_retries),
+                "BSKY_SESSION_URL": self.bsky_session_url,
+                "DM_CURSOR_URL": f"s3://{self.common_resource.userinfo_bucket.bucket_name}/dms/signup-cursor",
             },
         )
         self._add_common_tags(func)
@@ -88,7 +116,7 @@ class SignupFlowStack(BaseStack):
     def create_getter_lambda(self) -> _lambda.DockerImageFunction:
         name: str = f"{self.stack_name}-signup-getter"
         code = _lambda.DockerImageCode.from_image_asset(
-            directory=".", cmd=["signup.getter.handler"]
+            directory=".", build_args=self.common_resource.build_args, cmd=["signup.getter.handler"]
         )
         func = _lambda.DockerImageFunction(
             scope=self,
@@ -98,6 +126,9 @@ class SignupFlowStack(BaseStack):
             environment={
                 "LOG_LEVEL": self.common_resource.loglevel,
                 "MAX_RETRIES": str(self.common_resource.max_retries),
+                "BSKY_SESSION_URL": self.bsky_session_url,
+                "USER_REGISTRY_URL": self.common_resource.user_registry_url,
+                "RESOLVER_CACHE_URL": f"s3://{self.common_resource.userinfo_bucket.bucket_name}/resolver/cache.json",
             },
         )
         self._add_common_tags(func)
@@ -106,7 +137,7 @@ class SignupFlowStack(BaseStack):
     def create_notifier_lambda(self) -> _lambda.DockerImageFunction:
         name: str = f"{self.stack_name}-signup-notifier"
         code = _lambda.DockerImageCode.from_image_asset(
-            directory=".", cmd=["signup.notifier.handler"]
+            directory=".", build_args=self.common_resource.build_args, cmd=["signup.notifier.handler"]
         )
         func = _lambda.DockerImageFunction(
             scope=self,
@@ -116,6 +147,27 @@ class SignupFlowStack(BaseStack):
             environment={
                 "LOG_LEVEL": self.common_resource.loglevel,
                 "MAX_RETRIES": str(self.common_resource.max_retries),
+                "BSKY_SESSION_URL": self.bsky_session_url,
+            },
+        )
+        self._add_common_tags(func)
+        return func
+
+    def create_compactor_lambda(self) -> _lambda.DockerImageFunction:
+        name: str = f"{self.stack_name}-registry-compactor"
+        code = _lambda.DockerImageCode.from_image_asset(
+            directory=".", build_args=self.common_resource.build_args, cmd=["registry.compactor.handler"]
+        )
+        func = _lambda.DockerImageFunction(
+            scope=self,
+            id=name.lower(),
+            function_name=name,
+            code=code,
+            timeout=Duration.minutes(5),
+            memory_size=1024,
+            environment={
+                "LOG_LEVEL": self.common_resource.loglevel,
+                "USER_REGISTRY_URL": self.common_resource.user_registry_url,
             },
         )
         self._add_common_tags(func)
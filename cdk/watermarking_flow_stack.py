@@ -0,0 +1,138 @@
+from aws_cdk import Duration
+from aws_cdk import aws_lambda as _lambda
+from aws_cdk import aws_stepfunctions as sfn
+from aws_cdk import aws_stepfunctions_tasks as tasks
+from constructs import Construct
+
+from cdk.common_resource_stack import CommonResourceStack
+from cdk.defs import BaseStack
+
+# Lambdaは1,769MBで1vCPU相当。投稿の画像(最大4枚)を並列処理するため4vCPU相当を割り当てる
+WATERMARKER_MEMORY_SIZE = 7076
+WATERMARKER_MAX_WORKERS = 4
+# getterは最大4枚(各最大50MB)の画像をメモリに読み込んでS3に保存する
+GETTER_MEMORY_SIZE = 1024
+GETTER_TIMEOUT_SECONDS = 60
+# posterはログイン、最大4枚の画像のアップロードと投稿を行う。レート制限の待ちとリトライを含める
+POSTER_MEMORY_SIZE = 1024
+POSTER_TIMEOUT_SECONDS = 120
+
+
+class WatermarkingFlowStack(BaseStack):
+    def __init__(
+        self, scope: Construct, construct_id: str, common_resource: CommonResourceStack, **kwargs
+    ) -> None:
+        super().__init__(scope, construct_id, common_resource=common_resource, **kwargs)
+        # Blueskyのセッションを暗号化して保存し、コールドスタート時のログインを避ける
+        self.bsky_session_url = f"s3://{common_resource.userinfo_bucket.bucket_name}/sessions/bot"
+        self.getter_lambda = self.create_getter_lambda()
+        self.watermarker_lambda = self.create_watermarker_lambda()
+        self.poster_lambda = self.create_poster_lambda()
+
+        # Secrets Managerの利用権限付与
+        self._grant_secret_read(self.getter_lambda)
+        self._grant_secret_read(self.poster_lambda)
+        # S3バケットの利用権限付与
+        self.common_resource.org_image_bucket.grant_read_write(self.getter_lambda)
+        self.common_resource.org_image_bucket.grant_read(self.watermarker_lambda)
+        self.common_resource.watermarked_image_bucket.grant_read_write(self.watermarker_lambda)
+        self.common_resource.watermarked_image_bucket.grant_read(self.poster_lambda)
+        self.common_resource.userinfo_bucket.grant_read_write(self.poster_lambda, "sessions/*")
+        # ユーザ登録情報は起動時に読み込み、イベントごとにS3を参照しない
+        self.common_resource.userinfo_bucket.grant_read(self.getter_lambda, "registry/*")
+        # DIDの解決結果をコンテナ間で共有し、コールドスタート時の再解決を避ける
+        self.common_resource.userinfo_bucket.grant_read_write(self.getter_lambda, "resolver/*")
+
+        # step functionの作成
+        self.flow = self.create_workflow()
+
+    def create_workflow(self) -> sfn.StateMachine:
+        # Lambdaタスク定義
+        getter_task = tasks.LambdaInvoke(
+            self, "getter", lambda_function=self.getter_lambda, output_path="$.Payload"
+        )
+        watermarker_task = tasks.LambdaInvoke(
+            self, "watermarker", lambda_function=self.watermarker_lambda, output_path="$.Payload"
+        )
+        poster_task = tasks.LambdaInvoke(
+            self, "poster", lambda_function=self.poster_lambda, output_path="$.Payload"
+        )
+
+        # ステートマシンの定義。投稿の画像はwatermarker内で並列に処理する
+        definition = getter_task.next(watermarker_task).next(poster_task)
+        return sfn.StateMachine(
+            self, "WatermarkingFlow", definition=definition, timeout=Duration.minutes(5)
+        )
+
+    def create_getter_lambda(self) -> _lambda.DockerImageFunction:
+        name: str = f"{self.stack_name}-watermarking-getter"
+        code = _lambda.DockerImageCode.from_image_asset(
+            directory=".",
+            build_args=self.common_resource.build_args,
+            cmd=["watermarking.getter.handler"],
+        )
+        func = _lambda.DockerImageFunction(
+            scope=self,
+            id=name.lower(),
+            function_name=name,
+            code=code,
+            memory_size=GETTER_MEMORY_SIZE,
+            timeout=Duration.seconds(GETTER_TIMEOUT_SECONDS),
+            environment={
+                "LOG_LEVEL": self.common_resource.loglevel,
+                "MAX_RETRIES": str(self.common_resource.max_retries),
+                "ORG_IMAGE_BUCKET": self.common_resource.org_image_bucket.bucket_name,
+                "WATERMARKED_IMAGE_BUCKET": self.common_resource.watermarked_image_bucket.bucket_name,
+                "USER_REGISTRY_URL": self.common_resource.user_registry_url,
+                "RESOLVER_CACHE_URL": f"s3://{self.common_resource.userinfo_bucket.bucket_name}/resolver/cache.json",
+            },
+        )
+        self._add_common_tags(func)
+        return func
+
+    def create_watermarker_lambda(self) -> _lambda.DockerImageFunction:
+        name: str = f"{self.stack_name}-watermarking-watermarker"
+        code = _lambda.DockerImageCode.from_image_asset(
+            directory=".",
+            build_args=self.common_resource.build_args,
+            cmd=["watermarking.watermarker.handler"],
+        )
+        func = _lambda.DockerImageFunction(
+            scope=self,
+            id=name.lower(),
+            function_name=name,
+            code=code,
+            memory_size=WATERMARKER_MEMORY_SIZE,
+            timeout=Duration.seconds(60),
+            environment={
+                "LOG_LEVEL": self.common_resource.loglevel,
+                "MAX_RETRIES": str(self.common_resource.max_retries),
+                "WATERMARK_MAX_WORKERS": str(WATERMARKER_MAX_WORKERS),
+                "WATERMARKED_IMAGE_BUCKET": self.common_resource.watermarked_image_bucket.bucket_name,
+            },
+        )
+        self._add_common_tags(func)
+        return func
+
+    def create_poster_lambda(self) -> _lambda.DockerImageFunction:
+        name: str = f"{self.stack_name}-watermarking-poster"
+        code = _lambda.DockerImageCode.from_image_asset(
+            directory=".",
+            build_args=self.common_resource.build_args,
+            cmd=["watermarking.poster.handler"],
+        )
+        func = _lambda.DockerImageFunction(
+            scope=self,
+            id=name.lower(),
+            function_name=name,
+            code=code,
+            memory_size=POSTER_MEMORY_SIZE,
+            timeout=Duration.seconds(POSTER_TIMEOUT_SECONDS),
+            environment={
+                "LOG_LEVEL": self.common_resource.loglevel,
+                "MAX_RETRIES": str(self.common_resource.max_retries),
+                "BSKY_SESSION_URL": self.bsky_session_url,
+            },
+        )
+        self._add_common_tags(func)
+        return func
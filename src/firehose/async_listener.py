@@ -0,0 +1,291 @@
+"""Bluesky Firehose Listener (asyncio mode)
+
+Alternative entry point of `firehose.listener` for small tasks. Everything runs in one event loop:
+
+    receive -> bounded queue -> filter -> per-DID lanes -> decode (process pool) -> dispatch
+
+Only the CPU heavy decoding of the interested commits is offloaded to a process pool, and the
+blocking downstream I/O (dedup store, dispatch) to threads. Frames dropped by the pre-filter never
+leave the event loop, and the lanes keep the events of one author in order while the decoding and
+the downstream I/O of other authors go on concurrently.
+
+Usage:
+    PYTHONPATH=src python src/firehose/async_listener.py
+
+See:
+    https://github.com/MarshalX/atproto/blob/main/examples/firehose/process_commits_async.py
+"""
+
+import asyncio
+import os
+import signal
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from atproto import AsyncFirehoseSubscribeReposClient, firehose_models, models
+
+from firehose.checkpoint import Checkpointer, get_checkpoint_store
+from firehose.dedup import get_dedup_store
+from firehose.dispatcher import PendingSeqs, get_shard
+from firehose.listener import (
+    _dedup_url,
+    decode_commit,
+    dedup,
+    drop_duplicates,
+    follow_coalescer,
+    handle_ops,
+    pre_filter,
+    subscribers,
+)
+from firehose.metrics import MetricsExporter, metrics
+from lib.log import logger
+
+_received = metrics.counter("firehose_received_frames_total", "Frames received")
+_filter_latency = metrics.histogram("firehose_filter_seconds", "Pre-filter latency per commit")
+_filter_dropped = metrics.counter(
+    "firehose_filter_dropped_total", "Commits dropped by the pre-filter"
+)
+_parse_latency = metrics.histogram(
+    "firehose_parse_seconds", "Commit parse and CAR decode latency, including the process pool"
+)
+_dispatch_latency = metrics.histogram("firehose_dispatch_seconds", "Operations dispatch latency")
+_errors = metrics.counter("firehose_errors_total", "Frames failed to be processed")
+
+
+def _handle_ops(ops: dict) -> None:
+    handle_ops(drop_duplicates(ops))
+
+
+async def _dispatch_ops(ops: dict) -> None:
+    # the dedup store and the dispatch block on I/O, which must not stall the event loop
+    await asyncio.to_thread(_handle_ops, ops)
+
+
+async def _flush_follows_if_due() -> None:
+    # the flush starts the flows with a blocking Step Functions call
+    await asyncio.to_thread(follow_coalescer.flush_if_due)
+
+
+def decode_commits(messages: List[firehose_models.MessageFrame]) -> List[Optional[dict]]:
+    """Decode a batch of `#commit` messages in one round trip to the process pool"""
+    return [decode_commit(message) for message in messages]
+
+
+class AsyncPipeline:
+    """asyncio pipeline from the received frames to the dispatched operations"""
+
+    def __init__(
+        self,
+        executor: Optional[Executor],
+        lanes_count: int,
+        max_queue_size: int = 1000,
+        decode_batch_size: int = 50,
+        dispatch: Callable[[dict], Awaitable[None]] = _dispatch_ops,
+    ):
+        """
+        Args:
+            executor (Optional[Executor]): Executor of the decoding, the default executor if None
+            lanes_count (int): Number of decoding lanes, i.e. max number of concurrent decodings
+            max_queue_size (int): Capacity of the receive queue
+            decode_batch_size (int): Max number of queued messages of a lane
+                sent to the executor at once
+            dispatch (Callable[[dict], Awaitable[None]]): Called with the decoded operations
+        """
+        self.executor = executor
+        self.dispatch = dispatch
+        self.decode_batch_size = decode_batch_size
+        self.received = asyncio.Queue(maxsize=max_queue_size)
+        self.lanes = [
+            asyncio.Queue(maxsize=max(max_queue_size // lanes_count, 1)) for _ in range(lanes_count)
+        ]
+        self.pending = PendingSeqs(lanes_count)
+        self.done_seqs = [0] * lanes_count
+        self._tasks = []
+
+    def start(self) -> None:
+        """Start the stages as tasks of the running event loop"""
+        self._tasks.append(asyncio.create_task(self._filter()))
+        for lane in range(len(self.lanes)):
+            self._tasks.append(asyncio.create_task(self._decode(lane)))
+
+    async def receive(self, message: firehose_models.MessageFrame) -> None:
+        """Put a received frame to the pipeline, waiting while the queue is full
+
+        Args:
+            message (firehose_models.MessageFrame): Message frame
+        """
+        _received.inc()
+        await self.received.put(message)
+
+    def safe_cursor(self) -> int:
+        """Get the highest seq up to which every received frame has been processed"""
+        return self.pending.safe_cursor(self.done_seqs)
+
+    def queue_fill_ratio(self) -> float:
+        """Fill level of the receive queue, between 0 and 1"""
+        return self.received.qsize() / self.received.maxsize
+
+    async def join(self) -> None:
+        """Wait until every received frame has been processed"""
+        await self.received.join()
+        for lane in self.lanes:
+            await lane.join()
+
+    async def stop(self) -> None:
+        """Process the queued frames and cancel the stages"""
+        await self.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _filter(self) -> None:
+        while True:
+            message = await self.received.get()
+            seq = message.body.get("seq", self.pending.last_seq)
+            started = time.perf_counter()
+            interested = message.type == "#commit" and pre_filter.match(message.body)
+            _filter_latency.observe(time.perf_counter() - started)
+            if interested:
+                lane = get_shard(message.body["repo"], len(self.lanes))
+                self.pending.add(lane, seq)
+                await self.lanes[lane].put(message)
+            else:
+                _filter_dropped.inc()
+                self.pending.skip(seq)
+            self.received.task_done()
+
+            stats = pre_filter.report()
+            if stats:
+                logger.info(stats)
+
+    async def _dispatch_batch(
+        self, messages: List[firehose_models.MessageFrame], decoded: List[Optional[dict]]
+    ) -> None:
+        """Dispatch the operations of each author in order, the authors concurrently"""
+        by_author: Dict[str, List[dict]] = {}
+        for message, ops in zip(messages, decoded):
+            if ops:
+                by_author.setdefault(message.body["repo"], []).append(ops)
+
+        async def dispatch_author(author_ops: List[dict]) -> None:
+            for ops in author_ops:
+                await self.dispatch(ops)
+
+        results = await asyncio.gather(
+            *(dispatch_author(author_ops) for author_ops in by_author.values()),
+            return_exceptions=True,
+        )
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            raise errors[0]
+
+    async def _decode(self, lane: int) -> None:
+        loop = asyncio.get_running_loop()
+        queue = self.lanes[lane]
+        while True:
+            messages = [await queue.get()]
+            while len(messages) < self.decode_batch_size and not queue.empty():
+                messages.append(queue.get_nowait())
+
+            try:
+                started = time.perf_counter()
+                decoded = await loop.run_in_executor(self.executor, decode_commits, messages)
+                parsed = time.perf_counter()
+                _parse_latency.observe((parsed - started) / len(messages))
+                await self._dispatch_batch(messages, decoded)
+                _dispatch_latency.observe(time.perf_counter() - parsed)
+            except Exception as e:
+                _errors.inc(len(messages))
+                logger.exception(f"Failed to process the messages: {e}")
+            self.done_seqs[lane] = messages[-1].body["seq"]
+            for _ in messages:
+                queue.task_done()
+
+
+async def on_callback_error_handler(error: BaseException) -> None:
+    """Error handler for the callback
+
+    Args:
+        error (BaseException): Error object
+    """
+    logger.error("Got error!", error)
+
+
+async def main() -> None:
+    """Run the listener until SIGINT or SIGTERM"""
+    checkpoint_store = get_checkpoint_store(
+        os.getenv("FIREHOSE_CHECKPOINT_URL", "file://./.firehose-cursor")
+    )
+    start_cursor = checkpoint_store.load()
+    params = None
+    if start_cursor is not None:
+        logger.info(f"Resuming from the checkpoint seq={start_cursor}")
+        params = models.ComAtprotoSyncSubscribeRepos.Params(cursor=start_cursor)
+
+    checkpointer = Checkpointer(
+        checkpoint_store,
+        interval=float(os.getenv("FIREHOSE_CHECKPOINT_INTERVAL", 10)),
+        every_events=int(os.getenv("FIREHOSE_CHECKPOINT_EVERY_EVENTS", 10000)),
+    )
+    checkpointer.start()
+
+    if subscribers is not None:
+        # the pre-filter runs in the event loop, so the set is only needed in this process
+        subscribers.start()
+    if _dedup_url:
+        dedup.store = get_dedup_store(_dedup_url, 0, dedup.ttl)
+
+    client = AsyncFirehoseSubscribeReposClient(params)
+    workers_count = int(os.getenv("FIREHOSE_WORKERS", max(os.cpu_count() - 1, 1)))
+    cursor_update_interval = 1.0
+
+    with ProcessPoolExecutor(workers_count) as executor:
+        # two lanes per process keep the pool busy while a lane is dispatching
+        pipeline = AsyncPipeline(executor, workers_count * 2)
+        pipeline.start()
+        logger.info(f"Started the asyncio pipeline with {workers_count} decoding processes.")
+
+        queue_fill = metrics.gauge("firehose_queue_fill_ratio", "Fill level of the receive queue")
+        seq_lag = metrics.gauge("firehose_seq_lag", "Received seq minus the processed cursor")
+        exporter = MetricsExporter(
+            metrics,
+            interval=float(os.getenv("FIREHOSE_METRICS_INTERVAL", 10)),
+            collectors=[lambda: queue_fill.set(pipeline.queue_fill_ratio())],
+        )
+        metrics_port = os.getenv("FIREHOSE_METRICS_PORT")
+        exporter.start(int(metrics_port) if metrics_port else None)
+
+        async def update_cursor() -> None:
+            cursor = 0
+            while True:
+                await asyncio.sleep(cursor_update_interval)
+                safe_cursor = pipeline.safe_cursor()
+                seq_lag.set(pipeline.pending.last_seq - safe_cursor)
+                await _flush_follows_if_due()
+                if safe_cursor and safe_cursor != cursor:
+                    cursor = safe_cursor
+                    # the client resumes from this cursor on reconnecting
+                    client.update_params(models.ComAtprotoSyncSubscribeRepos.Params(cursor=cursor))
+                    checkpointer.update(cursor)
+
+        cursor_task = asyncio.create_task(update_cursor())
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, lambda: asyncio.create_task(client.stop()))
+
+        await client.start(pipeline.receive, on_callback_error_handler)
+
+        logger.info("Stop requested. Waiting for the queued frames...")
+        await pipeline.stop()
+        cursor_task.cancel()
+        await asyncio.to_thread(follow_coalescer.flush)
+        checkpointer.update(pipeline.safe_cursor())
+        checkpointer.stop()
+    logger.info("Listener stopped gracefully, Bye!")
+
+
+if __name__ == "__main__":
+    logger.info("Starting listener (asyncio mode)...")
+    asyncio.run(main())
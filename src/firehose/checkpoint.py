@@ -0,0 +1,163 @@
+"""Durable cursor checkpoints for the firehose listener
+
+The last fully processed seq is persisted periodically, so that a restarted task resumes
+`FirehoseSubscribeReposClient` from it instead of losing events.
+Writes happen in a background thread: the hot path only hands over the latest seq.
+
+The store is selected by `FIREHOSE_CHECKPOINT_URL`:
+    file:///var/lib/wmput/cursor       local file
+    s3://bucket/firehose/cursor        S3 object (the userinfo bucket in the deployed stack)
+"""
+
+import os
+import tempfile
+import threading
+from typing import Optional
+from urllib.parse import urlparse
+
+import boto3
+
+from lib.log import logger
+
+
+class CheckpointStore:
+    """Base class of the checkpoint stores"""
+
+    def load(self) -> Optional[int]:
+        """Load the checkpoint
+
+        Returns:
+            Optional[int]: Saved seq, or None if no checkpoint exists
+        """
+        raise NotImplementedError
+
+    def save(self, seq: int) -> None:
+        """Save the checkpoint
+
+        Args:
+            seq (int): Seq to save
+        """
+        raise NotImplementedError
+
+
+class FileCheckpointStore(CheckpointStore):
+    """Checkpoint stored in a local file"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Optional[int]:
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip())
+        except FileNotFoundError:
+            return None
+
+    def save(self, seq: int) -> None:
+        # write to a temporary file and rename it, so a crash never leaves a truncated file
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "w") as f:
+            f.write(str(seq))
+        os.replace(tmp_path, self.path)
+
+
+class S3CheckpointStore(CheckpointStore):
+    """Checkpoint stored as an S3 object"""
+
+    def __init__(self, bucket: str, key: str):
+        self.bucket = bucket
+        self.key = key
+        self._s3 = boto3.client("s3")
+
+    def load(self) -> Optional[int]:
+        try:
+            response = self._s3.get_object(Bucket=self.bucket, Key=self.key)
+        except self._s3.exceptions.NoSuchKey:
+            return None
+        return int(response["Body"].read().decode().strip())
+
+    def save(self, seq: int) -> None:
+        self._s3.put_object(Bucket=self.bucket, Key=self.key, Body=str(seq).encode())
+
+
+def get_checkpoint_store(url: str) -> CheckpointStore:
+    """Get the checkpoint store for the URL
+
+    Args:
+        url (str): `file://<path>` or `s3://<bucket>/<key>`
+
+    Returns:
+        CheckpointStore: Checkpoint store
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "s3":
+        return S3CheckpointStore(parsed.netloc, parsed.path.lstrip("/"))
+    if parsed.scheme in ("file", ""):
+        return FileCheckpointStore(parsed.netloc + parsed.path)
+    raise ValueError(f"Unsupported checkpoint store: `{url}`")
+
+
+class Checkpointer:
+    """Persist the latest seq in a background thread
+
+    A checkpoint is written every `interval` seconds, or earlier once the seq advanced by
+    `every_events` since the last write. Seqs of the relay are consecutive, so the seq delta
+    is used as the number of events.
+    """
+
+    def __init__(self, store: CheckpointStore, interval: float = 10.0, every_events: int = 10000):
+        """
+        Args:
+            store (CheckpointStore): Store to write to
+            interval (float): Max seconds between two checkpoints
+            every_events (int): Max number of events between two checkpoints
+        """
+        self.store = store
+        self.interval = interval
+        self.every_events = every_events
+        self._seq = 0
+        self._saved_seq = 0
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="checkpointer", daemon=True)
+
+    def start(self) -> None:
+        """Start the background thread"""
+        self._thread.start()
+
+    def update(self, seq: int) -> None:
+        """Hand over the latest fully processed seq, called from the hot path
+
+        Args:
+            seq (int): Latest fully processed seq
+        """
+        self._seq = seq
+        if seq - self._saved_seq >= self.every_events:
+            self._wakeup.set()
+
+    def _save(self) -> None:
+        seq = self._seq
+        if seq == self._saved_seq:
+            return
+        try:
+            self.store.save(seq)
+            self._saved_seq = seq
+        except Exception as e:
+            logger.error(f"Failed to save the checkpoint seq={seq}: {e}")
+
+    def _run(self) -> None:
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self._save()
+
+    def stop(self) -> None:
+        """Stop the background thread and write the final checkpoint"""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._save()
+        logger.info(f"Saved the checkpoint seq={self._saved_seq}")
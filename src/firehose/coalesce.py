@@ -0,0 +1,132 @@
+"""Windowed coalescing of follow and unfollow events
+
+Users who follow, unfollow and follow again within seconds would start the signup and signout
+flows several times. The events are collected per (follower DID, subject DID) during a window,
+and only the net change is dispatched, as one batch per window.
+
+The first event of a pair tells its state before the window: a follow means it was not
+following, an unfollow means it was. If the state at the end of the window is the same,
+nothing is dispatched for the pair.
+
+A follow delete only carries the URI of the follow record, so the subjects of the follows seen
+recently are remembered. Unfollows of older follows are dispatched with an unknown subject.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from firehose.metrics import metrics
+
+FOLLOW = "follow"
+UNFOLLOW = "unfollow"
+
+_events = metrics.counter("firehose_follow_events_total", "Follow and unfollow events received")
+_changes = metrics.counter("firehose_follow_changes_total", "Net follow changes dispatched")
+_batches = metrics.counter("firehose_follow_batches_total", "Batches of follow changes dispatched")
+
+
+class FollowCoalescer:
+    """Collapse the follow events of a window into their net changes
+
+    Thread safe, the asyncio listener handling the operations in threads.
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[List[dict]], None],
+        window: float = 10.0,
+        max_known_follows: int = 100000,
+    ):
+        """
+        Args:
+            flush (Callable[[List[dict]], None]): Called with the net changes of each window
+            window (float): Seconds during which the events are collected
+            max_known_follows (int): Max number of follow URIs remembered to resolve the subject
+                of their delete
+        """
+        self._flush = flush
+        self.window = window
+        self.max_known_follows = max_known_follows
+        self._pending: Dict[Tuple[str, Optional[str]], dict] = {}
+        self._known_follows: OrderedDict[str, str] = OrderedDict()
+        self._window_started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def follow(self, uri: str, cid: str, follower: str, subject: str, created_at: str) -> None:
+        """Add a follow event
+
+        Args:
+            uri (str): URI of the follow record
+            cid (str): CID of the follow record
+            follower (str): DID of the follower
+            subject (str): DID of the followed account
+            created_at (str): Creation time of the follow record
+        """
+        change = {
+            "action": FOLLOW,
+            "uri": uri,
+            "cid": cid,
+            "follower_did": follower,
+            "followed_did": subject,
+            "created_at": created_at,
+        }
+        with self._lock:
+            self._known_follows[uri] = subject
+            if len(self._known_follows) > self.max_known_follows:
+                self._known_follows.popitem(last=False)
+            self._add((follower, subject), change)
+
+    def is_known(self, uri: str) -> bool:
+        """Whether the follow record was seen recently, i.e. its subject is known"""
+        with self._lock:
+            return uri in self._known_follows
+
+    def unfollow(self, uri: str) -> None:
+        """Add an unfollow event, i.e. the delete of a follow record
+
+        Args:
+            uri (str): URI of the deleted follow record, `at://<follower>/app.bsky.graph.follow/..`
+        """
+        follower = uri[len("at://") :].split("/", 1)[0]
+        with self._lock:
+            subject = self._known_follows.pop(uri, None)
+            change = {
+                "action": UNFOLLOW,
+                "uri": uri,
+                "follower_did": follower,
+                "followed_did": subject,
+            }
+            # without the subject, the delete can only cancel out with its own follow
+            self._add((follower, subject) if subject else (follower, uri), change)
+
+    def _add(self, key: Tuple[str, Optional[str]], change: dict) -> None:
+        _events.inc()
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = {"initial": change["action"], "last": change}
+        else:
+            pending["last"] = change
+
+    def flush_if_due(self) -> None:
+        """Dispatch the net changes once the window has elapsed"""
+        if time.monotonic() - self._window_started >= self.window:
+            self.flush()
+
+    def flush(self) -> None:
+        """Dispatch the net changes of the current window"""
+        with self._lock:
+            self._window_started = time.monotonic()
+            pending_changes, self._pending = self._pending, {}
+        # a pair which ends in the state it started from did not change
+        changes = [
+            pending["last"]
+            for pending in pending_changes.values()
+            if pending["last"]["action"] == pending["initial"]
+        ]
+        if not changes:
+            return
+        _changes.inc(len(changes))
+        _batches.inc()
+        self._flush(changes)
@@ -0,0 +1,198 @@
+"""Dedup of the firehose records across reconnects and restarts
+
+After a reconnect or a resume from an older checkpoint, the relay sends commits which have
+already been handled. Every created record is checked by its URI and CID before it is
+dispatched, so that replayed events do not lead to duplicate downloads, renders and reposts.
+
+Two layers:
+* an in-process LRU with a TTL, bounded by an approximate memory size
+* an optional persistent store, so that duplicates are caught after a task restart as well.
+  It is selected by `FIREHOSE_DEDUP_URL`, one store per worker shard:
+    file:///var/lib/wmput/dedup.sqlite3    SQLite file, `-<shard>` is appended to the name
+    s3://bucket/firehose/dedup             S3 objects written with `If-None-Match: *`.
+                                           Expire them with a lifecycle rule on the prefix.
+"""
+
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+from firehose.metrics import metrics
+from lib.log import logger
+
+_ENTRY_OVERHEAD = 128
+"""Approximate bytes of an LRU entry besides its key: the dict slot, the link and the float"""
+
+_hits = metrics.counter("firehose_dedup_hits_total", "Records dropped as duplicates")
+_misses = metrics.counter("firehose_dedup_misses_total", "Records seen for the first time")
+_store_hits = metrics.counter(
+    "firehose_dedup_store_hits_total", "Duplicates found in the persistent store only"
+)
+_evictions = metrics.counter("firehose_dedup_evictions_total", "LRU entries evicted by the cap")
+_size = metrics.gauge("firehose_dedup_bytes", "Approximate memory of the LRU")
+
+
+class DedupStore:
+    """Base class of the persistent dedup stores"""
+
+    def add(self, key: str) -> bool:
+        """Record the key
+
+        Args:
+            key (str): Dedup key
+
+        Returns:
+            bool: False if the key was already recorded and has not expired
+        """
+        raise NotImplementedError
+
+
+class SQLiteDedupStore(DedupStore):
+    """Keys in a local SQLite file, expired after `ttl` seconds"""
+
+    def __init__(self, path: str, ttl: float):
+        self.ttl = ttl
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # shared by the dispatch threads of the asyncio listener
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        # losing the last keys on a crash only lets a few duplicates through
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, expires REAL)")
+        self._db.execute("DELETE FROM seen WHERE expires < ?", (time.time(),))
+
+    def add(self, key: str) -> bool:
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO seen VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET expires = excluded.expires WHERE seen.expires < ?",
+                (key, now + self.ttl, now),
+            )
+            return cursor.rowcount > 0
+
+
+class S3DedupStore(DedupStore):
+    """Keys as empty S3 objects, created with a conditional put"""
+
+    def __init__(self, bucket: str, prefix: str):
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/")
+        self._s3 = boto3.client("s3")
+
+    def add(self, key: str) -> bool:
+        object_key = f"{self.prefix}/{hashlib.sha256(key.encode()).hexdigest()}"
+        try:
+            self._s3.put_object(Bucket=self.bucket, Key=object_key, Body=b"", IfNoneMatch="*")
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("PreconditionFailed", "ConditionalRequestConflict"):
+                return False
+            raise
+        return True
+
+
+def get_dedup_store(url: str, shard: int, ttl: float) -> DedupStore:
+    """Get the persistent dedup store of a worker shard
+
+    Args:
+        url (str): `file://<path>` or `s3://<bucket>/<prefix>`
+        shard (int): Shard index of the worker
+        ttl (float): Seconds to keep the keys, the S3 store relies on a lifecycle rule instead
+
+    Returns:
+        DedupStore: Dedup store
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "s3":
+        return S3DedupStore(parsed.netloc, parsed.path.lstrip("/"))
+    if parsed.scheme in ("file", ""):
+        root, ext = os.path.splitext(parsed.netloc + parsed.path)
+        return SQLiteDedupStore(f"{root}-{shard}{ext}", ttl)
+    raise ValueError(f"Unsupported dedup store: `{url}`")
+
+
+class DedupCache:
+    """LRU of the handled records with a TTL, in front of an optional persistent store
+
+    Thread safe, the persistent store being called outside of the lock.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float = 86400.0,
+        store: Optional[DedupStore] = None,
+    ):
+        """
+        Args:
+            max_bytes (int): Approximate memory cap of the LRU
+            ttl (float): Seconds after which a record is not a duplicate anymore
+            store (Optional[DedupStore]): Persistent store checked on LRU misses
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.store = store
+        self.size = 0
+        self._entries: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remember(self, key: str, now: float, new: bool) -> None:
+        if new:
+            self.size += sys.getsizeof(key) + _ENTRY_OVERHEAD
+        self._entries[key] = now + self.ttl
+        self._entries.move_to_end(key)
+        while self.size > self.max_bytes:
+            evicted, _ = self._entries.popitem(last=False)
+            self.size -= sys.getsizeof(evicted) + _ENTRY_OVERHEAD
+            _evictions.inc()
+        _size.set(self.size)
+
+    def first_seen(self, uri: str, cid: str) -> bool:
+        """Check the record and remember it
+
+        Args:
+            uri (str): Record URI
+            cid (str): Record CID
+
+        Returns:
+            bool: True if the record has not been seen within the TTL
+        """
+        key = f"{uri} {cid}"
+        now = time.monotonic()
+        with self._lock:
+            expires = self._entries.get(key)
+            if expires is not None and expires > now:
+                self._entries.move_to_end(key)
+                _hits.inc()
+                return False
+            # a concurrent check of the same record finds it in the LRU
+            self._remember(key, now, expires is None)
+
+        first = True
+        if self.store is not None:
+            try:
+                first = self.store.add(key)
+            except Exception as e:
+                # a duplicate is cheaper than a lost record
+                logger.error(f"Failed to check the dedup store: {e}")
+
+        if not first:
+            _store_hits.inc()
+            _hits.inc()
+            return False
+        _misses.inc()
+        return True
@@ -0,0 +1,229 @@
+"""DID-sharded dispatcher for the firehose workers
+
+Frames are routed to one of N worker processes by a hash of the commit repo DID.
+Each worker owns its queue, so all events of one author are processed in order
+(i.e. a create followed by a delete) while the load is spread across cores.
+
+In the batch transport mode (see `firehose.transport`) the raw frame bytes are buffered per shard
+and sent as length-prefixed batches instead of one pickled `MessageFrame` per queue item.
+
+Every worker reports the seq it has finished into a shared array. The dispatcher remembers
+which seqs are still pending per shard and derives the cursor from them: it is the highest seq
+below which every frame has been processed, so resuming from it never skips an event.
+
+What happens to the frames of a full shard queue is decided by `firehose.overload`.
+"""
+
+import multiprocessing
+import time
+import zlib
+from collections import deque
+from functools import partial
+from typing import Callable, Iterable, List, Optional
+
+from atproto import firehose_models
+
+from firehose.overload import OverloadPolicy
+from firehose.transport import FrameBatcher
+
+
+def get_shard(did: str, shards_count: int) -> int:
+    """Get the shard index for the DID
+
+    `zlib.crc32` is used instead of `hash()` because it is stable across processes.
+
+    Args:
+        did (str): Repo DID
+        shards_count (int): Number of shards
+
+    Returns:
+        int: Shard index
+    """
+    return zlib.crc32(did.encode()) % shards_count
+
+
+class PendingSeqs:
+    """Track the seqs handed over to the shards which are not processed yet
+
+    Each shard processes its seqs in order and reports the last one it finished.
+    """
+
+    def __init__(self, shards_count: int):
+        self._pending = [deque() for _ in range(shards_count)]
+        self._discarded = [set() for _ in range(shards_count)]
+        self.last_seq = 0
+
+    def add(self, shard: int, seq: int) -> None:
+        """Remember the seq as pending on the shard"""
+        self._pending[shard].append(seq)
+        self.last_seq = seq
+
+    def skip(self, seq: int) -> None:
+        """Advance the seq for a frame which is not handed over to any shard"""
+        self.last_seq = seq
+
+    def discard(self, shard: int, seqs: Iterable[int]) -> None:
+        """Release the pending seqs of frames which were dropped after being handed over"""
+        self._discarded[shard].update(seqs)
+
+    def safe_cursor(self, done_seqs) -> int:
+        """Get the highest seq up to which every frame has been processed
+
+        Args:
+            done_seqs: Last finished seq of each shard
+
+        Returns:
+            int: Seq to resume from
+        """
+        cursor = self.last_seq
+        for shard, pending in enumerate(self._pending):
+            done = done_seqs[shard]
+            discarded = self._discarded[shard]
+            while pending and (pending[0] <= done or pending[0] in discarded):
+                discarded.discard(pending.popleft())
+            if pending:
+                cursor = min(cursor, pending[0] - 1)
+        return cursor
+
+
+class ShardedDispatcher:
+    """Route firehose frames to per-shard worker processes"""
+
+    def __init__(
+        self,
+        target: Callable,
+        workers_count: int,
+        max_queue_size: int,
+        args: tuple = (),
+        batch_options: Optional[dict] = None,
+        overload_policy: Optional[OverloadPolicy] = None,
+    ):
+        """
+        Args:
+            target (Callable): Worker function, called as
+                `target(shard, shard_queue, done_seqs, *args)`.
+                It must store the seq of each finished frame to `done_seqs[shard]`
+                and return when it gets `None` from the queue.
+            workers_count (int): Number of worker processes
+            max_queue_size (int): Total capacity of the queues, split evenly between shards
+            args (tuple): Extra arguments of the worker function
+            batch_options (Optional[dict]): Keyword arguments of `FrameBatcher`.
+                When given, raw frames are sent to the workers in batches.
+            overload_policy (Optional[OverloadPolicy]): Policy of the full queues,
+                blocks until a slot is free if None
+        """
+        self.workers_count = workers_count
+        self.queue_size = max(max_queue_size // workers_count, 1)
+        self.queues = [multiprocessing.Queue(maxsize=self.queue_size) for _ in range(workers_count)]
+        self.done_seqs = multiprocessing.Array("q", workers_count, lock=False)
+        self._pending = PendingSeqs(workers_count)
+        self.processes = [
+            multiprocessing.Process(
+                target=target, args=(shard, self.queues[shard], self.done_seqs, *args), daemon=True
+            )
+            for shard in range(workers_count)
+        ]
+        self.overload_policy = overload_policy or OverloadPolicy()
+        self.overload_policy.attach(self.queues, self.queue_size)
+        self.batchers = None
+        if batch_options is not None:
+            self.batchers = [
+                FrameBatcher(partial(self._put_batch, shard), **batch_options)
+                for shard in range(workers_count)
+            ]
+
+    def start(self) -> None:
+        """Start the worker processes"""
+        for process in self.processes:
+            process.start()
+        self.overload_policy.start()
+
+    def put(self, shard: int, item: object, seq: int) -> None:
+        """Put the item to the shard queue and remember its seq as pending
+
+        Args:
+            shard (int): Shard index
+            item (object): Item to put
+            seq (int): Highest seq contained in the item
+        """
+        self._pending.add(shard, seq)
+        if not self.overload_policy.put(shard, item):
+            self._pending.discard(shard, (seq,))
+
+    def _put_batch(self, shard: int, batch: bytes, seqs: List[int]) -> None:
+        if not self.overload_policy.put(shard, batch):
+            self._pending.discard(shard, seqs)
+
+    def dispatch(
+        self, message: firehose_models.MessageFrame, raw_frame: Optional[bytes] = None
+    ) -> None:
+        """Route the message to its shard
+
+        Only `#commit` frames are sent to the workers. Other frames are not processed,
+        so they only advance the seq.
+
+        Args:
+            message (firehose_models.MessageFrame): Message frame
+            raw_frame (Optional[bytes]): Raw bytes of the frame, required in the batch mode
+        """
+        seq = message.body.get("seq", self._pending.last_seq)
+        if message.type != "#commit":
+            self._pending.skip(seq)
+            return
+
+        shard = get_shard(message.body["repo"], self.workers_count)
+        if not self.overload_policy.admit(shard, message):
+            self._pending.skip(seq)
+            return
+
+        if self.batchers is None:
+            self.put(shard, message, seq)
+            return
+
+        # buffered frames are pending as well, so the cursor does not pass them
+        self._pending.add(shard, seq)
+        self.batchers[shard].add(raw_frame, seq)
+
+    def flush(self) -> None:
+        """Send the buffered batches to the workers"""
+        for batcher in self.batchers or ():
+            batcher.flush()
+
+    def safe_cursor(self) -> int:
+        """Get the highest seq up to which every dispatched frame has been processed
+
+        Returns:
+            int: Seq to resume from
+        """
+        return self._pending.safe_cursor(self.done_seqs)
+
+    @property
+    def last_seq(self) -> int:
+        """Seq of the last dispatched frame"""
+        return self._pending.last_seq
+
+    def queue_fill_ratio(self) -> float:
+        """Fill level of the fullest shard queue, between 0 and 1"""
+        return max(queue.qsize() for queue in self.queues) / self.queue_size
+
+    def empty(self) -> bool:
+        """Whether every shard queue and the overload policy are empty"""
+        self.flush()
+        return self.overload_policy.empty() and all(queue.empty() for queue in self.queues)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Ask the workers to finish their queues and wait for them
+
+        Args:
+            timeout (Optional[float]): Seconds to wait for each worker before terminating it
+        """
+        self.flush()
+        # the stop marker must not overtake the spilled items
+        while not self.overload_policy.empty():
+            time.sleep(0.01)
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
@@ -0,0 +1,86 @@
+"""Fast path to find the image posts on the decoded CBOR records
+
+Building the pydantic `AppBskyFeedPost` of every created post is the most expensive part of
+`_get_ops_by_type`, while only the posts with images can be watermarked. The extractor reads
+the embed of the raw record dict as decoded from the CAR, so that the model is built only for
+the posts which carry images.
+
+Supported embeds:
+    app.bsky.embed.images
+    app.bsky.embed.recordWithMedia whose media is app.bsky.embed.images
+"""
+
+from dataclasses import dataclass
+from typing import List, Union
+
+import libipld
+
+EMBED_IMAGES = "app.bsky.embed.images"
+EMBED_RECORD_WITH_MEDIA = "app.bsky.embed.recordWithMedia"
+
+
+@dataclass
+class ImageBlob:
+    """Image of a post"""
+
+    cid: str
+    mime_type: str
+    size: int
+    alt: str
+
+
+def _blob_cid(ref: Union[str, bytes, dict]) -> str:
+    """Get the CID string of a blob ref in any of its representations"""
+    if isinstance(ref, str):
+        return ref
+    if isinstance(ref, bytes):
+        return libipld.encode_cid(ref)
+    return ref["$link"]
+
+
+def get_embed_type(record: dict) -> str:
+    """Get the `$type` of the post embed, an empty string if the post has none"""
+    embed = record.get("embed")
+    return embed.get("$type", "") if isinstance(embed, dict) else ""
+
+
+def extract_images(record: dict) -> List[ImageBlob]:
+    """Extract the images of a raw post record
+
+    Args:
+        record (dict): `app.bsky.feed.post` record as decoded from the CAR blocks
+
+    Returns:
+        List[ImageBlob]: Images of the post, empty if the post has no image embed
+    """
+    embed = record.get("embed")
+    if not isinstance(embed, dict):
+        return []
+    embed_type = embed.get("$type")
+    if embed_type == EMBED_RECORD_WITH_MEDIA:
+        embed = embed.get("media") or {}
+        embed_type = embed.get("$type")
+    if embed_type != EMBED_IMAGES:
+        return []
+
+    images = []
+    for image in embed.get("images") or ():
+        blob = image.get("image")
+        if not isinstance(blob, dict):
+            continue
+        if "ref" in blob:
+            cid = _blob_cid(blob["ref"])
+        elif "cid" in blob:
+            # legacy blob, written before the `$type: blob` representation
+            cid = blob["cid"]
+        else:
+            continue
+        images.append(
+            ImageBlob(
+                cid=cid,
+                mime_type=blob.get("mimeType", ""),
+                size=blob.get("size", 0),
+                alt=image.get("alt", ""),
+            )
+        )
+    return images
@@ -4,13 +4,15 @@ See:
     https://github.com/MarshalX/atproto/blob/main/examples/firehose/process_commits.py
 """
 
-import json
 import multiprocessing
+import os
+import queue
 import signal
 import time
 from collections import defaultdict
+from datetime import datetime
 from types import FrameType
-from typing import Any
+from typing import Iterator, List, Optional, Union
 
 from atproto import (
     CAR,
@@ -21,13 +23,74 @@ from atproto import (
     parse_subscribe_repos_message,
 )
 
+from firehose.checkpoint import Checkpointer, get_checkpoint_store
+from firehose.coalesce import FOLLOW, UNFOLLOW, FollowCoalescer
+from firehose.dedup import DedupCache, get_dedup_store
+from firehose.dispatcher import ShardedDispatcher
+from firehose.images import extract_images
+from firehose.metrics import MetricsExporter, MetricsPusher, metrics
+from firehose.overload import POLICY_BLOCK, get_overload_policy
+from firehose.prefilter import DECODED_ACTIONS, CollectionPreFilter
+from firehose.subscribers import SubscriberSet, get_snapshot_source
+from firehose.transport import (
+    TRANSPORT_BATCH,
+    RawFrameFirehoseClient,
+    start_flusher,
+    unpack_frames,
+)
+from lib.aws.step_functions import start_batches
+from lib.bs.dms import SIGNOUT, SIGNUP
 from lib.log import logger
+from lib.registry import UserRegistry, get_registry_store
 
 _INTERESTED_RECORDS = {
     models.ids.AppBskyFeedPost: models.AppBskyFeedPost,  # Posts
     models.ids.AppBskyGraphFollow: models.AppBskyGraphFollow,  # Follows
 }
 
+_NO_OPS = {"created": [], "deleted": []}
+
+_subscribers_url = os.getenv("FIREHOSE_SUBSCRIBERS_URL")
+_registry_url = os.getenv("FIREHOSE_REGISTRY_URL")
+subscribers = None
+"""DIDs of the users who completed the signup, all authors pass if not configured"""
+if _registry_url:
+    subscribers = UserRegistry(get_registry_store(_registry_url))
+elif _subscribers_url:
+    subscribers = SubscriberSet(get_snapshot_source(_subscribers_url))
+
+BOT_DID = os.getenv("BOT_DID") or None
+"""DID of the bot, only the follows of the bot are collected. No follow is collected if unset"""
+_signup_state_machine_arn = os.getenv("FIREHOSE_SIGNUP_STATE_MACHINE_ARN")
+_signout_state_machine_arn = os.getenv("FIREHOSE_SIGNOUT_STATE_MACHINE_ARN")
+FOLLOW_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", 25))
+"""Follow changes handled per getter and notifier invocation of the flows"""
+
+_dedup_url = os.getenv("FIREHOSE_DEDUP_URL")
+dedup = DedupCache(
+    max_bytes=int(os.getenv("FIREHOSE_DEDUP_MAX_BYTES", 64 * 1024 * 1024)),
+    ttl=float(os.getenv("FIREHOSE_DEDUP_TTL", 86400)),
+)
+"""Records handled recently, the persistent store is opened by each worker"""
+
+_filter_latency = metrics.histogram("firehose_filter_seconds", "Pre-filter latency, sampled")
+_FILTER_SAMPLING_MASK = 0xF
+_filter_dropped = metrics.counter(
+    "firehose_filter_dropped_total", "Commits dropped by the pre-filter"
+)
+_parse_latency = metrics.histogram("firehose_parse_seconds", "Commit parse and CAR decode latency")
+_dispatch_latency = metrics.histogram("firehose_dispatch_seconds", "Operations dispatch latency")
+_posts_without_images = metrics.counter(
+    "firehose_posts_without_images_total", "Created posts skipped before building their model"
+)
+_processed = metrics.counter("firehose_processed_frames_total", "Frames processed by workers")
+_errors = metrics.counter("firehose_errors_total", "Frames failed to be processed")
+
+# follows are needed from anyone since following the bot is the signup
+pre_filter = CollectionPreFilter(
+    _INTERESTED_RECORDS, subscribers=subscribers, subscriber_only={models.ids.AppBskyFeedPost}
+)
+
 
 def on_callback_error_handler(error: BaseException) -> None:
     """Error handler for the callback
@@ -49,12 +112,17 @@ def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> defa
     """
     operation_by_type = defaultdict(lambda: {"created": [], "deleted": []})
 
-    car = CAR.from_bytes(commit.blocks)
-    for op in commit.ops:
-        if op.action == "update":
-            # not supported yet
-            continue
-
+    ops = [
+        op
+        for op in commit.ops
+        if op.action in DECODED_ACTIONS and pre_filter.is_interested(op.path)
+    ]
+    if not ops:
+        return operation_by_type
+
+    # deletions carry no record, so the CAR is decoded only when something was created
+    car = CAR.from_bytes(commit.blocks) if any(op.action == "create" for op in ops) else None
+    for op in ops:
         uri = AtUri.from_str(f"at://{commit.repo}/{op.path}")
 
         if op.action == "create":
@@ -67,6 +135,14 @@ def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> defa
             if not record_raw_data:
                 continue
 
+            if uri.collection == models.ids.AppBskyFeedPost:
+                # only the posts with images are watermarked, the others are not worth a model
+                images = extract_images(record_raw_data)
+                if not images:
+                    _posts_without_images.inc()
+                    continue
+                create_info["images"] = images
+
             record = models.get_or_create(record_raw_data, strict=False)
             record_type = _INTERESTED_RECORDS.get(uri.collection)
             if record_type and models.is_record_type(record, record_type):
@@ -75,100 +151,265 @@ def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> defa
                 )
 
         if op.action == "delete":
-            operation_by_type[uri.collection]["deleted"].append({"uri": str(uri)})
+            operation_by_type[uri.collection]["deleted"].append(
+                {"uri": str(uri), "author": commit.repo}
+            )
 
     return operation_by_type
 
 
-def worker_main(cursor_value: multiprocessing.Value, pool_queue: multiprocessing.Queue) -> None:
-    """Worker main function
+def decode_commit(message: firehose_models.MessageFrame) -> Optional[dict]:
+    """Parse a `#commit` message and decode its interested operations
+
+    This is the CPU heavy part of the processing.
 
     Args:
-        cursor_value (multiprocessing.Value): value of the cursor
-        pool_queue (multiprocessing.Queue): Queue object
+        message (firehose_models.MessageFrame): `#commit` message frame
+
+    Returns:
+        Optional[dict]: Operations by type
     """
-    signal.signal(signal.SIGINT, signal.SIG_IGN)  # we handle it in the main process
+    commit = parse_subscribe_repos_message(message)
+    if not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit):
+        return None
 
-    while True:
-        message = pool_queue.get()
+    if not commit.blocks:
+        return None
 
-        commit = parse_subscribe_repos_message(message)
-        if not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit):
-            continue
+    return dict(_get_ops_by_type(commit))
 
-        if commit.seq % 20 == 0:
-            cursor_value.value = commit.seq
 
-        if not commit.blocks:
-            continue
+def drop_duplicates(ops: dict) -> dict:
+    """Drop the created records which were already handled, i.e. replayed after a reconnect
 
-        ops = _get_ops_by_type(commit)
-
-        for created_post in ops[models.ids.AppBskyFeedPost]["created"]:
-            # TODO implement it
-            # https://atproto.blue/en/latest/atproto/atproto_client.models.app.bsky.feed.post.html
-            author = created_post["author"]
-            record = created_post["record"]
-            inlined_text = record.text.replace("\n", " ")
-            # when a new post is captured
-            logger.info(
-                f"NEW POST [CREATED_AT={record.created_at}][AUTHOR={author}]: {inlined_text}"
-            )
+    Args:
+        ops (dict): Operations by type, returned by `decode_commit`
 
-        for follow in ops[models.ids.AppBskyGraphFollow]["created"]:
-            # TODO implement it
-            # https://pub.dev/documentation/lexicon/latest/docs/appBskyGraphFollow-constant.html
-            payload = json.dumps(
-                {
-                    "cid": follow["cid"],
-                    "uri": follow["uri"],
-                    "follower_did": follow["author"],
-                    "followed_did": follow["record"].subject,
-                    "created_at": follow["record"].created_at,
-                }
-            )
-            logger.info(f"NEW FOLLOW: {payload}")
+    Returns:
+        dict: Operations by type without the duplicates
+    """
+    for collection_ops in ops.values():
+        created = collection_ops["created"]
+        if created:
+            collection_ops["created"] = [c for c in created if dedup.first_seen(c["uri"], c["cid"])]
+    return ops
 
 
-def get_firehose_params(
-    cursor_value: multiprocessing.Value,
-) -> models.ComAtprotoSyncSubscribeRepos.Params:
-    """Get firehose params
+def handle_ops(ops: dict) -> None:
+    """Handle the decoded operations
 
     Args:
-        cursor_value (multiprocessing.Value): Cursor value
+        ops (dict): Operations by type, returned by `decode_commit`
+    """
+    for created_post in ops.get(models.ids.AppBskyFeedPost, _NO_OPS)["created"]:
+        # TODO implement it
+        # https://atproto.blue/en/latest/atproto/atproto_client.models.app.bsky.feed.post.html
+        author = created_post["author"]
+        record = created_post["record"]
+        images = len(created_post["images"])
+        inlined_text = record.text.replace("\n", " ")
+        # when a new post is captured
+        logger.info(
+            f"NEW POST [CREATED_AT={record.created_at}][AUTHOR={author}][IMAGES={images}]:"
+            f" {inlined_text}"
+        )
+
+    follow_ops = ops.get(models.ids.AppBskyGraphFollow, _NO_OPS)
+    for follow in follow_ops["created"]:
+        # https://pub.dev/documentation/lexicon/latest/docs/appBskyGraphFollow-constant.html
+        if BOT_DID is None or follow["record"].subject != BOT_DID:
+            continue
+        follow_coalescer.follow(
+            follow["uri"],
+            follow["cid"],
+            follow["author"],
+            follow["record"].subject,
+            follow["record"].created_at,
+        )
+    for unfollow in follow_ops["deleted"]:
+        if is_follow_of_bot(unfollow["uri"], unfollow["author"]):
+            follow_coalescer.unfollow(unfollow["uri"])
+    follow_coalescer.flush_if_due()
+
+
+def is_follow_of_bot(uri: str, author: str) -> bool:
+    """Whether a deleted follow record was a follow of the bot
+
+    A delete carries no subject. The follows of the bot seen recently are known by the
+    coalescer, the older ones by the `follow_uri` saved in the registry record at signup.
+
+    Args:
+        uri (str): URI of the deleted follow record
+        author (str): DID of the follower
 
     Returns:
-        models.ComAtprotoSyncSubscribeRepos.Params: Firehose params
+        bool: True if the record followed the bot
     """
-    return models.ComAtprotoSyncSubscribeRepos.Params(cursor=cursor_value.value)
+    if follow_coalescer.is_known(uri):
+        return True
+    # only the registry keeps the records, a DID set cannot tell the follows apart
+    get_record = getattr(subscribers, "get", None)
+    if get_record is None:
+        return False
+    record = get_record(author)
+    return record is not None and record.get("follow_uri") == uri
+
 
+def _to_item(command: str, change: dict) -> dict:
+    return {
+        "command": command,
+        "did": change["follower_did"],
+        "uri": change["uri"],
+        "created_at": change.get("created_at"),
+    }
 
-def measure_events_per_second(func: callable) -> callable:
-    """Measure events per second
+
+def dispatch_follow_changes(changes: List[dict]) -> None:
+    """Dispatch the net follow changes of a window to the signup and signout flows
 
     Args:
-        func (callable): Function
+        changes (List[dict]): Net changes, see `FollowCoalescer`
+    """
+    flows = (
+        (SIGNUP, FOLLOW, _signup_state_machine_arn),
+        (SIGNOUT, UNFOLLOW, _signout_state_machine_arn),
+    )
+    for command, action, state_machine_arn in flows:
+        items = [_to_item(command, c) for c in changes if c["action"] == action]
+        if not items:
+            continue
+        if not state_machine_arn:
+            logger.info(f"No {command} flow configured, dropped {len(items)} follow changes")
+            continue
+        try:
+            execution_arn = start_batches(state_machine_arn, items, FOLLOW_BATCH_SIZE)
+        except Exception as e:
+            logger.error(f"Failed to start the {command} flow with {len(items)} items: {e}")
+            continue
+        logger.info(f"Started the {command} flow with {len(items)} follow changes: {execution_arn}")
 
-    Returns:
-        callable: Wrapper function
+
+follow_coalescer = FollowCoalescer(
+    dispatch_follow_changes, window=float(os.getenv("FIREHOSE_FOLLOW_WINDOW", 10))
+)
+"""Follows are sharded by the follower DID, so each pair is coalesced in one worker"""
+
+
+def process_message(message: firehose_models.MessageFrame) -> None:
+    """Process a firehose message
+
+    Args:
+        message (firehose_models.MessageFrame): Message frame
+    """
+    if message.type != "#commit":
+        return
+
+    # drop commits without interested ops before building any model
+    if (pre_filter.commits_matched + pre_filter.commits_skipped) & _FILTER_SAMPLING_MASK:
+        interested = pre_filter.match(message.body)
+    else:
+        # the pre-filter takes a few microseconds, so its latency is sampled
+        started = time.perf_counter()
+        interested = pre_filter.match(message.body)
+        _filter_latency.observe(time.perf_counter() - started)
+    if not interested:
+        _filter_dropped.inc()
+        return
+
+    filtered = time.perf_counter()
+    ops = decode_commit(message)
+    parsed = time.perf_counter()
+    _parse_latency.observe(parsed - filtered)
+    if ops:
+        handle_ops(drop_duplicates(ops))
+        _dispatch_latency.observe(time.perf_counter() - parsed)
+
+
+def _iter_messages(
+    item: Union[firehose_models.MessageFrame, bytes],
+) -> Iterator[firehose_models.MessageFrame]:
+    """Iterate over the messages of a queue item
+
+    Args:
+        item (Union[firehose_models.MessageFrame, bytes]): Message frame or batch of raw frames
+
+    Yields:
+        firehose_models.MessageFrame: Message frame
+    """
+    if not isinstance(item, bytes):
+        yield item
+        return
+    for raw_frame in unpack_frames(item):
+        yield firehose_models.Frame.from_bytes(raw_frame)
+
+
+def worker_main(
+    shard: int,
+    shard_queue: multiprocessing.Queue,
+    done_seqs: multiprocessing.Array,
+    metrics_queue: Optional[multiprocessing.Queue] = None,
+) -> None:
+    """Worker main function
+
+    Args:
+        shard (int): Shard index of the worker
+        shard_queue (multiprocessing.Queue): Queue of the shard, holding message frames
+            or batches of raw frames
+        done_seqs (multiprocessing.Array): Last processed seq of each shard
+        metrics_queue (Optional[multiprocessing.Queue]): Queue to push the worker metrics to
     """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # we handle it in the main process
+    if subscribers is not None:
+        subscribers.start()
+    if _dedup_url:
+        # records of an author always land on the same shard, so the stores do not overlap
+        dedup.store = get_dedup_store(_dedup_url, shard, dedup.ttl)
+    pusher = MetricsPusher(metrics, metrics_queue) if metrics_queue is not None else None
+
+    while True:
+        try:
+            item = shard_queue.get(timeout=follow_coalescer.window)
+        except queue.Empty:
+            # the window is flushed by the next follow otherwise
+            follow_coalescer.flush_if_due()
+            continue
+        if item is None:
+            # stop requested by the dispatcher
+            follow_coalescer.flush()
+            if pusher:
+                pusher.push()
+            return
+
+        for message in _iter_messages(item):
+            try:
+                process_message(message)
+            except Exception as e:
+                _errors.inc()
+                logger.exception(f"Failed to process the message: {e}")
+
+            _processed.inc()
+            done_seqs[shard] = message.body["seq"]
 
-    def wrapper(*args) -> Any:
-        wrapper.calls += 1
-        cur_time = time.time()
+        if pusher:
+            pusher.push_if_due()
 
-        if cur_time - wrapper.start_time >= 1:
-            logger.info(f"NETWORK LOAD: {wrapper.calls} events/second")
-            wrapper.start_time = cur_time
-            wrapper.calls = 0
+        stats = pre_filter.report()
+        if stats:
+            logger.info(f"[SHARD={shard}] {stats}")
 
-        return func(*args)
 
-    wrapper.calls = 0
-    wrapper.start_time = time.time()
+def get_firehose_params(
+    cursor_value: multiprocessing.Value,
+) -> models.ComAtprotoSyncSubscribeRepos.Params:
+    """Get firehose params
 
-    return wrapper
+    Args:
+        cursor_value (multiprocessing.Value): Cursor value
+
+    Returns:
+        models.ComAtprotoSyncSubscribeRepos.Params: Firehose params
+    """
+    return models.ComAtprotoSyncSubscribeRepos.Params(cursor=cursor_value.value)
 
 
 def signal_handler(_: int, __: FrameType) -> None:
@@ -180,15 +421,16 @@ def signal_handler(_: int, __: FrameType) -> None:
     # Stop receiving new messages
     client.stop()
 
-    # Drain the messages queue
-    while not queue.empty():
+    # Drain the messages queues
+    while not dispatcher.empty():
         logger.info("Waiting for the queue to empty...")
         time.sleep(0.2)
 
     logger.info("Queue is empty. Gracefully terminating processes...")
 
-    pool.terminate()
-    pool.join()
+    dispatcher.stop(timeout=10)
+    checkpointer.update(dispatcher.safe_cursor())
+    checkpointer.stop()
     # exit the main process gracefully.
     logger.info("Listener stopped gracefully, Bye!")
     exit(0)
@@ -198,30 +440,117 @@ if __name__ == "__main__":
     logger.info("Starting listener...")
     signal.signal(signal.SIGINT, signal_handler)
 
-    start_cursor = None
+    checkpoint_store = get_checkpoint_store(
+        os.getenv("FIREHOSE_CHECKPOINT_URL", "file://./.firehose-cursor")
+    )
+    start_cursor = checkpoint_store.load()
 
     params = None
-    cursor = multiprocessing.Value("i", 0)
+    # firehose seqs exceed the range of 32-bit int
+    cursor = multiprocessing.Value("q", 0)
     if start_cursor is not None:
-        cursor = multiprocessing.Value("i", start_cursor)
+        logger.info(f"Resuming from the checkpoint seq={start_cursor}")
+        cursor = multiprocessing.Value("q", start_cursor)
         params = get_firehose_params(cursor)
 
-    client = FirehoseSubscribeReposClient(params)
+    checkpointer = Checkpointer(
+        checkpoint_store,
+        interval=float(os.getenv("FIREHOSE_CHECKPOINT_INTERVAL", 10)),
+        every_events=int(os.getenv("FIREHOSE_CHECKPOINT_EVERY_EVENTS", 10000)),
+    )
+    checkpointer.start()
 
-    # workers_count = multiprocessing.cpu_count() * 2 - 1
-    workers_count = 1
+    # one core is left for the websocket receiver
+    workers_count = int(os.getenv("FIREHOSE_WORKERS", max(multiprocessing.cpu_count() - 1, 1)))
     max_queue_size = 10000
+    cursor_update_interval = 1.0
+    transport = os.getenv("FIREHOSE_TRANSPORT", TRANSPORT_BATCH)
+    batch_options = None
+    if transport == TRANSPORT_BATCH:
+        batch_options = {
+            "max_frames": int(os.getenv("FIREHOSE_BATCH_FRAMES", 200)),
+            "max_bytes": int(os.getenv("FIREHOSE_BATCH_BYTES", 1024 * 1024)),
+            "flush_interval": float(os.getenv("FIREHOSE_BATCH_FLUSH_INTERVAL", 0.05)),
+        }
+        client = RawFrameFirehoseClient(params)
+    else:
+        client = FirehoseSubscribeReposClient(params)
+
+    # a full queue must not stall the websocket callback, or the relay drops the connection
+    overload_policy_name = os.getenv("FIREHOSE_OVERLOAD_POLICY", POLICY_BLOCK)
+    overload_policy = get_overload_policy(
+        overload_policy_name,
+        timeout=float(os.getenv("FIREHOSE_OVERLOAD_TIMEOUT", 5)),
+        interested=_INTERESTED_RECORDS,
+        spill_dir=os.getenv("FIREHOSE_SPILL_DIR", "/tmp/firehose-spill"),
+        max_spill_bytes=int(os.getenv("FIREHOSE_SPILL_MAX_BYTES", 4 * 1024**3)),
+    )
 
-    queue = multiprocessing.Queue(maxsize=max_queue_size)
-    pool = multiprocessing.Pool(workers_count, worker_main, (cursor, queue))
+    metrics_queue = multiprocessing.Queue(maxsize=workers_count * 10)
+    dispatcher = ShardedDispatcher(
+        worker_main,
+        workers_count,
+        max_queue_size,
+        args=(metrics_queue,),
+        batch_options=batch_options,
+        overload_policy=overload_policy,
+    )
+    dispatcher.start()
+    if dispatcher.batchers:
+        start_flusher(dispatcher.batchers, batch_options["flush_interval"] / 2)
+    logger.info(
+        f"Started {workers_count} workers. transport={transport} overload={overload_policy_name}"
+    )
 
-    @measure_events_per_second
-    def on_message_handler(message: firehose_models.MessageFrame) -> None:
-        if cursor.value:
-            # we are using updating the cursor state here because of multiprocessing
-            # typically you can call client.update_params() directly on commit processing
-            client.update_params(get_firehose_params(cursor))
+    received = metrics.counter("firehose_received_frames_total", "Frames received")
+    received_bytes = metrics.counter("firehose_received_bytes_total", "Bytes of raw frames")
+    receive_latency = metrics.histogram(
+        "firehose_receive_seconds", "Time in the websocket client between two frames"
+    )
+    enqueue_latency = metrics.histogram("firehose_enqueue_seconds", "Dispatch to a shard queue")
+    queue_fill = metrics.gauge("firehose_queue_fill_ratio", "Fill level of the fullest queue")
+    seq_lag = metrics.gauge("firehose_seq_lag", "Received seq minus the processed cursor")
+    time_lag = metrics.gauge("firehose_commit_time_lag_seconds", "Now minus the commit time")
+
+    exporter = MetricsExporter(
+        metrics,
+        metrics_queue,
+        interval=float(os.getenv("FIREHOSE_METRICS_INTERVAL", 10)),
+        collectors=[lambda: queue_fill.set(dispatcher.queue_fill_ratio())],
+    )
+    metrics_port = os.getenv("FIREHOSE_METRICS_PORT")
+    exporter.start(int(metrics_port) if metrics_port else None)
 
-        queue.put(message)
+    last_cursor_update = time.monotonic()
+    last_returned = time.perf_counter()
+
+    def on_message_handler(message: firehose_models.MessageFrame) -> None:
+        global last_cursor_update, last_returned
+
+        started = time.perf_counter()
+        receive_latency.observe(started - last_returned)
+        received.inc()
+        raw_frame = None
+        if batch_options:
+            raw_frame = client.last_raw_frame
+            received_bytes.inc(len(raw_frame))
+
+        dispatcher.dispatch(message, raw_frame)
+        last_returned = time.perf_counter()
+        enqueue_latency.observe(last_returned - started)
+
+        now = time.monotonic()
+        if now - last_cursor_update >= cursor_update_interval:
+            last_cursor_update = now
+            safe_cursor = dispatcher.safe_cursor()
+            seq_lag.set(dispatcher.last_seq - safe_cursor)
+            commit_time = message.body.get("time")
+            if commit_time:
+                time_lag.set(time.time() - datetime.fromisoformat(commit_time).timestamp())
+            if safe_cursor and safe_cursor != cursor.value:
+                # the client resumes from this cursor on reconnecting
+                cursor.value = safe_cursor
+                client.update_params(get_firehose_params(cursor))
+                checkpointer.update(safe_cursor)
 
     client.start(on_message_handler, on_callback_error_handler)
@@ -0,0 +1,369 @@
+"""Hot-path metrics of the firehose listener
+
+Every process records into its own `MetricsRegistry` with plain attribute updates, no locks.
+The values are never reset, so that no increment is lost to a concurrent reset: the deltas are
+computed against the values of the previous snapshot. The workers push the deltas of their
+registry to the main process periodically, where the `MetricsExporter` aggregates them and
+exports them as:
+
+* CloudWatch Embedded Metric Format (EMF) lines on stdout, one per interval (deltas)
+* a Prometheus text endpoint on `FIREHOSE_METRICS_PORT` (cumulative values)
+
+Stage names used by the listener: receive, enqueue, filter, parse, dispatch.
+"""
+
+import bisect
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+
+from lib.log import logger
+
+_LATENCY_BUCKETS = [1e-6 * 2**i for i in range(24)]
+"""Upper bounds of the latency buckets in seconds, 1us to ~8.4s"""
+
+
+class Counter:
+    """Monotonically increasing value"""
+
+    __slots__ = ("name", "help", "value")
+
+    def __init__(self, name: str, help: str = ""):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+
+class Gauge:
+    """Value which can go up and down"""
+
+    __slots__ = ("name", "help", "value")
+
+    def __init__(self, name: str, help: str = ""):
+        self.name = name
+        self.help = help
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Histogram:
+    """Latency histogram with fixed exponential buckets"""
+
+    __slots__ = ("name", "help", "counts", "sum", "count")
+
+    def __init__(self, name: str, help: str = ""):
+        self.name = name
+        self.help = help
+        self.counts = [0] * (len(_LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(_LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate the quantile from the bucket upper bounds
+
+        Args:
+            q (float): Quantile between 0 and 1
+
+        Returns:
+            float: Estimated latency in seconds
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return _LATENCY_BUCKETS[min(i, len(_LATENCY_BUCKETS) - 1)]
+        return _LATENCY_BUCKETS[-1]
+
+
+class MetricsRegistry:
+    """Metrics of one process"""
+
+    def __init__(self):
+        self.counters: Dict[str, Counter] = {}
+        self.gauges: Dict[str, Gauge] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self._last: dict = {"counters": {}, "histograms": {}}
+        """Cumulative values of the previous snapshot of deltas"""
+
+    def counter(self, name: str, help: str = "") -> Counter:
+        """Get or create a counter"""
+        if name not in self.counters:
+            self.counters[name] = Counter(name, help)
+        return self.counters[name]
+
+    def gauge(self, name: str, help: str = "") -> Gauge:
+        """Get or create a gauge"""
+        if name not in self.gauges:
+            self.gauges[name] = Gauge(name, help)
+        return self.gauges[name]
+
+    def histogram(self, name: str, help: str = "") -> Histogram:
+        """Get or create a latency histogram"""
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, help)
+        return self.histograms[name]
+
+    def snapshot(self, deltas: bool = False) -> dict:
+        """Get the values as a picklable dict
+
+        Args:
+            deltas (bool): Get the counters and histograms since the previous snapshot of deltas,
+                instead of their cumulative values
+
+        Returns:
+            dict: Snapshot, see `merge`
+        """
+        snapshot = {
+            "counters": {name: (c.help, c.value) for name, c in list(self.counters.items())},
+            "gauges": {name: (g.help, g.value) for name, g in list(self.gauges.items())},
+            "histograms": {
+                name: (h.help, list(h.counts), h.sum, h.count)
+                for name, h in list(self.histograms.items())
+            },
+        }
+        if not deltas:
+            return snapshot
+        last, self._last = self._last, snapshot
+        counters = {}
+        for name, (help, value) in snapshot["counters"].items():
+            counters[name] = (help, value - last["counters"].get(name, (help, 0))[1])
+        histograms = {}
+        for name, (help, counts, total, count) in snapshot["histograms"].items():
+            previous = last["histograms"].get(name)
+            if previous is not None:
+                counts = [a - b for a, b in zip(counts, previous[1])]
+                total -= previous[2]
+                count -= previous[3]
+            histograms[name] = (help, counts, total, count)
+        return {"counters": counters, "gauges": snapshot["gauges"], "histograms": histograms}
+
+    def merge(self, snapshot: dict) -> None:
+        """Add the counters and histograms of the snapshot and take over its gauges
+
+        Args:
+            snapshot (dict): Snapshot built by `snapshot`
+        """
+        for name, (help, value) in snapshot["counters"].items():
+            self.counter(name, help).inc(value)
+        for name, (help, value) in snapshot["gauges"].items():
+            self.gauge(name, help).set(value)
+        for name, (help, counts, total, count) in snapshot["histograms"].items():
+            h = self.histogram(name, help)
+            h.counts = [a + b for a, b in zip(h.counts, counts)]
+            h.sum += total
+            h.count += count
+
+    def to_prometheus(self) -> str:
+        """Render the metrics in the Prometheus text exposition format"""
+        lines = []
+        for c in self.counters.values():
+            lines += [
+                f"# HELP {c.name} {c.help}",
+                f"# TYPE {c.name} counter",
+                f"{c.name} {c.value}",
+            ]
+        for g in self.gauges.values():
+            lines += [f"# HELP {g.name} {g.help}", f"# TYPE {g.name} gauge", f"{g.name} {g.value}"]
+        for h in self.histograms.values():
+            lines += [f"# HELP {h.name} {h.help}", f"# TYPE {h.name} histogram"]
+            cumulative = 0
+            for bound, n in zip(_LATENCY_BUCKETS, h.counts):
+                cumulative += n
+                lines.append(f'{h.name}_bucket{{le="{bound:.6g}"}} {cumulative}')
+            lines.append(f'{h.name}_bucket{{le="+Inf"}} {h.count}')
+            lines += [f"{h.name}_sum {h.sum}", f"{h.name}_count {h.count}"]
+        return "\n".join(lines) + "\n"
+
+    def to_emf(self, namespace: str, dimensions: Dict[str, str]) -> dict:
+        """Render the metrics as a CloudWatch Embedded Metric Format document
+
+        Histograms are sent as `Values`/`Counts` pairs of the non-empty buckets.
+
+        Args:
+            namespace (str): CloudWatch namespace
+            dimensions (Dict[str, str]): Dimension names and values
+
+        Returns:
+            dict: EMF document
+        """
+        document = dict(dimensions)
+        definitions = []
+        for c in self.counters.values():
+            document[c.name] = c.value
+            definitions.append({"Name": c.name, "Unit": "Count"})
+        for g in self.gauges.values():
+            document[g.name] = g.value
+            definitions.append({"Name": g.name, "Unit": "None"})
+        for h in self.histograms.values():
+            if not h.count:
+                continue
+            values, counts = [], []
+            for bound, n in zip(_LATENCY_BUCKETS + [_LATENCY_BUCKETS[-1]], h.counts):
+                if n:
+                    values.append(bound * 1000)
+                    counts.append(n)
+            document[h.name] = {"Values": values, "Counts": counts}
+            definitions.append({"Name": h.name, "Unit": "Milliseconds"})
+        document["_aws"] = {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": namespace,
+                    "Dimensions": [list(dimensions)],
+                    "Metrics": definitions,
+                }
+            ],
+        }
+        return document
+
+
+metrics = MetricsRegistry()
+"""Registry of the current process"""
+
+
+class MetricsPusher:
+    """Push the deltas of a worker registry to the main process"""
+
+    def __init__(self, registry: MetricsRegistry, target: "queue.Queue", interval: float = 5.0):
+        """
+        Args:
+            registry (MetricsRegistry): Registry of the worker
+            target (queue.Queue): Queue read by `MetricsExporter`
+            interval (float): Seconds between two pushes
+        """
+        self.registry = registry
+        self.target = target
+        self.interval = interval
+        self._last_push = time.monotonic()
+
+    def push_if_due(self) -> None:
+        """Push the deltas once per interval, called from the worker loop"""
+        now = time.monotonic()
+        if now - self._last_push < self.interval:
+            return
+        self._last_push = now
+        self.push()
+
+    def push(self) -> None:
+        """Push the deltas now, i.e. before the worker exits"""
+        try:
+            self.target.put_nowait(self.registry.snapshot(deltas=True))
+        except queue.Full:
+            pass
+
+
+class MetricsExporter:
+    """Aggregate the registries of all processes and export them"""
+
+    def __init__(
+        self,
+        registry: MetricsRegistry,
+        source: Optional["queue.Queue"] = None,
+        interval: float = 10.0,
+        namespace: str = "wmput/firehose",
+        dimensions: Optional[Dict[str, str]] = None,
+        collectors: Optional[List[Callable[[], None]]] = None,
+    ):
+        """
+        Args:
+            registry (MetricsRegistry): Registry of the main process
+            source (Optional[queue.Queue]): Queue of the worker snapshots
+            interval (float): Seconds between two EMF lines
+            namespace (str): CloudWatch namespace
+            dimensions (Optional[Dict[str, str]]): EMF dimensions
+            collectors (Optional[List[Callable[[], None]]]): Called before each export,
+                to update the gauges which are not maintained on the hot path
+        """
+        self.registry = registry
+        self.source = source
+        self.interval = interval
+        self.namespace = namespace
+        self.dimensions = dimensions or {"Service": "firehose"}
+        self.collectors = collectors or []
+        self.total = MetricsRegistry()
+        """Cumulative values of all processes, served to Prometheus"""
+        self._lock = threading.Lock()
+
+    def collect(self) -> MetricsRegistry:
+        """Aggregate the pending snapshots
+
+        Returns:
+            MetricsRegistry: Deltas since the previous call
+        """
+        for collector in self.collectors:
+            collector()
+        interval = MetricsRegistry()
+        snapshots = [self.registry.snapshot(deltas=True)]
+        while self.source is not None:
+            try:
+                snapshots.append(self.source.get_nowait())
+            except queue.Empty:
+                break
+        with self._lock:
+            for snapshot in snapshots:
+                interval.merge(snapshot)
+                self.total.merge(snapshot)
+        return interval
+
+    def export(self) -> None:
+        """Print one EMF line with the deltas since the previous export"""
+        interval = self.collect()
+        print(json.dumps(interval.to_emf(self.namespace, self.dimensions)), flush=True)
+
+    def prometheus(self) -> str:
+        """Render the cumulative values in the Prometheus format"""
+        with self._lock:
+            return self.total.to_prometheus()
+
+    def start(self, port: Optional[int] = None) -> None:
+        """Start the export thread and the HTTP endpoint
+
+        Args:
+            port (Optional[int]): Port of the `/metrics` endpoint, not served if None
+        """
+
+        def run() -> None:
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.export()
+                except Exception as e:
+                    logger.error(f"Failed to export the metrics: {e}")
+
+        threading.Thread(target=run, name="metrics-exporter", daemon=True).start()
+        if port is None:
+            return
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                body = exporter.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        server = ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info(f"Serving the metrics on :{port}/metrics")
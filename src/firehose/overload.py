@@ -0,0 +1,375 @@
+"""Overload policies of the shard queues
+
+When the workers fall behind (i.e. a CPU spike), a blocking `queue.put` stalls the websocket
+callback, the relay disconnects us as a slow consumer and we reconnect from a stale cursor.
+The policy decides what happens to a frame whose shard queue is full:
+
+    block: wait up to `timeout` seconds for a free slot, then shed the frame
+    shed : above `high_watermark`, drop the frames without interested collections first.
+           The workers would drop them anyway, so nothing is lost until the interested
+           frames themselves time out as in `block`.
+    spill: append the items to per-shard segment files on the local disk, drained into the
+           queue by a background thread when the workers catch up. A segment is deleted once
+           it has been drained, so the disk is freed while the workers are still behind.
+           Frames are only shed once the spill files on disk reach `max_spill_bytes`.
+
+The seqs of the shed frames are released by the dispatcher, so the cursor moves past them.
+"""
+
+import glob
+import os
+import pickle
+import queue
+import struct
+import threading
+import time
+from collections import deque
+from typing import Deque, Iterable, List, Optional
+
+from atproto import firehose_models
+
+from firehose.metrics import metrics
+from firehose.prefilter import get_collection
+from firehose.transport import count_frames
+from lib.log import logger
+
+POLICY_BLOCK = "block"
+POLICY_SHED = "shed"
+POLICY_SPILL = "spill"
+
+_LENGTH = struct.Struct("<I")
+SEGMENT_BYTES = 64 * 1024**2
+"""Size from which a spill buffer writes to a new segment file"""
+
+_shed = metrics.counter("firehose_shed_frames_total", "Frames dropped because of a full queue")
+_spilled = metrics.counter("firehose_spilled_frames_total", "Frames spilled to the local disk")
+_drained = metrics.counter("firehose_drained_frames_total", "Spilled frames put back to the queue")
+_spill_bytes = metrics.gauge("firehose_spill_bytes", "Bytes of the spill files on the local disk")
+_blocked = metrics.histogram("firehose_blocked_seconds", "Wait for a free slot of a full queue")
+
+
+def _frames_of(item: object) -> int:
+    """Number of frames in a queue item, a raw batch or a single message"""
+    return count_frames(item) if isinstance(item, bytes) else 1
+
+
+class OverloadPolicy:
+    """Put items to the shard queues, blocking until a slot is free"""
+
+    def __init__(self, timeout: Optional[float] = None):
+        """
+        Args:
+            timeout (Optional[float]): Max seconds to wait for a slot before shedding the item.
+                Waits forever if None.
+        """
+        self.timeout = timeout
+        self.queues: List[queue.Queue] = []
+
+    def attach(self, queues: List[queue.Queue], queue_size: int) -> None:
+        """Set the shard queues, called by the dispatcher
+
+        Args:
+            queues (List[queue.Queue]): Shard queues
+            queue_size (int): Capacity of each queue
+        """
+        self.queues = queues
+
+    def start(self) -> None:
+        """Start the background work of the policy, if any"""
+
+    def admit(self, shard: int, message: firehose_models.MessageFrame) -> bool:
+        """Whether the `#commit` message should be dispatched at all
+
+        Args:
+            shard (int): Shard index of the message
+            message (firehose_models.MessageFrame): `#commit` message frame
+
+        Returns:
+            bool: False to drop the message before it is buffered
+        """
+        return True
+
+    def put(self, shard: int, item: object) -> bool:
+        """Put the item to the shard queue
+
+        Args:
+            shard (int): Shard index
+            item (object): Message frame or batch of raw frames
+
+        Returns:
+            bool: False if the item was shed
+        """
+        shard_queue = self.queues[shard]
+        try:
+            shard_queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+
+        started = time.perf_counter()
+        try:
+            shard_queue.put(item, timeout=self.timeout)
+            return True
+        except queue.Full:
+            frames = _frames_of(item)
+            _shed.inc(frames)
+            logger.warning(f"Shard {shard} is full for {self.timeout}s, shed {frames} frames")
+            return False
+        finally:
+            _blocked.observe(time.perf_counter() - started)
+
+    def empty(self) -> bool:
+        """Whether no item is held by the policy"""
+        return True
+
+
+class ShedPolicy(OverloadPolicy):
+    """Drop the frames without interested collections while the queue is above a watermark"""
+
+    def __init__(
+        self, interested: Iterable[str], high_watermark: float = 0.8, timeout: float = 5.0
+    ):
+        """
+        Args:
+            interested (Iterable[str]): Collection NSIDs which are never dropped early
+            high_watermark (float): Fill ratio of the shard queue from which to drop
+            timeout (float): Max seconds to wait for a slot for the interested frames
+        """
+        super().__init__(timeout)
+        self.interested = frozenset(interested)
+        self.high_watermark = high_watermark
+        self._limit = 0
+
+    def attach(self, queues: List[queue.Queue], queue_size: int) -> None:
+        super().attach(queues, queue_size)
+        self._limit = int(queue_size * self.high_watermark)
+
+    def admit(self, shard: int, message: firehose_models.MessageFrame) -> bool:
+        if self.queues[shard].qsize() < self._limit:
+            return True
+        for op in message.body.get("ops") or ():
+            if get_collection(op["path"]) in self.interested:
+                return True
+        _shed.inc()
+        return False
+
+
+class _Segment:
+    """Spill file, written up to `SpillBuffer.segment_bytes`"""
+
+    __slots__ = ("path", "file", "size")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "w+b")
+        self.size = 0
+
+
+class SpillBuffer:
+    """FIFO of pickled queue items in local segment files
+
+    The items are appended to the last segment, and read from the first one. A fully read
+    segment is deleted, so the files on disk only hold the items not read yet and the segment
+    being read.
+    """
+
+    def __init__(self, path: str, segment_bytes: int = SEGMENT_BYTES):
+        """
+        Args:
+            path (str): Path of the segment files, `.<index>` is appended to it
+            segment_bytes (int): Size from which a new segment is written
+        """
+        self.path = path
+        self.segment_bytes = segment_bytes
+        # the items spilled by a previous process are not drained
+        for stale in glob.glob(glob.escape(path) + ".*"):
+            os.remove(stale)
+        self._next_index = 0
+        self._segments: Deque[_Segment] = deque()
+        self._read_offset = 0
+        self._open_segment()
+
+    def _open_segment(self) -> None:
+        self._segments.append(_Segment(f"{self.path}.{self._next_index}"))
+        self._next_index += 1
+
+    @property
+    def size(self) -> int:
+        """Bytes of the items not read yet"""
+        return self.disk_size - self._read_offset
+
+    @property
+    def disk_size(self) -> int:
+        """Bytes of the segment files on disk"""
+        return sum(segment.size for segment in self._segments)
+
+    @property
+    def segments(self) -> int:
+        """Number of segment files on disk"""
+        return len(self._segments)
+
+    def append(self, item: object) -> None:
+        data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+        if self._segments[-1].size >= self.segment_bytes:
+            self._open_segment()
+        segment = self._segments[-1]
+        segment.file.seek(segment.size)
+        segment.file.write(_LENGTH.pack(len(data)))
+        segment.file.write(data)
+        segment.size = segment.file.tell()
+
+    def peek(self) -> Optional[object]:
+        """Read the oldest item without removing it"""
+        if not self.size:
+            return None
+        segment = self._segments[0]
+        segment.file.flush()
+        segment.file.seek(self._read_offset)
+        (length,) = _LENGTH.unpack(segment.file.read(_LENGTH.size))
+        return pickle.loads(segment.file.read(length))
+
+    def pop(self) -> None:
+        """Remove the oldest item, deleting its segment once it has been fully read"""
+        segment = self._segments[0]
+        segment.file.seek(self._read_offset)
+        (length,) = _LENGTH.unpack(segment.file.read(_LENGTH.size))
+        self._read_offset += _LENGTH.size + length
+        if self._read_offset < segment.size:
+            return
+        self._read_offset = 0
+        if len(self._segments) == 1:
+            segment.file.truncate(0)
+            segment.size = 0
+            return
+        self._segments.popleft()
+        segment.file.close()
+        os.remove(segment.path)
+
+
+class SpillPolicy(OverloadPolicy):
+    """Spill the items of a full queue to the local disk and drain them later"""
+
+    def __init__(
+        self,
+        spill_dir: str,
+        max_spill_bytes: int = 4 * 1024**3,
+        drain_interval: float = 0.05,
+        segment_bytes: int = SEGMENT_BYTES,
+    ):
+        """
+        Args:
+            spill_dir (str): Directory of the spill files
+            max_spill_bytes (int): Max total size of the spill files on disk, frames are shed
+                above it
+            drain_interval (float): Seconds between two checks while nothing is spilled
+            segment_bytes (int): Size of the segment files
+        """
+        super().__init__(timeout=0)
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.drain_interval = drain_interval
+        self.segment_bytes = segment_bytes
+        self._buffers: List[SpillBuffer] = []
+        self._locks: List[threading.Lock] = []
+
+    def attach(self, queues: List[queue.Queue], queue_size: int) -> None:
+        super().attach(queues, queue_size)
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self._buffers = [
+            SpillBuffer(os.path.join(self.spill_dir, f"shard-{shard}.spill"), self.segment_bytes)
+            for shard in range(len(queues))
+        ]
+        self._locks = [threading.Lock() for _ in queues]
+
+    def start(self) -> None:
+        def run() -> None:
+            while True:
+                try:
+                    drained = self.drain()
+                except Exception as e:
+                    drained = 0
+                    logger.error(f"Failed to drain the spilled frames: {e}")
+                if not drained:
+                    # poll the full queues closely, the workers free a slot within milliseconds
+                    time.sleep(self.drain_interval if self.empty() else 0.001)
+
+        threading.Thread(target=run, name="spill-drainer", daemon=True).start()
+
+    def put(self, shard: int, item: object) -> bool:
+        buffer = self._buffers[shard]
+        with self._locks[shard]:
+            # once a shard spilled, its items go through the file to keep them in order
+            if not buffer.size:
+                try:
+                    self.queues[shard].put_nowait(item)
+                    return True
+                except queue.Full:
+                    pass
+
+            frames = _frames_of(item)
+            if self.spill_size() >= self.max_spill_bytes:
+                _shed.inc(frames)
+                return False
+            if not buffer.size:
+                logger.warning(f"Shard {shard} is full, spilling to {buffer.path}")
+            buffer.append(item)
+            _spilled.inc(frames)
+            _spill_bytes.set(self.spill_size())
+            return True
+
+    def drain(self) -> int:
+        """Move the spilled items to the queues while they have free slots
+
+        Returns:
+            int: Number of drained frames
+        """
+        drained = 0
+        for shard, buffer in enumerate(self._buffers):
+            with self._locks[shard]:
+                while buffer.size:
+                    item = buffer.peek()
+                    try:
+                        self.queues[shard].put_nowait(item)
+                    except queue.Full:
+                        break
+                    buffer.pop()
+                    drained += _frames_of(item)
+        if drained:
+            _drained.inc(drained)
+            _spill_bytes.set(self.spill_size())
+        return drained
+
+    def spill_size(self) -> int:
+        """Total bytes of the spill files on disk"""
+        return sum(buffer.disk_size for buffer in self._buffers)
+
+    def empty(self) -> bool:
+        return not any(buffer.size for buffer in self._buffers)
+
+
+def get_overload_policy(
+    name: str,
+    timeout: float = 5.0,
+    interested: Iterable[str] = (),
+    spill_dir: str = "/tmp/firehose-spill",
+    max_spill_bytes: int = 4 * 1024**3,
+) -> OverloadPolicy:
+    """Get the overload policy by name
+
+    Args:
+        name (str): `block`, `shed` or `spill`
+        timeout (float): Max seconds to wait for a slot before shedding a frame
+        interested (Iterable[str]): Collection NSIDs kept by the `shed` policy
+        spill_dir (str): Directory of the spill files of the `spill` policy
+        max_spill_bytes (int): Max total size of the spill files
+
+    Returns:
+        OverloadPolicy: Overload policy
+    """
+    if name == POLICY_BLOCK:
+        return OverloadPolicy(timeout)
+    if name == POLICY_SHED:
+        return ShedPolicy(interested, timeout=timeout)
+    if name == POLICY_SPILL:
+        return SpillPolicy(spill_dir, max_spill_bytes)
+    raise ValueError(f"Unsupported overload policy: `{name}`")
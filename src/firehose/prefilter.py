@@ -0,0 +1,134 @@
+"""Collection-aware pre-filter for firehose commits
+
+Decoding the CAR blocks of a commit and building record models is the most expensive part of
+the worker loop, while the listener is only interested in a handful of collections.
+The pre-filter looks at the collection prefix of each `op.path` on the raw message body,
+so that commits which only touch likes, reposts, profiles, etc. are dropped before any decoding.
+
+Some collections (posts) are only interesting when the author is a subscriber of the bot.
+For them the commit repo is looked up in the subscriber set as well.
+"""
+
+import time
+from collections import Counter
+from typing import TYPE_CHECKING, Iterable, Optional, Union
+
+if TYPE_CHECKING:
+    from firehose.subscribers import SubscriberSet
+    from lib.registry import UserRegistry
+
+DECODED_ACTIONS = frozenset(("create", "delete"))
+"""Op actions decoded by the listener, updates are not supported yet"""
+
+
+def get_collection(path: str) -> str:
+    """Get the collection NSID from a repo op path
+
+    Args:
+        path (str): Repo op path, i.e. `app.bsky.feed.post/3kq2...`
+
+    Returns:
+        str: Collection NSID, i.e. `app.bsky.feed.post`
+    """
+    return path.split("/", 1)[0]
+
+
+class CollectionPreFilter:
+    """Pre-filter commits by the collections of their ops
+
+    Counts matched and skipped ops per collection, so that the amount of skipped work is visible.
+    """
+
+    def __init__(
+        self,
+        collections: Iterable[str],
+        report_interval: float = 60.0,
+        subscribers: Optional[Union["SubscriberSet", "UserRegistry"]] = None,
+        subscriber_only: Iterable[str] = (),
+    ):
+        """
+        Args:
+            collections (Iterable[str]): Collection NSIDs to keep
+            report_interval (float): Seconds between two stats reports
+            subscribers (Optional[Union[SubscriberSet, UserRegistry]]): Subscribed DIDs.
+                If None, the authors are not checked.
+            subscriber_only (Iterable[str]): Collections kept only for subscribed authors
+        """
+        self.collections = frozenset(collections)
+        self.report_interval = report_interval
+        self.subscribers = subscribers
+        self.subscriber_only = (
+            frozenset(subscriber_only) if subscribers is not None else frozenset()
+        )
+        self.matched = Counter()
+        """Number of ops per collection which passed the filter"""
+        self.skipped = Counter()
+        """Number of ops per collection which were dropped before decoding"""
+        self.not_subscribed = Counter()
+        """Number of ops per collection which were dropped because the author is not a subscriber"""
+        self.commits_matched = 0
+        self.commits_skipped = 0
+        self._last_report = time.monotonic()
+
+    def is_interested(self, path: str) -> bool:
+        """Whether the op path belongs to an interested collection"""
+        return get_collection(path) in self.collections
+
+    def match(self, body: dict) -> bool:
+        """Check the raw commit body and count its ops
+
+        Args:
+            body (dict): Raw body of a `#commit` message frame
+
+        Returns:
+            bool: True if at least one created or deleted op of the commit belongs to an
+                interested collection
+        """
+        matched = False
+        subscribed = None
+        for op in body.get("ops") or ():
+            collection = get_collection(op["path"])
+            if collection not in self.collections or op.get("action") not in DECODED_ACTIONS:
+                self.skipped[collection] += 1
+                continue
+            if collection in self.subscriber_only:
+                if subscribed is None:
+                    subscribed = body.get("repo") in self.subscribers
+                if not subscribed:
+                    self.not_subscribed[collection] += 1
+                    continue
+            self.matched[collection] += 1
+            matched = True
+
+        if matched:
+            self.commits_matched += 1
+        else:
+            self.commits_skipped += 1
+        return matched
+
+    def report(self) -> Optional[str]:
+        """Build a stats line once per `report_interval` and reset the counters
+
+        Returns:
+            Optional[str]: Stats line, or None if the interval has not elapsed yet
+        """
+        now = time.monotonic()
+        if now - self._last_report < self.report_interval:
+            return None
+
+        skipped = ", ".join(f"{c}={n}" for c, n in self.skipped.most_common(5))
+        matched = ", ".join(f"{c}={n}" for c, n in self.matched.most_common())
+        line = (
+            f"PRE-FILTER: commits matched={self.commits_matched} skipped={self.commits_skipped}"
+            f" | ops matched [{matched}] | ops skipped top5 [{skipped}]"
+        )
+        if self.subscribers is not None:
+            not_subscribed = ", ".join(f"{c}={n}" for c, n in self.not_subscribed.most_common())
+            line += f" | ops not subscribed [{not_subscribed}] | {self.subscribers.stats()}"
+        self.matched.clear()
+        self.skipped.clear()
+        self.not_subscribed.clear()
+        self.commits_matched = 0
+        self.commits_skipped = 0
+        self._last_report = now
+        return line
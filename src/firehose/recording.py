@@ -0,0 +1,134 @@
+"""Recordings of raw firehose frames
+
+A recording keeps the raw `MessageFrame` bytes as received from the relay, so that the listener
+pipeline can be replayed offline at full speed or at the pace of the capture.
+
+File layout:
+    b"WMFH" <uint8 version>
+    (<uint32 little-endian length><float64 little-endian seconds since the start><frame bytes>)*
+
+Recordings whose path ends with `.zst` are compressed with zstd, which needs the optional
+`zstandard` package. The frames compress well since most of them share the same keys.
+"""
+
+import io
+import random
+import struct
+import time
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from firehose.synthetic import generate_frames
+
+_MAGIC = b"WMFH\x01"
+_RECORD = struct.Struct("<Id")
+
+
+def _is_compressed(path: str) -> bool:
+    return path.endswith(".zst")
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise RuntimeError("zstandard is required for `.zst` recordings") from e
+    return zstandard
+
+
+class FrameRecorder:
+    """Append raw frames to a recording"""
+
+    def __init__(self, path: str, compression_level: int = 3):
+        """
+        Args:
+            path (str): Path of the recording, compressed with zstd if it ends with `.zst`
+            compression_level (int): zstd compression level
+        """
+        self.path = path
+        self.frames = 0
+        self._file = open(path, "wb")
+        self._out: BinaryIO = self._file
+        if _is_compressed(path):
+            compressor = _zstd().ZstdCompressor(level=compression_level)
+            self._out = compressor.stream_writer(self._file, closefd=False)
+        self._out.write(_MAGIC)
+        self._started = None
+
+    def write(self, frame: bytes, received_at: Optional[float] = None) -> None:
+        """Append a raw frame
+
+        Args:
+            frame (bytes): Raw frame
+            received_at (Optional[float]): `time.monotonic()` at the reception, now if None
+        """
+        if received_at is None:
+            received_at = time.monotonic()
+        if self._started is None:
+            self._started = received_at
+        self._out.write(_RECORD.pack(len(frame), received_at - self._started))
+        self._out.write(frame)
+        self.frames += 1
+
+    def close(self) -> None:
+        """Flush and close the recording"""
+        if self._out is not self._file:
+            self._out.close()
+        self._file.close()
+
+    def __enter__(self) -> "FrameRecorder":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def read_recording(path: str) -> Iterator[Tuple[float, bytes]]:
+    """Read the frames of a recording
+
+    Args:
+        path (str): Path of the recording
+
+    Yields:
+        Tuple[float, bytes]: Seconds since the start of the recording and raw frame
+    """
+    with open(path, "rb") as f:
+        stream: BinaryIO = f
+        if _is_compressed(path):
+            stream = io.BufferedReader(_zstd().ZstdDecompressor().stream_reader(f))
+        if stream.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f"Not a firehose recording: `{path}`")
+        while True:
+            header = stream.read(_RECORD.size)
+            if not header:
+                return
+            if len(header) < _RECORD.size:
+                raise ValueError(f"Truncated firehose recording: `{path}`")
+            length, offset = _RECORD.unpack(header)
+            frame = stream.read(length)
+            if len(frame) < length:
+                raise ValueError(f"Truncated firehose recording: `{path}`")
+            yield offset, frame
+
+
+def write_synthetic_recording(
+    path: str, count: int, rate: float = 1000.0, seed: int = 0, authors: int = 1000
+) -> int:
+    """Write a recording of synthetic frames, see `firehose.synthetic`
+
+    Args:
+        path (str): Path of the recording
+        count (int): Number of frames
+        rate (float): Average frames per second of the simulated capture
+        seed (int): Random seed, the same seed gives the same recording
+        authors (int): Number of distinct repo DIDs
+
+    Returns:
+        int: Number of written frames
+    """
+    rng = random.Random(seed)
+    received_at = 0.0
+    with FrameRecorder(path) as recorder:
+        for frame in generate_frames(count, seed=seed, authors=authors):
+            recorder.write(frame, received_at)
+            received_at += rng.expovariate(rate)
+        return recorder.frames
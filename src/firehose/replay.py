@@ -0,0 +1,226 @@
+"""Capture and replay of the firehose for offline throughput benchmarks
+
+The replay feeds a recording (see `firehose.recording`) through the same sharded workers as
+the listener (`worker_main` -> `process_message` -> `_get_ops_by_type`), as fast as possible
+or at a multiple of the pace of the capture, and reports the throughput and the stage latencies.
+
+Usage:
+    # capture the live firehose
+    PYTHONPATH=src python src/firehose/replay.py record firehose.bin.zst --frames 100000
+    # or build a synthetic recording, no network needed
+    PYTHONPATH=src python src/firehose/replay.py generate firehose.bin --frames 50000
+    # replay it, `--speed 0` is as fast as possible, `--speed 2` twice the captured pace
+    PYTHONPATH=src python src/firehose/replay.py replay firehose.bin --workers 3 --speed 0
+"""
+
+import argparse
+import logging
+import multiprocessing
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from atproto import firehose_models
+
+from firehose.dispatcher import ShardedDispatcher
+from firehose.listener import _INTERESTED_RECORDS, worker_main
+from firehose.metrics import MetricsExporter, metrics
+from firehose.overload import OverloadPolicy, get_overload_policy
+from firehose.recording import FrameRecorder, read_recording, write_synthetic_recording
+from firehose.transport import RawFrameFirehoseClient, start_flusher
+from lib.log import logger
+
+REPORTED_STAGES = ("enqueue", "filter", "parse", "dispatch")
+"""Stages reported by the replay, matching the `firehose_<stage>_seconds` histograms"""
+
+
+@dataclass
+class ReplayReport:
+    """Result of a replay"""
+
+    frames: int
+    commits: int
+    elapsed: float
+    errors: int = 0
+    shed: int = 0
+    spilled: int = 0
+    latencies: Dict[str, Dict[str, float]] = field(default_factory=dict)
+    """p50 and p99 in milliseconds per stage"""
+
+    @property
+    def frames_per_second(self) -> float:
+        return self.frames / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def commits_per_second(self) -> float:
+        return self.commits / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        lines = [
+            f"frames: {self.frames} in {self.elapsed:.2f}s, errors: {self.errors}"
+            f", shed: {self.shed}, spilled: {self.spilled}",
+            f"frames/s : {self.frames_per_second:10.0f}",
+            f"commits/s: {self.commits_per_second:10.0f}",
+        ]
+        for stage, latency in self.latencies.items():
+            lines.append(
+                f"{stage:9}: p50 {latency['p50']:8.3f}ms  p99 {latency['p99']:8.3f}ms"
+                f"  ({latency['count']} samples)"
+            )
+        return "\n".join(lines)
+
+
+def replay(
+    path: str,
+    workers: int = 1,
+    speed: float = 0.0,
+    max_queue_size: int = 10000,
+    batch_options: Optional[dict] = None,
+    overload_policy: Optional[OverloadPolicy] = None,
+) -> ReplayReport:
+    """Replay a recording through the listener workers
+
+    Args:
+        path (str): Path of the recording
+        workers (int): Number of worker processes
+        speed (float): Multiple of the captured pace, 0 for as fast as possible
+        max_queue_size (int): Total capacity of the shard queues
+        batch_options (Optional[dict]): Options of the batch transport, as in the listener.
+            The frames are sent one by one if None.
+        overload_policy (Optional[OverloadPolicy]): Policy of the full queues, as in the listener
+
+    Returns:
+        ReplayReport: Throughput and latencies
+    """
+    # skip the values recorded before, the workers inherit the registry on fork
+    metrics.snapshot(deltas=True)
+    enqueue_latency = metrics.histogram("firehose_enqueue_seconds", "Dispatch to a shard queue")
+    metrics_queue = multiprocessing.Queue()
+    dispatcher = ShardedDispatcher(
+        worker_main,
+        workers,
+        max_queue_size,
+        args=(metrics_queue,),
+        batch_options=batch_options,
+        overload_policy=overload_policy,
+    )
+    dispatcher.start()
+    if dispatcher.batchers:
+        start_flusher(dispatcher.batchers, batch_options["flush_interval"] / 2)
+
+    frames = 0
+    commits = 0
+    started = time.perf_counter()
+    for offset, raw_frame in read_recording(path):
+        if speed:
+            delay = started + offset / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        message = firehose_models.Frame.from_bytes(raw_frame)
+        frames += 1
+        if message.type == "#commit":
+            commits += 1
+        dispatched = time.perf_counter()
+        dispatcher.dispatch(message, raw_frame)
+        enqueue_latency.observe(time.perf_counter() - dispatched)
+
+    dispatcher.flush()
+    while dispatcher.safe_cursor() < dispatcher.last_seq:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - started
+    dispatcher.stop()
+
+    totals = MetricsExporter(metrics, metrics_queue).collect()
+    report = ReplayReport(frames, commits, elapsed)
+    report.errors = totals.counter("firehose_errors_total").value
+    report.shed = totals.counter("firehose_shed_frames_total").value
+    report.spilled = totals.counter("firehose_spilled_frames_total").value
+    for stage in REPORTED_STAGES:
+        histogram = totals.histograms.get(f"firehose_{stage}_seconds")
+        if histogram is None or not histogram.count:
+            continue
+        report.latencies[stage] = {
+            "p50": histogram.quantile(0.5) * 1000,
+            "p99": histogram.quantile(0.99) * 1000,
+            "count": histogram.count,
+        }
+    return report
+
+
+def record(path: str, max_frames: int, duration: Optional[float] = None) -> int:
+    """Record the live firehose
+
+    Args:
+        path (str): Path of the recording
+        max_frames (int): Stop after this number of frames
+        duration (Optional[float]): Stop after this number of seconds
+
+    Returns:
+        int: Number of recorded frames
+    """
+    client = RawFrameFirehoseClient()
+    deadline = time.monotonic() + duration if duration else None
+
+    with FrameRecorder(path) as recorder:
+
+        def on_message_handler(_: firehose_models.MessageFrame) -> None:
+            recorder.write(client.last_raw_frame)
+            if recorder.frames >= max_frames or (deadline and time.monotonic() >= deadline):
+                client.stop()
+
+        client.start(on_message_handler)
+        return recorder.frames
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="record the live firehose")
+    record_parser.add_argument("path")
+    record_parser.add_argument("--frames", type=int, default=100000)
+    record_parser.add_argument("--seconds", type=float)
+    generate_parser = commands.add_parser("generate", help="write a synthetic recording")
+    generate_parser.add_argument("path")
+    generate_parser.add_argument("--frames", type=int, default=50000)
+    generate_parser.add_argument("--rate", type=float, default=1000.0)
+    generate_parser.add_argument("--seed", type=int, default=0)
+    replay_parser = commands.add_parser("replay", help="replay a recording")
+    replay_parser.add_argument("path")
+    replay_parser.add_argument("--workers", type=int, default=1)
+    replay_parser.add_argument("--speed", type=float, default=0.0)
+    replay_parser.add_argument("--transport", choices=("batch", "frame"), default="batch")
+    replay_parser.add_argument("--overload", choices=("block", "shed", "spill"), default="block")
+    replay_parser.add_argument("--queue-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        recorded = record(args.path, args.frames, args.seconds)
+        logger.info(f"Recorded {recorded} frames to {args.path}")
+    elif args.command == "generate":
+        written = write_synthetic_recording(args.path, args.frames, args.rate, args.seed)
+        logger.info(f"Wrote {written} synthetic frames to {args.path}")
+    else:
+        # the handlers would measure the console otherwise
+        logger.setLevel(logging.WARNING)
+        batch_options = None
+        if args.transport == "batch":
+            batch_options = {"max_frames": 200, "max_bytes": 1024 * 1024, "flush_interval": 0.05}
+        overload_policy = get_overload_policy(
+            args.overload,
+            interested=_INTERESTED_RECORDS,
+            spill_dir=tempfile.mkdtemp(prefix="firehose-spill-"),
+        )
+        report = replay(
+            args.path,
+            args.workers,
+            args.speed,
+            args.queue_size,
+            batch_options=batch_options,
+            overload_policy=overload_policy,
+        )
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""In-memory set of the subscribed DIDs with hot reload
+
+The bot only handles the posts of the users who completed the signup. Their DIDs are kept
+in a snapshot object in the userinfo bucket, one DID per line. The listener holds them in a
+frozenset, checked on `commit.repo` before any decoding, and polls the snapshot with a conditional
+GET (ETag), so that new signups take effect within seconds without restarting the task.
+
+The snapshot is selected by `FIREHOSE_SUBSCRIBERS_URL`:
+    file:///path/to/dids.txt
+    s3://bucket/subscribers/dids.txt
+"""
+
+import os
+import threading
+import time
+from typing import Optional, Tuple
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+from lib.log import logger
+
+
+class SnapshotSource:
+    """Base class of the snapshot sources"""
+
+    def fetch(self, etag: Optional[str]) -> Optional[Tuple[bytes, str]]:
+        """Fetch the snapshot if it changed
+
+        Args:
+            etag (Optional[str]): ETag of the snapshot held by the caller
+
+        Returns:
+            Optional[Tuple[bytes, str]]: Content and ETag of the snapshot, or None if unchanged
+        """
+        raise NotImplementedError
+
+
+class FileSnapshotSource(SnapshotSource):
+    """Snapshot in a local file, its mtime and size are used as the ETag"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def fetch(self, etag: Optional[str]) -> Optional[Tuple[bytes, str]]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        current = f"{stat.st_mtime_ns}-{stat.st_size}"
+        if current == etag:
+            return None
+        with open(self.path, "rb") as f:
+            return f.read(), current
+
+
+class S3SnapshotSource(SnapshotSource):
+    """Snapshot as an S3 object, fetched with `If-None-Match`"""
+
+    def __init__(self, bucket: str, key: str):
+        self.bucket = bucket
+        self.key = key
+        self._s3 = boto3.client("s3")
+
+    def fetch(self, etag: Optional[str]) -> Optional[Tuple[bytes, str]]:
+        params = {"Bucket": self.bucket, "Key": self.key}
+        if etag:
+            params["IfNoneMatch"] = etag
+        try:
+            response = self._s3.get_object(**params)
+        except ClientError as e:
+            status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+            if status == 304 or e.response["Error"]["Code"] in ("304", "NoSuchKey"):
+                return None
+            raise
+        return response["Body"].read(), response["ETag"]
+
+
+def get_snapshot_source(url: str) -> SnapshotSource:
+    """Get the snapshot source for the URL
+
+    Args:
+        url (str): `file://<path>` or `s3://<bucket>/<key>`
+
+    Returns:
+        SnapshotSource: Snapshot source
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "s3":
+        return S3SnapshotSource(parsed.netloc, parsed.path.lstrip("/"))
+    if parsed.scheme in ("file", ""):
+        return FileSnapshotSource(parsed.netloc + parsed.path)
+    raise ValueError(f"Unsupported subscribers snapshot: `{url}`")
+
+
+class SubscriberSet:
+    """Set of the subscribed DIDs, reloaded in a background thread"""
+
+    def __init__(self, source: SnapshotSource, reload_interval: float = 5.0):
+        """
+        Args:
+            source (SnapshotSource): Source of the snapshot
+            reload_interval (float): Seconds between two checks of the snapshot
+        """
+        self.source = source
+        self.reload_interval = reload_interval
+        self._dids = frozenset()
+        self._etag = None
+        self.lookups = 0
+        self.hits = 0
+        self.reload_latency_ms = 0.0
+        """Latency of the last reload which fetched a new snapshot"""
+
+    def __contains__(self, did: str) -> bool:
+        self.lookups += 1
+        if did in self._dids:
+            self.hits += 1
+            return True
+        return False
+
+    def __len__(self) -> int:
+        return len(self._dids)
+
+    def reload(self) -> bool:
+        """Reload the snapshot if it changed
+
+        Returns:
+            bool: True if a new snapshot was loaded
+        """
+        started = time.perf_counter()
+        fetched = self.source.fetch(self._etag)
+        if fetched is None:
+            return False
+        content, etag = fetched
+        dids = frozenset(line.strip() for line in content.decode().splitlines() if line.strip())
+        # replacing the reference is atomic, readers never see a partially built set
+        self._dids = dids
+        self._etag = etag
+        self.reload_latency_ms = (time.perf_counter() - started) * 1000
+        logger.info(
+            f"Loaded {len(dids)} subscribers in {self.reload_latency_ms:.1f}ms (etag={etag})"
+        )
+        return True
+
+    def start(self) -> threading.Thread:
+        """Load the snapshot and start the reload thread
+
+        Call it in the process which uses the set, threads do not survive a fork.
+
+        Returns:
+            threading.Thread: Started thread
+        """
+        self.reload()
+
+        def run() -> None:
+            while True:
+                time.sleep(self.reload_interval)
+                try:
+                    self.reload()
+                except Exception as e:
+                    logger.error(f"Failed to reload the subscribers: {e}")
+
+        thread = threading.Thread(target=run, name="subscribers-reloader", daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self) -> str:
+        """Build a stats line and reset the lookup counters"""
+        ratio = self.hits / self.lookups if self.lookups else 0.0
+        line = (
+            f"subscribers={len(self._dids)} lookups={self.lookups} hit_ratio={ratio:.4f}"
+            f" last_reload={self.reload_latency_ms:.1f}ms"
+        )
+        self.lookups = 0
+        self.hits = 0
+        return line
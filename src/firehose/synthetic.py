@@ -0,0 +1,177 @@
+"""Synthetic firehose frames
+
+Builds raw `com.atproto.sync.subscribeRepos` frames with a realistic mix of collections,
+so that the listener pipeline can be benchmarked without a connection to the relay.
+"""
+
+import hashlib
+import random
+from typing import Iterator, Optional
+
+import libipld
+
+_HEADER = libipld.encode_dag_cbor({"op": 1, "t": "#commit"})
+
+COLLECTION_WEIGHTS = {
+    "app.bsky.feed.like": 50,
+    "app.bsky.feed.repost": 12,
+    "app.bsky.graph.follow": 12,
+    "app.bsky.feed.post": 20,
+    "app.bsky.actor.profile": 3,
+    "app.bsky.graph.block": 3,
+}
+"""Approximate share of each collection on the network"""
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _cid(data: bytes) -> bytes:
+    """CIDv1, dag-cbor, sha2-256"""
+    return b"\x01\x71\x12\x20" + hashlib.sha256(data).digest()
+
+
+def build_car(blocks: list) -> bytes:
+    """Build a CAR v1 file, the first block being the root
+
+    Args:
+        blocks (list): Pairs of (CID bytes, block bytes)
+
+    Returns:
+        bytes: CAR file
+    """
+    root = blocks[0][0]
+    # {"roots": [CID link], "version": 1}, keys in dag-cbor canonical order
+    header = b"\xa2\x65roots\x81\xd8\x2a\x58\x25\x00" + root + b"\x67version\x01"
+    parts = [_varint(len(header)), header]
+    for cid, data in blocks:
+        parts.append(_varint(len(cid) + len(data)))
+        parts.append(cid)
+        parts.append(data)
+    return b"".join(parts)
+
+
+def build_record(collection: str, rng: random.Random, created_at: str) -> dict:
+    """Build a record of the collection with random content"""
+    subject_did = f"did:plc:{rng.getrandbits(100):025x}"
+    if collection == "app.bsky.feed.post":
+        record = {
+            "$type": collection,
+            "text": " ".join(
+                rng.choice(("hello", "bluesky", "art", "wip", "🎨")) for _ in range(12)
+            ),
+            "langs": ["ja"],
+            "createdAt": created_at,
+        }
+        if rng.random() < 0.3:
+            record["embed"] = {
+                "$type": "app.bsky.embed.images",
+                "images": [
+                    {
+                        "alt": "illustration",
+                        "image": {
+                            "$type": "blob",
+                            "ref": libipld.encode_cid(_cid(rng.randbytes(16))),
+                            "mimeType": "image/jpeg",
+                            "size": rng.randint(100_000, 1_000_000),
+                        },
+                        "aspectRatio": {"width": 1000, "height": 1414},
+                    }
+                    for _ in range(rng.randint(1, 4))
+                ],
+            }
+        return record
+    if collection == "app.bsky.graph.follow" or collection == "app.bsky.graph.block":
+        return {"$type": collection, "subject": subject_did, "createdAt": created_at}
+    if collection == "app.bsky.actor.profile":
+        return {"$type": collection, "displayName": "someone", "description": "hello " * 20}
+    subject = {
+        "uri": f"at://{subject_did}/app.bsky.feed.post/{rng.getrandbits(60):013x}",
+        "cid": libipld.encode_cid(_cid(rng.randbytes(16))),
+    }
+    return {"$type": collection, "subject": subject, "createdAt": created_at}
+
+
+def build_commit_frame(
+    seq: int,
+    repo: str,
+    collection: str,
+    record: Optional[dict] = None,
+    action: str = "create",
+    rkey: Optional[str] = None,
+    time: str = "2025-01-01T00:00:00.000Z",
+) -> bytes:
+    """Build a raw `#commit` frame with one op
+
+    Args:
+        seq (int): Seq of the event
+        repo (str): Repo DID
+        collection (str): Collection NSID
+        record (Optional[dict]): Record, required for the `create` action
+        action (str): `create` or `delete`
+        rkey (Optional[str]): Record key, derived from the seq by default
+        time (str): Commit time
+
+    Returns:
+        bytes: Raw frame
+    """
+    rkey = rkey or f"{seq:013x}"
+    commit = libipld.encode_dag_cbor({"did": repo, "rev": rkey, "version": 3})
+    blocks = [(_cid(commit), commit)]
+    op = {"action": action, "path": f"{collection}/{rkey}", "cid": None}
+    if action == "create":
+        data = libipld.encode_dag_cbor(record)
+        cid = _cid(data)
+        blocks.append((cid, data))
+        op["cid"] = libipld.encode_cid(cid)
+
+    body = {
+        "seq": seq,
+        "repo": repo,
+        "rev": rkey,
+        "since": None,
+        "commit": libipld.encode_cid(blocks[0][0]),
+        "ops": [op],
+        "blocks": build_car(blocks),
+        "blobs": [],
+        "rebase": False,
+        "tooBig": False,
+        "time": time,
+    }
+    return _HEADER + libipld.encode_dag_cbor(body)
+
+
+def generate_frames(
+    count: int, seed: int = 0, start_seq: int = 1, authors: int = 1000
+) -> Iterator[bytes]:
+    """Generate raw commit frames with the collection mix of `COLLECTION_WEIGHTS`
+
+    Args:
+        count (int): Number of frames
+        seed (int): Random seed, the same seed gives the same frames
+        start_seq (int): Seq of the first frame
+        authors (int): Number of distinct repo DIDs
+
+    Yields:
+        bytes: Raw frame
+    """
+    rng = random.Random(seed)
+    collections = list(COLLECTION_WEIGHTS)
+    weights = list(COLLECTION_WEIGHTS.values())
+    for seq in range(start_seq, start_seq + count):
+        collection = rng.choices(collections, weights)[0]
+        repo = f"did:plc:{rng.randrange(authors):024d}"
+        if rng.random() < 0.05:
+            yield build_commit_frame(seq, repo, collection, action="delete")
+            continue
+        record = build_record(collection, rng, "2025-01-01T00:00:00.000Z")
+        yield build_commit_frame(seq, repo, collection, record)
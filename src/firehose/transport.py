@@ -0,0 +1,199 @@
+"""Batched frame transport between the websocket thread and the workers
+
+Putting every `MessageFrame` on a `multiprocessing.Queue` pickles the whole decoded frame
+and pays one pipe write plus one lock per message. In the batch transport mode the raw frame
+bytes are buffered per shard and sent as a single length-prefixed batch, bounded by frame count,
+size and age. The workers decode the frames on their side.
+
+Batch layout: `<uint32 little-endian length><frame bytes>` repeated.
+"""
+
+import struct
+import threading
+import time
+from typing import Callable, Iterator, List
+
+from atproto import FirehoseSubscribeReposClient
+
+_LENGTH = struct.Struct("<I")
+
+TRANSPORT_FRAME = "frame"
+"""Put every decoded `MessageFrame` to the queue"""
+TRANSPORT_BATCH = "batch"
+"""Put length-prefixed batches of raw frame bytes to the queue"""
+
+
+def pack_frames(frames: List[bytes]) -> bytes:
+    """Pack raw frames into one length-prefixed batch
+
+    Args:
+        frames (List[bytes]): Raw frames
+
+    Returns:
+        bytes: Batch
+    """
+    parts = []
+    for frame in frames:
+        parts.append(_LENGTH.pack(len(frame)))
+        parts.append(frame)
+    return b"".join(parts)
+
+
+def unpack_frames(batch: bytes) -> Iterator[bytes]:
+    """Iterate over the raw frames of a batch
+
+    Args:
+        batch (bytes): Batch built by `pack_frames`
+
+    Yields:
+        bytes: Raw frame. The CBOR decoder only accepts `bytes`, so each frame is sliced out.
+    """
+    offset = 0
+    while offset < len(batch):
+        (length,) = _LENGTH.unpack_from(batch, offset)
+        offset += _LENGTH.size
+        yield batch[offset : offset + length]
+        offset += length
+
+
+def count_frames(batch: bytes) -> int:
+    """Count the frames of a batch without slicing them out
+
+    Args:
+        batch (bytes): Batch built by `pack_frames`
+
+    Returns:
+        int: Number of frames
+    """
+    count = 0
+    offset = 0
+    while offset < len(batch):
+        (length,) = _LENGTH.unpack_from(batch, offset)
+        offset += _LENGTH.size + length
+        count += 1
+    return count
+
+
+class FrameBatcher:
+    """Buffer raw frames and hand them over as batches
+
+    A batch is flushed when it reaches `max_frames` or `max_bytes`, or when its oldest frame
+    is older than `flush_interval` seconds. `flush_if_due` is expected to be called periodically
+    (see `start_flusher`) so that frames do not wait for the next message on a quiet stream.
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[bytes, List[int]], None],
+        max_frames: int = 200,
+        max_bytes: int = 1024 * 1024,
+        flush_interval: float = 0.05,
+    ):
+        """
+        Args:
+            flush (Callable[[bytes, List[int]], None]): Called with each packed batch
+                and the seqs of its frames
+            max_frames (int): Max number of frames in a batch
+            max_bytes (int): Max total size of the frames in a batch
+            flush_interval (float): Max age in seconds of a buffered frame
+        """
+        self._flush = flush
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self._frames = []
+        self._seqs = []
+        self._size = 0
+        self._first_added = 0.0
+        self._lock = threading.RLock()
+
+    def add(self, frame: bytes, seq: int = 0) -> None:
+        """Buffer a raw frame, flushing the batch if it is full
+
+        Args:
+            frame (bytes): Raw frame
+            seq (int): Seq of the frame
+        """
+        with self._lock:
+            if not self._frames:
+                self._first_added = time.monotonic()
+            self._frames.append(frame)
+            self._seqs.append(seq)
+            self._size += len(frame)
+            if len(self._frames) >= self.max_frames or self._size >= self.max_bytes:
+                self._flush_locked()
+
+    def flush_if_due(self) -> None:
+        """Flush the batch if its oldest frame exceeded `flush_interval`"""
+        with self._lock:
+            if self._frames and time.monotonic() - self._first_added >= self.flush_interval:
+                self._flush_locked()
+
+    def flush(self) -> None:
+        """Flush the batch regardless of its size and age"""
+        with self._lock:
+            if self._frames:
+                self._flush_locked()
+
+    def _flush_locked(self) -> None:
+        batch = pack_frames(self._frames)
+        seqs = self._seqs
+        self._frames = []
+        self._seqs = []
+        self._size = 0
+        self._flush(batch, seqs)
+
+
+def start_flusher(batchers: List[FrameBatcher], interval: float) -> threading.Thread:
+    """Start a daemon thread that flushes the due batches every `interval` seconds
+
+    Args:
+        batchers (List[FrameBatcher]): Batchers to flush
+        interval (float): Seconds between two checks
+
+    Returns:
+        threading.Thread: Started thread
+    """
+
+    def run() -> None:
+        while True:
+            time.sleep(interval)
+            for batcher in batchers:
+                batcher.flush_if_due()
+
+    thread = threading.Thread(target=run, name="frame-batch-flusher", daemon=True)
+    thread.start()
+    return thread
+
+
+class _RawFrameRecorder:
+    """Websocket connection proxy which keeps the last received raw frame on the client"""
+
+    def __init__(self, connection, client: "RawFrameFirehoseClient"):
+        self._connection = connection
+        self._client = client
+
+    def __enter__(self) -> "_RawFrameRecorder":
+        self._connection.__enter__()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        return self._connection.__exit__(*exc_info)
+
+    def recv(self, timeout=None):
+        raw_frame = self._connection.recv(timeout)
+        self._client.last_raw_frame = raw_frame
+        return raw_frame
+
+
+class RawFrameFirehoseClient(FirehoseSubscribeReposClient):
+    """Firehose client exposing the raw bytes of the frame being processed
+
+    The message callback is invoked synchronously right after `recv`, so inside the callback
+    `last_raw_frame` holds the bytes of the frame passed to it.
+    """
+
+    last_raw_frame: bytes = b""
+
+    def _get_client(self):
+        return _RawFrameRecorder(super()._get_client(), self)
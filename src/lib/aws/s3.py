@@ -0,0 +1,18 @@
+from functools import lru_cache
+
+import boto3
+from botocore.config import Config
+
+from lib.http import POOL_SIZE
+
+
+@lru_cache(maxsize=None)
+def get_s3_client():
+    """Get the S3 client shared by the invocations of the container
+
+    boto3 clients are thread safe, the pool is sized for the concurrent image transfers.
+
+    Returns:
+        S3 client
+    """
+    return boto3.client("s3", config=Config(max_pool_connections=POOL_SIZE))
@@ -1,5 +1,6 @@
 import json
 import os
+from functools import lru_cache
 from typing import Any, Optional
 
 from boto3.session import Session
@@ -16,6 +17,12 @@ class SecretNameIsEmptyError(BaseException):
     """"""
 
 
+@lru_cache(maxsize=None)
+def get_client(region_name: str):
+    """Get the Secrets Manager client of the region, reused by the warm container"""
+    return Session().client(service_name="secretsmanager", region_name=region_name)
+
+
 def get_secret(secret_name: Optional[str] = None) -> Any:
     """Get Secrets from AWS KMS
 
@@ -30,9 +37,7 @@ def get_secret(secret_name: Optional[str] = None) -> Any:
     logger.debug(f"Getting secret_name: `{sn}`")
     region_name = os.getenv("AWS_REGION_NAME", default="ap-northeast-1")
 
-    # Create a Secrets Manager client
-    session = Session()
-    client = session.client(service_name="secretsmanager", region_name=region_name)
+    client = get_client(region_name)
 
     # In this sample we only handle the specific exceptions for the 'GetSecretValue' API.
     # See https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
@@ -0,0 +1,38 @@
+import json
+from functools import lru_cache
+from typing import List, Optional
+
+import boto3
+
+
+@lru_cache(maxsize=None)
+def get_sfn_client():
+    """Get the Step Functions client shared by the invocations of the container"""
+    return boto3.client("stepfunctions")
+
+
+def start_batches(
+    state_machine_arn: str, items: List[dict], batch_size: int, wait_seconds: int = 0
+) -> Optional[str]:
+    """Start one execution of a flow with the items split into batches
+
+    The Map state of the flow iterates the batches, one invocation and login per batch instead
+    of per user.
+
+    Args:
+        state_machine_arn (str): ARN of the state machine
+        items (List[dict]): Items of the flow
+        batch_size (int): Items per batch
+        wait_seconds (int): Seconds the state machine waits before processing the items
+
+    Returns:
+        Optional[str]: ARN of the execution, None if there is no item
+    """
+    batches = [{"items": items[i : i + batch_size]} for i in range(0, len(items), batch_size)]
+    if not batches:
+        return None
+    execution = get_sfn_client().start_execution(
+        stateMachineArn=state_machine_arn,
+        input=json.dumps({"items": batches, "waitSeconds": wait_seconds}),
+    )
+    return execution["executionArn"]
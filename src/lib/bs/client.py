@@ -1,32 +1,105 @@
+import os
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
 from atproto import Client
 
+from lib.bs.session import SessionManager, SessionStore, get_session_store, is_session_refused
+from lib.log import get_logger
+
+logger = get_logger(__name__)
+
+_managers: Dict[str, SessionManager] = {}
+"""Session managers by account, kept across the warm invocations of the container"""
+
 
-def get_client(identifier:str, password:str)->Client:
+def get_session_manager(identifier:str, password:str, store:Optional[SessionStore]=None)->SessionManager:
+    '''Get the session manager of an account
+
+    Args:
+        identifier (str): Bluesky User Handle
+        password (str): Bluesky User App Password
+        store (Optional[SessionStore]): Store of the session shared by the containers
+
+    Returns:
+        SessionManager: Session manager, one per account and container
+    '''
+    manager = _managers.get(identifier)
+    if manager is None:
+        manager = _managers[identifier] = SessionManager(identifier, password, store)
+    elif manager.store is None:
+        manager.store = store
+    return manager
+
+
+def get_client(identifier:str, password:str, store:Optional[SessionStore]=None)->Client:
     '''Login to the Bsky app
 
+    The session is reused while it is valid, logging in only when needed.
+
     Args:
         identifier (str): Bluesky User Handle
         password (str): Bluesky User App Password
+        store (Optional[SessionStore]): Store of the session shared by the containers
 
     Returns:
         atproto.Client: Atproto client object
     SeeAlso:
         https://docs.bsky.app/docs/api/com-atproto-server-create-session
     '''
-    client = Client()
-    client.login(identifier, password)
-    return client
+    return get_session_manager(identifier, password, store).get_client()
 
-def get_dm_client(identifier:str, password:str)->Client:
+def get_dm_client(identifier:str, password:str, store:Optional[SessionStore]=None)->Client:
     '''Login to the Bsky app
 
+    The proxied client shares the session of `get_client`, without logging in again.
+
     Args:
         identifier (str): Bluesky User Handle
         password (str): Bluesky User App Password
+        store (Optional[SessionStore]): Store of the session shared by the containers
 
     Returns:
         atproto.Client: Atproto client object
     SeeAlso:
         https://docs.bsky.app/docs/api/com-atproto-server-create-session
     '''
-    return get_client(identifier, password).with_bsky_chat_proxy()
+    return get_client(identifier, password, store).with_bsky_chat_proxy()
+
+def get_bot_client()->Client:
+    '''Get the client of the bot account, reusing its session across invocations
+
+    The session is stored at `BSKY_SESSION_URL`, encrypted with the Fernet key of the settings.
+
+    Returns:
+        atproto.Client: Atproto client object
+    '''
+    from settings import settings
+
+    store = get_session_store(os.getenv('BSKY_SESSION_URL'), settings.FERNET_KEY)
+    return get_client(settings.BOT_USERID, settings.BOT_APP_PASSWORD, store)
+
+
+def invalidate_bot_client()->None:
+    '''Drop the client of the bot, the next `get_bot_client` importing or creating a session'''
+    from settings import settings
+
+    manager = _managers.get(settings.BOT_USERID)
+    if manager is not None:
+        manager.invalidate()
+
+
+@contextmanager
+def drop_refused_session()->Iterator[None]:
+    '''Drop the client of the bot when a request of the block is refused for its session
+
+    Without it, a warm container whose session was revoked keeps returning the dead client until
+    its refresh token expires. The error is raised again, the next invocation logging in.
+    '''
+    try:
+        yield
+    except Exception as e:
+        if is_session_refused(e):
+            logger.info(f"Session of the bot refused, dropping the client: {e}")
+            invalidate_bot_client()
+        raise
@@ -1,14 +1,258 @@
-from atproto import IdResolver
+"""Direct messages of the bot
+
+`get_unread_dms` walks every conversation, which costs as many requests as there are users.
+The executors poll the chat log (`chat.bsky.convo.getLog`) instead: it lists the events of all
+the conversations after a cursor, so a run reads only what happened since the previous one.
+The cursor of each reader is persisted and saved only once the run handed off its messages,
+the messages of a failed run being read again.
+
+Stores, selected by the `DM_CURSOR_URL` of the executor:
+    s3://bucket/dms/signup-cursor    S3 object
+"""
+
+import os
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import List, Optional
+from urllib.parse import urlparse
+
+import boto3
+from atproto import Client, models
+from botocore.exceptions import ClientError
+
+from lib.bs.resolver import get_resolver
+from lib.log import get_logger
+
+logger = get_logger(__name__)
+
+MAX_PAGES = int(os.getenv("DM_MAX_PAGES", 10))
+"""Pages of the chat log read per run, the rest is read by the next runs"""
+
+SIGNUP = "signup"
+SIGNOUT = "signout"
+
+COMMANDS = {
+    SIGNUP: ("signup", "sign up", "登録"),
+    SIGNOUT: ("signout", "sign out", "解除"),
+}
+"""Words of each command, a message is a command when it starts with one of them"""
+
+
+def get_command(text: str) -> Optional[str]:
+    """Get the command of a message
+
+    Args:
+        text (str): Text of the message
+
+    Returns:
+        Optional[str]: `SIGNUP` or `SIGNOUT`, None if the message is not a command
+    """
+    normalized = re.sub(r"\s+", " ", text).strip().lower()
+    for command, words in COMMANDS.items():
+        for word in words:
+            if normalized == word or normalized.startswith(f"{word} "):
+                return command
+    return None
+
+
+def get_argument(text: str) -> Optional[str]:
+    """Get the text following the command word of a message, e.g. the watermark text of a signup
+
+    Args:
+        text (str): Text of the message
+
+    Returns:
+        Optional[str]: Text after the command word, None if there is none
+    """
+    normalized = re.sub(r"\s+", " ", text).strip()
+    lowered = normalized.lower()
+    for words in COMMANDS.values():
+        for word in words:
+            if lowered.startswith(f"{word} "):
+                return normalized[len(word) + 1 :].strip() or None
+    return None
+
+
+class CursorStore:
+    """Base class of the stores of the chat log cursors"""
+
+    def load(self) -> Optional[str]:
+        """Load the cursor, None if none is stored"""
+        raise NotImplementedError
+
+    def save(self, cursor: str) -> None:
+        """Save the cursor"""
+        raise NotImplementedError
+
+
+class S3CursorStore(CursorStore):
+    """Cursor in an S3 object"""
+
+    def __init__(self, bucket: str, key: str):
+        self.bucket = bucket
+        self.key = key
+        self._s3 = boto3.client("s3")
+
+    def load(self) -> Optional[str]:
+        try:
+            body = self._s3.get_object(Bucket=self.bucket, Key=self.key)["Body"].read()
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return body.decode().strip() or None
+
+    def save(self, cursor: str) -> None:
+        self._s3.put_object(Bucket=self.bucket, Key=self.key, Body=cursor.encode())
+
+
+@lru_cache(maxsize=None)
+def get_cursor_store(url: str) -> CursorStore:
+    """Get the cursor store
+
+    Args:
+        url (str): `s3://<bucket>/<key>`
+
+    Returns:
+        CursorStore: Cursor store, the same one for the same URL
+    """
+    parsed = urlparse(url or "")
+    if parsed.scheme == "s3":
+        return S3CursorStore(parsed.netloc, parsed.path.lstrip("/"))
+    raise ValueError(f"Unsupported cursor store: `{url}`")
+
+
+@dataclass
+class DmMessage:
+    """Message received by the bot"""
+
+    convo_id: str
+    message_id: str
+    sender_did: str
+    text: str
+    sent_at: str
+
+    def to_item(self, command: str) -> dict:
+        """Item of the `items` array of the state machines"""
+        return {
+            "command": command,
+            "convo_id": self.convo_id,
+            "message_id": self.message_id,
+            "did": self.sender_did,
+            "text": self.text,
+            "sent_at": self.sent_at,
+        }
+
+
+@dataclass
+class DmLog:
+    """Messages read from the chat log in a run"""
+
+    messages: List[DmMessage] = field(default_factory=list)
+    cursor: Optional[str] = None
+    """Cursor after the last read event, to save once the messages are handed off"""
+    scanned: int = 0
+    """Events of the chat log read, of any kind"""
+    pages: int = 0
+    complete: bool = True
+    """False when `MAX_PAGES` was reached before the end of the log"""
+
+    def stats(self) -> dict:
+        """Stats reported in the handler responses"""
+        return {
+            "scanned": self.scanned,
+            "messages": len(self.messages),
+            "pages": self.pages,
+            "complete": self.complete,
+        }
+
+
+def read_dm_log(
+    dm_client: Client, cursor: Optional[str], self_did: str, max_pages: int = MAX_PAGES
+) -> DmLog:
+    """Read the messages sent to the bot after the cursor
+
+    Args:
+        dm_client (Client): Client proxied to the chat service
+        cursor (Optional[str]): Cursor of the previous run, None to read from the start of
+            the log
+        self_did (str): DID of the bot, whose own messages are skipped
+        max_pages (int): Max pages to read
+
+    Returns:
+        DmLog: Messages and the cursor to resume from
+    """
+    log = DmLog(cursor=cursor)
+    while log.pages < max_pages:
+        response = dm_client.chat.bsky.convo.get_log(
+            models.ChatBskyConvoGetLog.Params(cursor=log.cursor)
+        )
+        log.pages += 1
+        log.scanned += len(response.logs)
+        for event in response.logs:
+            if not isinstance(event, models.ChatBskyConvoDefs.LogCreateMessage):
+                continue
+            message = event.message
+            # deleted messages have no text
+            if not isinstance(message, models.ChatBskyConvoDefs.MessageView):
+                continue
+            if message.sender.did == self_did:
+                continue
+            log.messages.append(
+                DmMessage(
+                    event.convo_id, message.id, message.sender.did, message.text, message.sent_at
+                )
+            )
+        if not response.logs or not response.cursor or response.cursor == log.cursor:
+            return log
+        log.cursor = response.cursor
+    log.complete = False
+    return log
+
+
+class DmLogReader:
+    """Reader of the chat log resuming from its persisted cursor"""
+
+    def __init__(self, store: CursorStore, max_pages: int = MAX_PAGES):
+        """
+        Args:
+            store (CursorStore): Store of the cursor of this reader
+            max_pages (int): Max pages read per run
+        """
+        self.store = store
+        self.max_pages = max_pages
+
+    def read(self, dm_client: Client, self_did: str) -> DmLog:
+        """Read the messages since the last committed run
+
+        Args:
+            dm_client (Client): Client proxied to the chat service
+            self_did (str): DID of the bot
+
+        Returns:
+            DmLog: Messages, to pass to `commit` once handed off
+        """
+        return read_dm_log(dm_client, self.store.load(), self_did, self.max_pages)
+
+    def commit(self, log: DmLog) -> None:
+        """Save the cursor after the messages of the log
+
+        Args:
+            log (DmLog): Log returned by `read`
+        """
+        if log.cursor:
+            self.store.save(log.cursor)
 
 
 def get_unread_dms(client) -> None:
-    '''未読のDMを取得する
+    """未読のDMを取得する
 
     Args:
         client (_type_): _description_
     See:
         https://atproto.blue/en/latest/dm.html
-    '''
+    """
 
     # create client proxied to Bluesky Chat service
     dm_client = client.with_bsky_chat_proxy()
@@ -16,12 +260,12 @@ def get_unread_dms(client) -> None:
     dm = dm_client.chat.bsky.convo
 
     convo_list = dm.list_convos()  # use limit and cursor to paginate
-    print(f'Your conversations ({len(convo_list.convos)}):')
+    print(f"Your conversations ({len(convo_list.convos)}):")
     for convo in convo_list.convos:
-        members = ', '.join(member.display_name for member in convo.members)
-        print(f'- ID: {convo.id} ({members})')
+        members = ", ".join(member.display_name for member in convo.members)
+        print(f"- ID: {convo.id} ({members})")
 
-    # create resolver instance with in-memory cache
-    id_resolver = IdResolver()
+    # the resolver cache is shared by the invocations of the container
+    resolver = get_resolver(os.getenv("RESOLVER_CACHE_URL"))
     # resolve DID
-    id_resolver.handle.resolve('test.marshal.dev')
+    resolver.resolve_handle("test.marshal.dev")
@@ -0,0 +1,109 @@
+"""Handlers of the signup and signout flows
+
+The two flows only differ by their command and by the message sent to the users. Their
+executors and notifiers are thin wrappers of `execute` and `notify`.
+"""
+
+import os
+import time
+from typing import List
+
+from lib.aws.step_functions import start_batches
+from lib.bs.client import drop_refused_session, get_bot_client
+from lib.bs.dms import DmLogReader, get_command, get_cursor_store
+from lib.bs.notifier import SENT, DmNotifier, convo_cache, count_statuses
+from lib.log import get_logger
+
+logger = get_logger(__name__)
+
+WAIT_SECONDS = int(os.getenv("WAIT_SECONDS", 0))
+"""Seconds the state machine waits before processing the items"""
+BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", 25))
+"""Commands handled per getter and notifier invocation"""
+NOTIFY_FAILED = "Failed to notify"
+"""Start of the log line of the users not notified, matched by the alarm of the flow stacks"""
+
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def execute(command: str, state_machine_arn: str, cursor_url: str) -> dict:
+    """Start a flow with the commands among the DMs received since the previous run
+
+    Messages scanned per run track the new activity, not the user count.
+
+    Args:
+        command (str): `SIGNUP` or `SIGNOUT`
+        state_machine_arn (str): ARN of the state machine of the flow
+        cursor_url (str): URL of the chat log cursor of the flow, see `get_cursor_store`
+
+    Returns:
+        dict: Response of the executor
+    """
+    started = time.perf_counter()
+    reader = DmLogReader(get_cursor_store(cursor_url))
+    with drop_refused_session():
+        client = get_bot_client()
+        log = reader.read(client.with_bsky_chat_proxy(), client.me.did)
+    items = [m.to_item(command) for m in log.messages if get_command(m.text) == command]
+
+    execution_arn = start_batches(state_machine_arn, items, BATCH_SIZE, WAIT_SECONDS)
+    # the cursor moves only once the items are handed off, a failed run reads them again
+    reader.commit(log)
+
+    elapsed_ms = _elapsed_ms(started)
+    logger.info(
+        f"Scanned {log.scanned} chat log events in {log.pages} pages, "
+        f"{len(log.messages)} messages, {len(items)} {command} commands in {elapsed_ms} ms"
+    )
+    return {
+        "message": "OK",
+        "status": 200,
+        "items": len(items),
+        "batches": -(-len(items) // BATCH_SIZE),
+        "execution_arn": execution_arn,
+        "dm_log": log.stats(),
+        "elapsed_ms": elapsed_ms,
+    }
+
+
+def notify(items: List[dict], text: str) -> dict:
+    """Send a DM to a batch of users
+
+    Args:
+        items (List[dict]): {did, convo_id} of the users, see `execute`
+        text (str): Message
+
+    The getter already changed the registry, so a failure does not fail the flow execution,
+    which could only be retried with the getter. The users not notified are returned in
+    `failed_dids` and logged, the stacks alarm on that log line.
+
+    Returns:
+        dict: Response of the notifier
+    """
+    started = time.perf_counter()
+    # one login and one proxied client for the whole batch
+    messages = [
+        {"did": item["did"], "convo_id": item.get("convo_id"), "text": text} for item in items
+    ]
+    with drop_refused_session():
+        notifier = DmNotifier(get_bot_client().with_bsky_chat_proxy())
+        results = notifier.send(messages)
+    counts = count_statuses(results)
+    elapsed_ms = _elapsed_ms(started)
+    logger.info(
+        f"Notified {len(results)} users in {elapsed_ms} ms {counts}, "
+        f"convo cache {convo_cache.hits=} {convo_cache.misses=}"
+    )
+    failed_dids = [r["did"] for r in results if r["status"] != SENT]
+    if failed_dids:
+        logger.error(f"{NOTIFY_FAILED} {len(failed_dids)} of {len(results)} users: {failed_dids}")
+    return {
+        "message": "OK",
+        "status": 200,
+        "results": [{k: v for k, v in r.items() if k != "text"} for r in results],
+        "failed_dids": failed_dids,
+        **counts,
+        "elapsed_ms": elapsed_ms,
+    }
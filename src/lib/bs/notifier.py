@@ -0,0 +1,182 @@
+"""Batched DM notifier
+
+The notifiers used to be invoked once per user, each invocation logging in and sending one
+message. A notifier invocation now takes a batch of recipients:
+* the conversations are resolved once per recipient and kept in `ConvoCache` by the warm
+  container. Items coming from the chat log already carry their conversation.
+* the conversations are sent to concurrently, the requests being throttled by the chat bucket
+  of `lib.bs.ratelimit`. The messages of a conversation are sent one after the other, in order.
+  After a failure the following messages of the conversation are skipped, so that they never
+  arrive before the failed one. A refused session fails the whole batch instead, since no
+  message can be sent with it.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+from atproto import Client, models
+
+from lib.bs.session import is_session_refused
+from lib.log import get_logger
+
+logger = get_logger(__name__)
+
+MAX_WORKERS = int(os.getenv("NOTIFY_MAX_WORKERS", 4))
+"""Conversations sent to concurrently"""
+CONVO_CACHE_SIZE = 10_000
+
+SENT = "sent"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class ConvoCache:
+    """Thread safe LRU of the conversation ID of each DID"""
+
+    def __init__(self, max_entries: int = CONVO_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._convos: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, did: str) -> Optional[str]:
+        with self._lock:
+            convo_id = self._convos.get(did)
+            if convo_id is None:
+                self.misses += 1
+                return None
+            self._convos.move_to_end(did)
+            self.hits += 1
+            return convo_id
+
+    def put(self, did: str, convo_id: str) -> None:
+        with self._lock:
+            self._convos[did] = convo_id
+            self._convos.move_to_end(did)
+            while len(self._convos) > self.max_entries:
+                self._convos.popitem(last=False)
+
+
+# conversations and threads are kept across the warm invocations of the container
+convo_cache = ConvoCache()
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="notifier")
+
+
+class DmNotifier:
+    """Send DMs to batches of users"""
+
+    def __init__(
+        self,
+        dm_client: Client,
+        cache: ConvoCache = convo_cache,
+        executor: ThreadPoolExecutor = executor,
+    ):
+        """
+        Args:
+            dm_client (Client): Client proxied to the chat service
+            cache (ConvoCache): Conversation of each DID
+            executor (ThreadPoolExecutor): Runs the conversations concurrently
+        """
+        self.dm_client = dm_client
+        self.cache = cache
+        self.executor = executor
+
+    def _get_convo_id(self, did: str) -> str:
+        convo_id = self.cache.get(did)
+        if convo_id is None:
+            convo_id = self.dm_client.chat.bsky.convo.get_convo_for_members(
+                models.ChatBskyConvoGetConvoForMembers.Params(members=[did])
+            ).convo.id
+            self.cache.put(did, convo_id)
+        return convo_id
+
+    def get_convo_ids(self, dids: Iterable[str]) -> Dict[str, str]:
+        """Get the conversation of each DID concurrently, creating the missing ones
+
+        Args:
+            dids (Iterable[str]): DIDs, duplicates are resolved once
+
+        Returns:
+            Dict[str, str]: Conversation ID of each DID, the failed ones being missing
+        """
+        unique = list(dict.fromkeys(dids))
+
+        def lookup(did: str) -> Optional[str]:
+            try:
+                return self._get_convo_id(did)
+            except Exception as e:
+                if is_session_refused(e):
+                    raise
+                logger.error(f"Failed to get the conversation with {did}: {e}")
+                return None
+
+        return {
+            did: convo_id
+            for did, convo_id in zip(unique, self.executor.map(lookup, unique))
+            if convo_id is not None
+        }
+
+    def _send_convo(self, convo_id: str, messages: List[dict]) -> List[dict]:
+        results = []
+        failed = False
+        for message in messages:
+            if failed:
+                results.append({**message, "convo_id": convo_id, "status": SKIPPED})
+                continue
+            try:
+                sent = self.dm_client.chat.bsky.convo.send_message(
+                    models.ChatBskyConvoSendMessage.Data(
+                        convo_id=convo_id,
+                        message=models.ChatBskyConvoDefs.MessageInput(text=message["text"]),
+                    )
+                )
+            except Exception as e:
+                if is_session_refused(e):
+                    raise
+                logger.error(f"Failed to send a message to {convo_id}: {e}")
+                failed = True
+                results.append({**message, "convo_id": convo_id, "status": FAILED, "error": str(e)})
+                continue
+            results.append({**message, "convo_id": convo_id, "status": SENT, "id": sent.id})
+        return results
+
+    def send(self, messages: List[dict]) -> List[dict]:
+        """Send messages, in order within each conversation
+
+        Args:
+            messages (List[dict]): {did, text} of each message, with the `convo_id` when known
+
+        Returns:
+            List[dict]: Messages in the given order, with their `convo_id` and `status`, the
+                `id` of the sent ones and the `error` of the failed ones
+        """
+        convo_ids = self.get_convo_ids(m["did"] for m in messages if not m.get("convo_id"))
+        convos: Dict[str, List[int]] = {}
+        results: List[Optional[dict]] = [None] * len(messages)
+        for i, message in enumerate(messages):
+            convo_id = message.get("convo_id") or convo_ids.get(message["did"])
+            if convo_id is None:
+                results[i] = {**message, "status": FAILED, "error": "no conversation"}
+                continue
+            convos.setdefault(convo_id, []).append(i)
+
+        def send_convo(convo_id: str) -> None:
+            indexes = convos[convo_id]
+            sent = self._send_convo(convo_id, [messages[i] for i in indexes])
+            for i, result in zip(indexes, sent):
+                results[i] = result
+
+        list(self.executor.map(send_convo, convos))
+        return results
+
+
+def count_statuses(results: List[dict]) -> Dict[str, int]:
+    """Count the results of `DmNotifier.send` by status"""
+    counts = {SENT: 0, FAILED: 0, SKIPPED: 0}
+    for result in results:
+        counts[result["status"]] += 1
+    return counts
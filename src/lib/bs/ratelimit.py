@@ -0,0 +1,247 @@
+"""Rate-limit-aware Bluesky client
+
+The PDS and the chat service limit the requests per account and endpoint, and answer 429 when
+a limit is hit. Posting bursts are slowed down instead of failing:
+* a token bucket per endpoint class (blob upload, record writes, chat, others), shared by all
+  the clients and threads of the process
+* the `ratelimit-remaining` / `ratelimit-reset` headers of each response lower the rate of its
+  bucket, so that the remaining requests are spread until the reset
+* 429, 5xx and network errors are retried `MAX_RETRIES` times, after the reset of the limit or
+  an exponential backoff with full jitter. The record writes and blob uploads may have been
+  applied when their response is lost, they are only retried on 429 and on failures to connect,
+  so that a post is never created twice.
+"""
+
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import httpx
+from atproto import Client
+from atproto_client.exceptions import NetworkError, RequestErrorBase
+
+from lib.log import get_logger
+
+logger = get_logger(__name__)
+
+MAX_RETRIES = int(os.getenv("MAX_RETRIES", 3))
+BACKOFF_BASE = 0.5
+"""Seconds of the first backoff, doubled on each retry"""
+BACKOFF_MAX = 30.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+BLOB = "blob"
+WRITE = "write"
+CHAT = "chat"
+DEFAULT = "default"
+
+ENDPOINT_CLASSES = {
+    "com.atproto.repo.uploadBlob": BLOB,
+    "com.atproto.repo.createRecord": WRITE,
+    "com.atproto.repo.putRecord": WRITE,
+    "com.atproto.repo.deleteRecord": WRITE,
+    "com.atproto.repo.applyWrites": WRITE,
+}
+
+BUCKET_LIMITS = {
+    BLOB: (5.0, 10),
+    # 5000 points per hour, a record creation costs 3
+    WRITE: (0.45, 20),
+    CHAT: (5.0, 10),
+    DEFAULT: (10.0, 30),
+}
+"""Requests per second and burst of each endpoint class"""
+
+NON_IDEMPOTENT_CLASSES = {BLOB, WRITE}
+"""Endpoint classes whose requests may have been applied when no response came back"""
+
+
+def get_endpoint_class(nsid: str) -> str:
+    """Get the class of an XRPC method
+
+    Args:
+        nsid (str): NSID of the method, e.g. `com.atproto.repo.uploadBlob`
+
+    Returns:
+        str: Endpoint class
+    """
+    if nsid.startswith("chat.bsky."):
+        return CHAT
+    return ENDPOINT_CLASSES.get(nsid, DEFAULT)
+
+
+class TokenBucket:
+    """Thread safe token bucket, whose rate can be lowered until a deadline"""
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        clock: Callable[[], float] = time.time,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        """
+        Args:
+            rate (float): Tokens per second
+            burst (int): Max tokens
+            clock (Callable[[], float]): Epoch seconds, the ratelimit-reset header being one
+            sleep (Callable[[float], None]): Sleeps the given seconds
+        """
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._throttled_rate: Optional[float] = None
+        self._throttled_until = 0.0
+        self._lock = threading.Lock()
+
+    def _current_rate(self, now: float) -> float:
+        if self._throttled_rate is not None and now < self._throttled_until:
+            return self._throttled_rate
+        self._throttled_rate = None
+        return self.rate
+
+    def acquire(self) -> float:
+        """Take a token, waiting for it if needed
+
+        Returns:
+            float: Seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                rate = self._current_rate(now)
+                self._tokens = min(self._tokens + (now - self._updated) * rate, self.burst)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                if rate > 0:
+                    delay = (1 - self._tokens) / rate
+                else:
+                    delay = self._throttled_until - now
+                # waking up at the deadline restores the rate
+                if self._throttled_rate is not None:
+                    delay = min(delay, max(self._throttled_until - now, 0.0))
+            delay = max(delay, 0.001)
+            self._sleep(delay)
+            waited += delay
+
+    def observe(self, remaining: int, reset: float) -> None:
+        """Spread the remaining requests of the server limit until its reset
+
+        Args:
+            remaining (int): Requests remaining in the window of the server
+            reset (float): Epoch seconds of the reset of the window
+        """
+        with self._lock:
+            now = self._clock()
+            if reset <= now:
+                return
+            rate = max(remaining, 0) / (reset - now)
+            if rate < self._current_rate(now):
+                self._throttled_rate = rate
+                self._throttled_until = reset
+                self._tokens = min(self._tokens, max(remaining, 0))
+
+
+class RateLimiter:
+    """Token buckets of the endpoint classes, shared by the clients of the process"""
+
+    def __init__(self, limits: Dict[str, tuple] = BUCKET_LIMITS, **bucket_options):
+        self.buckets = {
+            name: TokenBucket(rate, burst, **bucket_options)
+            for name, (rate, burst) in limits.items()
+        }
+
+    def bucket(self, nsid: str) -> TokenBucket:
+        return self.buckets[get_endpoint_class(nsid)]
+
+
+limiter = RateLimiter()
+
+
+def _parse_limit_headers(headers: Optional[dict]) -> Optional[tuple]:
+    """Get (remaining, reset) of the ratelimit headers, None if missing"""
+    if not headers:
+        return None
+    try:
+        return int(headers["ratelimit-remaining"]), float(headers["ratelimit-reset"])
+    except (KeyError, ValueError):
+        return None
+
+
+def is_retryable(endpoint_class: str, status: Optional[int], error: RequestErrorBase) -> bool:
+    """Whether a failed request can be sent again
+
+    Args:
+        endpoint_class (str): Endpoint class of the request
+        status (Optional[int]): Status code of the response, None if there is no response
+        error (RequestErrorBase): Error raised by the request
+
+    Returns:
+        bool: True if the request was rejected, or failed in a way which is safe to retry
+    """
+    if status == 429:
+        # rate limited requests are rejected before being applied
+        return True
+    if endpoint_class in NON_IDEMPOTENT_CLASSES:
+        # a 5xx or a lost response may hide an applied write, only the requests which were never
+        # sent are retried
+        return isinstance(error, NetworkError) and isinstance(error.__cause__, httpx.ConnectError)
+    return status in RETRY_STATUSES or (status is None and isinstance(error, NetworkError))
+
+
+def get_backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter
+
+    Args:
+        attempt (int): Retry number, from 0
+
+    Returns:
+        float: Seconds to wait
+    """
+    return random.uniform(0, min(BACKOFF_BASE * 2**attempt, BACKOFF_MAX))
+
+
+class RateLimitedClient(Client):
+    """atproto Client throttled by the shared rate limiter, retrying on 429 and 5xx"""
+
+    limiter: RateLimiter = limiter
+    max_retries: int = MAX_RETRIES
+
+    def _invoke(self, invoke_type, **kwargs):
+        nsid = kwargs["url"].rsplit("/", 1)[-1]
+        endpoint_class = get_endpoint_class(nsid)
+        bucket = self.limiter.buckets[endpoint_class]
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                response = super()._invoke(invoke_type, **kwargs)
+            except RequestErrorBase as e:
+                response = e.response
+                status = response.status_code if response is not None else None
+                if not is_retryable(endpoint_class, status, e) or attempt >= self.max_retries:
+                    raise
+                delay = get_backoff(attempt)
+                limit = _parse_limit_headers(response.headers if response is not None else None)
+                if limit is not None:
+                    bucket.observe(*limit)
+                    if status == 429:
+                        # the window resets at a known time, a few jittered ms keep the callers
+                        # from retrying at once
+                        delay = max(limit[1] - time.time(), 0.0) + random.uniform(0, 0.5)
+                logger.warning(f"{nsid} failed with {status}, retry {attempt + 1} in {delay:.1f}s")
+                time.sleep(min(delay, BACKOFF_MAX))
+                attempt += 1
+                continue
+            limit = _parse_limit_headers(response.headers)
+            if limit is not None:
+                bucket.observe(*limit)
+            return response
@@ -0,0 +1,404 @@
+"""Layered cache of the handle and DID resolutions
+
+`IdResolver()` caches nothing by default, and its optional in-memory cache dies with the Lambda
+container, so each cold start resolved the handles and DID documents over the network again.
+`CachingResolver` looks them up in layers:
+
+1. an in-process LRU with a TTL
+2. a store shared by the processes: a SQLite file for the ECS listener, or an S3 object for the
+   Lambdas, loaded on the first lookup and written back by `flush`
+3. the network, through `IdResolver`
+
+Not found handles and DIDs are cached as well, with the shorter `NEGATIVE_TTL`, so that the
+unknown identities of a burst do not hit the network each time. Network errors are not cached.
+
+Stores, selected by `RESOLVER_CACHE_URL`:
+    sqlite:///var/lib/wmput/resolver.db    SQLite file
+    s3://bucket/resolver/cache.json        S3 object
+"""
+
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, Optional, Tuple
+from urllib.parse import urlparse
+
+import boto3
+from atproto import IdResolver
+from atproto_core.did_doc import DidDocument
+from atproto_identity.did.atproto_data import AtprotoData
+from botocore.exceptions import ClientError
+
+from lib.log import get_logger
+
+logger = get_logger(__name__)
+
+TTL = int(os.getenv("RESOLVER_CACHE_TTL", 6 * 60 * 60))
+"""Seconds a resolution is reused, handles and PDS rarely move"""
+NEGATIVE_TTL = int(os.getenv("RESOLVER_CACHE_NEGATIVE_TTL", 5 * 60))
+"""Seconds a not found handle or DID is reused"""
+MAX_ENTRIES = int(os.getenv("RESOLVER_CACHE_MAX_ENTRIES", 100_000))
+MAX_WORKERS = 8
+"""Concurrent network resolutions of `resolve_many`"""
+LATENCY_SAMPLES = 1024
+"""Latencies kept for the percentiles"""
+
+Entry = Tuple[Optional[object], float]
+"""Resolved value, None if not found, and its expiry in epoch seconds"""
+
+
+class TTLCache:
+    """Thread safe LRU whose entries expire"""
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, clock: Callable[[], float] = time.time):
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries: OrderedDict[str, Entry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Entry]:
+        """Get an entry, None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= self._clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: Entry) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ResolverStore:
+    """Base class of the shared stores of the resolutions"""
+
+    def get(self, key: str) -> Optional[Entry]:
+        """Get an entry, expired or not, None if missing"""
+        raise NotImplementedError
+
+    def put(self, key: str, entry: Entry) -> None:
+        """Put an entry"""
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        """Write the pending entries back, if the store buffers them"""
+
+
+class SqliteResolverStore(ResolverStore):
+    """Resolutions in a local SQLite file, shared by the processes of the host"""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+        # readers do not block the writer of another process
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS resolutions"
+            " (key TEXT PRIMARY KEY, value TEXT, expires REAL NOT NULL)"
+        )
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Entry]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, expires FROM resolutions WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def put(self, key: str, entry: Entry) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO resolutions VALUES (?, ?, ?)",
+                (key, json.dumps(entry[0]), entry[1]),
+            )
+            self._db.commit()
+
+
+class S3ResolverStore(ResolverStore):
+    """Resolutions in one S3 object, loaded once and written back by `flush`
+
+    Concurrent containers merge their entries on flush, the latest expiry of a key winning.
+    """
+
+    def __init__(self, bucket: str, key: str):
+        self.bucket = bucket
+        self.key = key
+        self._s3 = boto3.client("s3")
+        self._entries: Optional[Dict[str, Entry]] = None
+        self._dirty: Dict[str, Entry] = {}
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Entry]:
+        try:
+            body = self._s3.get_object(Bucket=self.bucket, Key=self.key)["Body"].read()
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return {}
+            raise
+        return {key: tuple(entry) for key, entry in json.loads(body).items()}
+
+    def get(self, key: str) -> Optional[Entry]:
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            return self._entries.get(key)
+
+    def put(self, key: str, entry: Entry) -> None:
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            self._entries[key] = entry
+            self._dirty[key] = entry
+
+    def flush(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = self._load()
+            now = time.time()
+            for key, entry in self._dirty.items():
+                current = entries.get(key)
+                if current is None or current[1] < entry[1]:
+                    entries[key] = entry
+            # the object does not grow with the expired entries
+            entries = {key: entry for key, entry in entries.items() if entry[1] > now}
+            self._s3.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=json.dumps(entries, separators=(",", ":")).encode(),
+                ContentType="application/json",
+            )
+            self._entries = entries
+            self._dirty = {}
+
+
+def get_resolver_store(url: str) -> Optional[ResolverStore]:
+    """Get the shared store of the resolutions
+
+    Args:
+        url (str): `sqlite://<path>` or `s3://<bucket>/<key>`, None or empty for no store
+
+    Returns:
+        Optional[ResolverStore]: Store, None if no URL is given
+    """
+    if not url:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == "s3":
+        return S3ResolverStore(parsed.netloc, parsed.path.lstrip("/"))
+    if parsed.scheme == "sqlite":
+        return SqliteResolverStore(parsed.netloc + parsed.path)
+    raise ValueError(f"Unsupported resolver cache: `{url}`")
+
+
+def _percentile(samples: list, ratio: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(math.ceil(len(ordered) * ratio) - 1, len(ordered) - 1)]
+
+
+class CachingResolver:
+    """Handle and DID resolver backed by the in-process LRU, the shared store and the network"""
+
+    def __init__(
+        self,
+        store: Optional[ResolverStore] = None,
+        id_resolver: Optional[IdResolver] = None,
+        ttl: float = TTL,
+        negative_ttl: float = NEGATIVE_TTL,
+        max_entries: int = MAX_ENTRIES,
+        clock: Callable[[], float] = time.time,
+    ):
+        """
+        Args:
+            store (Optional[ResolverStore]): Store shared by the processes
+            id_resolver (Optional[IdResolver]): Network resolver
+            ttl (float): Seconds a resolution is reused
+            negative_ttl (float): Seconds a not found handle or DID is reused
+            max_entries (int): Max entries of the in-process LRU
+            clock (Callable[[], float]): Epoch seconds
+        """
+        self.store = store
+        self.id_resolver = id_resolver or IdResolver()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self.memory = TTLCache(max_entries, clock)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="resolver")
+        self._latencies: deque = deque(maxlen=LATENCY_SAMPLES)
+        self._network_latencies: deque = deque(maxlen=LATENCY_SAMPLES)
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.errors = 0
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _resolve(self, key: str, fetch: Callable[[], Optional[object]]) -> Optional[object]:
+        started = time.perf_counter()
+        try:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self._count("memory_hits")
+            elif self.store is not None and (entry := self._get_stored(key)) is not None:
+                self.memory.put(key, entry)
+                self._count("store_hits")
+            else:
+                self._count("misses")
+                network_started = time.perf_counter()
+                try:
+                    value = fetch()
+                except Exception:
+                    self._count("errors")
+                    raise
+                self._network_latencies.append(time.perf_counter() - network_started)
+                ttl = self.ttl if value is not None else self.negative_ttl
+                entry = (value, self._clock() + ttl)
+                self.memory.put(key, entry)
+                if self.store is not None:
+                    self.store.put(key, entry)
+                return value
+            if entry[0] is None:
+                self._count("negative_hits")
+            return entry[0]
+        finally:
+            self._latencies.append(time.perf_counter() - started)
+
+    def _get_stored(self, key: str) -> Optional[Entry]:
+        try:
+            entry = self.store.get(key)
+        except Exception as e:
+            # the network is the source of truth, the store only saves round trips
+            logger.error(f"Failed to read the resolver cache: {e}")
+            return None
+        if entry is None or entry[1] <= self._clock():
+            return None
+        return entry
+
+    def resolve_handle(self, handle: str) -> Optional[str]:
+        """Resolve a handle to its DID
+
+        Args:
+            handle (str): Handle, e.g. `alice.bsky.social`
+
+        Returns:
+            Optional[str]: DID, None if the handle does not resolve
+        """
+        handle = handle.lower()
+        return self._resolve(f"handle:{handle}", lambda: self.id_resolver.handle.resolve(handle))
+
+    def resolve_did(self, did: str) -> Optional[dict]:
+        """Resolve a DID to its document
+
+        Args:
+            did (str): DID
+
+        Returns:
+            Optional[dict]: DID document as JSON, None if the DID is not found
+        """
+        return self._resolve(
+            f"doc:{did}", lambda: self.id_resolver.did.resolve_without_validation(did)
+        )
+
+    def resolve_atproto_data(self, did: str) -> Optional[AtprotoData]:
+        """Resolve the handle, PDS and signing key of a DID
+
+        Args:
+            did (str): DID
+
+        Returns:
+            Optional[AtprotoData]: AT Protocol data, None if the DID is not found
+        """
+        document = self.resolve_did(did)
+        if document is None:
+            return None
+        return AtprotoData.from_did_doc(DidDocument.from_dict(document))
+
+    def resolve(self, identifier: str) -> Optional[object]:
+        """Resolve a DID to its document, or a handle to its DID"""
+        if identifier.startswith("did:"):
+            return self.resolve_did(identifier)
+        return self.resolve_handle(identifier)
+
+    def resolve_many(self, identifiers: Iterable[str]) -> Dict[str, Optional[object]]:
+        """Resolve a batch of handles and DIDs
+
+        Duplicates are resolved once and the cache misses are resolved concurrently.
+
+        Args:
+            identifiers (Iterable[str]): Handles and DIDs
+
+        Returns:
+            Dict[str, Optional[object]]: DID of each handle and document of each DID, None for
+                the ones not found
+        """
+        unique = list(dict.fromkeys(identifiers))
+        return dict(zip(unique, self._executor.map(self.resolve, unique)))
+
+    def flush(self) -> None:
+        """Write the new resolutions back to the shared store, e.g. at the end of an invocation"""
+        if self.store is None:
+            return
+        try:
+            self.store.flush()
+        except Exception as e:
+            logger.error(f"Failed to write the resolver cache: {e}")
+
+    def stats(self) -> dict:
+        """Hit rate and latency percentiles in milliseconds, reported by the handlers"""
+        lookups = self.memory_hits + self.store_hits + self.misses
+        latencies = list(self._latencies)
+        network = list(self._network_latencies)
+        return {
+            "lookups": lookups,
+            "memory_hits": self.memory_hits,
+            "store_hits": self.store_hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "errors": self.errors,
+            "hit_rate": round((lookups - self.misses) / lookups, 3) if lookups else 0.0,
+            "p50_ms": round(_percentile(latencies, 0.5) * 1000, 2),
+            "p90_ms": round(_percentile(latencies, 0.9) * 1000, 2),
+            "p99_ms": round(_percentile(latencies, 0.99) * 1000, 2),
+            "network_p50_ms": round(_percentile(network, 0.5) * 1000, 2),
+            "network_p99_ms": round(_percentile(network, 0.99) * 1000, 2),
+        }
+
+
+@lru_cache(maxsize=None)
+def get_resolver(url: Optional[str] = None) -> CachingResolver:
+    """Get the resolver shared by the invocations of the container
+
+    Args:
+        url (Optional[str]): URL of the shared store, see `get_resolver_store`. None for the
+            in-process LRU only
+
+    Returns:
+        CachingResolver: Resolver, the same one for the same URL
+    """
+    return CachingResolver(get_resolver_store(url))
@@ -0,0 +1,204 @@
+"""Bluesky session cache
+
+`createSession` is rate limited and costs a round trip, so the session of an account is:
+* reused by the warm container as long as its refresh token is valid. The atproto client
+  refreshes the access token itself, 15 minutes before it expires.
+* persisted, encrypted with the Fernet key, in a store shared by the containers. A cold start
+  imports it instead of logging in. Refreshed sessions are written back, since the refresh
+  token rotates.
+* created with the password only when there is no usable session: none stored, its refresh
+  token expired or the PDS refused it. A warm client whose session gets refused, e.g. revoked,
+  is dropped with `invalidate`, see `is_session_refused`.
+
+Stores, selected by `BSKY_SESSION_URL`:
+    s3://bucket/sessions/bot    S3 object, `.fernet` is appended to the key
+"""
+
+import threading
+import time
+from functools import lru_cache
+from typing import Callable, Optional
+from urllib.parse import urlparse
+
+import boto3
+from atproto import Client, Session, SessionEvent
+from atproto_client.exceptions import BadRequestError, LoginRequiredError, UnauthorizedError
+from botocore.exceptions import ClientError
+
+from lib.bs.ratelimit import RateLimitedClient
+from lib.fernet import decrypt, encrypt
+from lib.log import get_logger
+
+logger = get_logger(__name__)
+
+REFRESH_MARGIN = 24 * 60 * 60
+"""Seconds before the expiry of the refresh token from which the session is not reused"""
+
+
+class SessionStore:
+    """Base class of the stores of the session strings"""
+
+    def load(self) -> Optional[str]:
+        """Load the session string, None if none is stored"""
+        raise NotImplementedError
+
+    def save(self, session_string: str) -> None:
+        """Save the session string"""
+        raise NotImplementedError
+
+
+class S3SessionStore(SessionStore):
+    """Session string in an S3 object, encrypted with Fernet"""
+
+    def __init__(self, bucket: str, key: str, fernet_key: str):
+        self.bucket = bucket
+        self.key = key
+        self._fernet_key = fernet_key
+        self._s3 = boto3.client("s3")
+
+    def load(self) -> Optional[str]:
+        try:
+            body = self._s3.get_object(Bucket=self.bucket, Key=self.key)["Body"].read()
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return decrypt(body, self._fernet_key).decode()
+
+    def save(self, session_string: str) -> None:
+        body = encrypt(session_string.encode(), self._fernet_key)
+        self._s3.put_object(Bucket=self.bucket, Key=self.key, Body=body)
+
+
+@lru_cache(maxsize=None)
+def get_session_store(url: str, fernet_key: str) -> Optional[SessionStore]:
+    """Get the session store
+
+    Args:
+        url (str): `s3://<bucket>/<key>`, None or empty for no store
+        fernet_key (str): Key encrypting the session string
+
+    Returns:
+        Optional[SessionStore]: Session store, the same one for the same arguments. None if no
+            URL is given
+    """
+    if not url:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == "s3":
+        return S3SessionStore(parsed.netloc, f"{parsed.path.lstrip('/')}.fernet", fernet_key)
+    raise ValueError(f"Unsupported session store: `{url}`")
+
+
+def is_session_refused(error: BaseException) -> bool:
+    """Check whether a request failed because the PDS refused the session of the client
+
+    Args:
+        error (BaseException): Error raised by a request
+
+    Returns:
+        bool: True if the client must import or create a session again
+    """
+    if isinstance(error, (LoginRequiredError, UnauthorizedError)):
+        return True
+    if isinstance(error, BadRequestError) and error.response is not None:
+        return getattr(error.response.content, "error", None) in ("ExpiredToken", "InvalidToken")
+    return False
+
+
+def _is_reusable(session: Session) -> bool:
+    """Check whether the refresh token of the session is far enough from its expiry"""
+    try:
+        expires = session.refresh_jwt_payload.exp
+    except Exception:
+        return False
+    return expires is not None and expires - time.time() > REFRESH_MARGIN
+
+
+class SessionManager:
+    """Logged in client of an account, reusing its session across invocations and containers"""
+
+    def __init__(
+        self,
+        identifier: str,
+        password: str,
+        store: Optional[SessionStore] = None,
+        client_factory: Callable[[], Client] = RateLimitedClient,
+    ):
+        """
+        Args:
+            identifier (str): Bluesky User Handle
+            password (str): Bluesky User App Password
+            store (Optional[SessionStore]): Store shared by the containers
+            client_factory (Callable[[], Client]): Creates the clients
+        """
+        self.identifier = identifier
+        self._password = password
+        self.store = store
+        self._client_factory = client_factory
+        self._client: Optional[Client] = None
+        self._lock = threading.Lock()
+        self.logins = 0
+        self.imports = 0
+
+    def get_client(self) -> Client:
+        """Get the logged in client
+
+        Returns:
+            atproto.Client: Client, the same one as long as its session is reusable
+        """
+        with self._lock:
+            if self._client is not None and _is_reusable(self._client._session):
+                return self._client
+            self._client = self._import() or self._login()
+            return self._client
+
+    def invalidate(self) -> None:
+        """Drop the client, e.g. after the PDS refused its session"""
+        with self._lock:
+            self._client = None
+
+    def _new_client(self) -> Client:
+        client = self._client_factory()
+
+        # atproto registers plain functions only, a bound method would be dropped silently
+        def on_session_change(event: SessionEvent, session: Session) -> None:
+            self._on_session_change(event, session)
+
+        client.on_session_change(on_session_change)
+        return client
+
+    def _import(self) -> Optional[Client]:
+        if self.store is None:
+            return None
+        try:
+            session_string = self.store.load()
+        except Exception as e:
+            logger.error(f"Failed to load the session of {self.identifier}: {e}")
+            return None
+        if not session_string or not _is_reusable(Session.decode(session_string)):
+            return None
+        client = self._new_client()
+        try:
+            client.login(session_string=session_string)
+        except (BadRequestError, LoginRequiredError, UnauthorizedError) as e:
+            logger.info(f"Stored session of {self.identifier} refused: {e}")
+            return None
+        self.imports += 1
+        return client
+
+    def _login(self) -> Client:
+        client = self._new_client()
+        client.login(self.identifier, self._password)
+        self.logins += 1
+        logger.info(f"Logged in as {self.identifier}")
+        return client
+
+    def _on_session_change(self, event: SessionEvent, session: Session) -> None:
+        if event not in (SessionEvent.CREATE, SessionEvent.REFRESH) or self.store is None:
+            return
+        try:
+            self.store.save(session.export())
+        except Exception as e:
+            # the next cold start logs in again
+            logger.error(f"Failed to save the session of {self.identifier}: {e}")
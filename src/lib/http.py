@@ -0,0 +1,65 @@
+import io
+import os
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 16))
+"""Connections kept per host, enough for the images of a post downloaded concurrently"""
+
+CHUNK_SIZE = 64 * 1024
+
+_session: Optional[requests.Session] = None
+_lock = threading.Lock()
+
+
+class ResponseTooLargeError(ValueError):
+    """The response body is over the size cap"""
+
+
+def get_session() -> requests.Session:
+    """Get the HTTP session shared by the invocations of the container
+
+    Returns:
+        requests.Session: Session with a pool of keep-alive connections
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def download(url: str, params: Optional[dict] = None, max_bytes: int = 0, timeout=30) -> bytes:
+    """Stream a response body into memory
+
+    Args:
+        url (str): URL
+        params (Optional[dict]): Query parameters
+        max_bytes (int): Size cap of the body, 0 for none
+        timeout: Connect and read timeout in seconds
+
+    Raises:
+        ResponseTooLargeError: The body is over `max_bytes`
+        requests.HTTPError: The response status is an error
+
+    Returns:
+        bytes: Response body
+    """
+    with get_session().get(url, params=params, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        length = int(response.headers.get("Content-Length") or 0)
+        if max_bytes and length > max_bytes:
+            raise ResponseTooLargeError(f"{url} is {length} bytes, over {max_bytes}")
+        buffer = io.BytesIO()
+        for chunk in response.iter_content(CHUNK_SIZE):
+            buffer.write(chunk)
+            if max_bytes and buffer.tell() > max_bytes:
+                raise ResponseTooLargeError(f"{url} is over {max_bytes} bytes")
+        return buffer.getvalue()
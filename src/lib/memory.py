@@ -0,0 +1,35 @@
+import resource
+
+_STATUS = "/proc/self/status"
+_CLEAR_REFS = "/proc/self/clear_refs"
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak RSS of the process, so that it can be measured per invocation
+
+    Returns:
+        bool: False if the peak cannot be reset, e.g. out of Linux
+    """
+    try:
+        with open(_CLEAR_REFS, "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss_mb() -> float:
+    """Get the peak RSS of the process since its start or the last `reset_peak_rss`
+
+    Returns:
+        float: Peak RSS in MiB
+    """
+    try:
+        with open(_STATUS) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux, and is not reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
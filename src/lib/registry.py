@@ -0,0 +1,756 @@
+"""Compact indexed registry of the users and their watermark settings
+
+Looking the settings of a user up in one object per user costs an S3 GET per event. The
+registry keeps all the users in a snapshot loaded once per process instead:
+
+* snapshot: `SHARDS` shard files, a DID landing in the shard `crc32(did) % shards`. A shard is
+  sorted by DID and memory-mapped, so that opening it costs no parsing and a lookup is a binary
+  search over its fixed-width index, reading only the pages it touches.
+* delta log: signups and signouts since the snapshot, one object per change. They are replayed
+  into an in-memory overlay, which takes precedence over the snapshot.
+* compaction: merges the snapshot and the deltas into a new snapshot version, then switches the
+  manifest to it. Deltas newer than `COMPACTION_LAG` stay in the log, since a writer may still
+  be putting a delta with an older key. Nothing is published when there is no delta to merge.
+  The current and the previous versions are kept for the readers which have not reloaded yet,
+  the older snapshots and the deltas they compacted are deleted.
+
+Shard file layout, little endian:
+    header   MAGIC, record count (u32), reserved (u32)
+    index    per record: offset of the DID (u32), DID length (u16), record length (u16),
+             sorted by DID. The record follows its DID.
+    data     DIDs and records, the records being compact JSON of the settings
+
+Stores, selected by the registry URL:
+    file:///var/lib/wmput/registry    local directory
+    s3://bucket/registry              S3 prefix, shards are cached under `cache_dir`
+"""
+
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+from lib.log import get_logger
+
+logger = get_logger(__name__)
+
+SHARDS = 16
+MAGIC = b"WMREG\x00\x00\x01"
+HEADER = struct.Struct("<8sII")
+INDEX = struct.Struct("<IHH")
+COMPACTION_LAG = 60.0
+"""Seconds a delta stays in the log before it is compacted"""
+
+
+def encode_record(record: dict) -> bytes:
+    """Encode the settings of a user as compact JSON"""
+    return json.dumps(record, separators=(",", ":"), sort_keys=True, ensure_ascii=False).encode()
+
+
+def decode_record(data: bytes) -> dict:
+    """Decode the settings of a user"""
+    return json.loads(data)
+
+
+def get_shard(did: str, shards: int) -> int:
+    """Get the shard of a DID
+
+    Args:
+        did (str): DID
+        shards (int): Shard count of the snapshot
+
+    Returns:
+        int: Shard index
+    """
+    return zlib.crc32(did.encode()) % shards
+
+
+def write_shard(path: str, records: Iterable[Tuple[str, dict]]) -> int:
+    """Write a shard file
+
+    Args:
+        path (str): Path of the shard file
+        records (Iterable[Tuple[str, dict]]): DIDs and their settings, in any order
+
+    Returns:
+        int: Record count
+    """
+    entries = sorted((did.encode(), encode_record(record)) for did, record in records)
+    offset = HEADER.size + INDEX.size * len(entries)
+    index = bytearray()
+    data = bytearray()
+    for did, record in entries:
+        index += INDEX.pack(offset + len(data), len(did), len(record))
+        data += did + record
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(entries), 0))
+        f.write(index)
+        f.write(data)
+    return len(entries)
+
+
+class Shard:
+    """Memory-mapped shard file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, _ = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"Not a registry shard: `{path}`")
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _entry(self, i: int) -> Tuple[int, int, int]:
+        return INDEX.unpack_from(self._mm, HEADER.size + INDEX.size * i)
+
+    def get(self, did: str) -> Optional[bytes]:
+        """Get the encoded record of a DID
+
+        Args:
+            did (str): DID
+
+        Returns:
+            Optional[bytes]: Encoded record, None if the DID is not in the shard
+        """
+        key = did.encode()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset, did_length, record_length = self._entry(middle)
+            current = self._mm[offset : offset + did_length]
+            if current == key:
+                start = offset + did_length
+                return self._mm[start : start + record_length]
+            if current < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        """Iterate the DIDs and their settings, sorted by DID"""
+        for i in range(self.count):
+            offset, did_length, record_length = self._entry(i)
+            start = offset + did_length
+            yield (
+                self._mm[offset:start].decode(),
+                decode_record(self._mm[start : start + record_length]),
+            )
+
+    def close(self) -> None:
+        self._mm.close()
+
+
+@dataclass
+class Delta:
+    """Signup or signout of a user"""
+
+    key: str
+    """Orders the deltas, starts with the nanoseconds of the write"""
+    did: str
+    record: Optional[dict]
+    """Settings of the user, None for a signout"""
+
+
+def new_delta_key(now: Optional[float] = None) -> str:
+    """Build the key of a new delta, sorted by time"""
+    ns = time.time_ns() if now is None else int(now * 1e9)
+    return f"{ns:020d}-{uuid.uuid4().hex[:8]}"
+
+
+class RegistryStore:
+    """Base class of the registry stores"""
+
+    def load_manifest(self) -> Optional[dict]:
+        """Load the manifest of the current snapshot
+
+        Returns:
+            Optional[dict]: {version, shards, counts, delta_after}, None if no snapshot exists
+        """
+        raise NotImplementedError
+
+    def fetch_shard(self, version: int, index: int) -> str:
+        """Get a local copy of a shard file
+
+        Args:
+            version (int): Snapshot version
+            index (int): Shard index
+
+        Returns:
+            str: Path of the shard file
+        """
+        raise NotImplementedError
+
+    def publish(self, manifest: dict, paths: List[str]) -> None:
+        """Store the shard files of a new snapshot, then switch the manifest to it
+
+        Args:
+            manifest (dict): Manifest of the snapshot
+            paths (List[str]): Shard files, by shard index
+        """
+        raise NotImplementedError
+
+    def append(self, did: str, record: Optional[dict]) -> str:
+        """Append a delta to the log
+
+        Args:
+            did (str): DID of the user
+            record (Optional[dict]): Settings of a signup, None for a signout
+
+        Returns:
+            str: Key of the delta
+        """
+        raise NotImplementedError
+
+    def read_deltas(self, after: Optional[str], skip: frozenset = frozenset()) -> List[Delta]:
+        """Read the deltas after a key
+
+        Args:
+            after (Optional[str]): Key after which to read, None to read all of them
+            skip (frozenset): Keys already read, which are not fetched again
+
+        Returns:
+            List[Delta]: Deltas sorted by key
+        """
+        raise NotImplementedError
+
+    def prune(self, before_version: int, delta_until: Optional[str]) -> int:
+        """Delete the superseded snapshots and the compacted deltas
+
+        Args:
+            before_version (int): Snapshot versions below it are deleted
+            delta_until (Optional[str]): Deltas up to this key are deleted, None to keep them all
+
+        Returns:
+            int: Deleted snapshots and deltas
+        """
+        raise NotImplementedError
+
+    def release(self, version: int) -> None:
+        """Drop the local copies of the shards of a snapshot no longer used by the process
+
+        Args:
+            version (int): Snapshot version
+        """
+
+
+class FileRegistryStore(RegistryStore):
+    """Registry in a local directory"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _write(self, path: str, data: bytes) -> None:
+        # write to a temporary file and rename it, so that readers never see a partial file
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def load_manifest(self) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.root, "manifest.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def fetch_shard(self, version: int, index: int) -> str:
+        return os.path.join(self.root, f"snapshot-{version}", f"{index:04d}.shard")
+
+    def publish(self, manifest: dict, paths: List[str]) -> None:
+        for index, path in enumerate(paths):
+            with open(path, "rb") as f:
+                self._write(self.fetch_shard(manifest["version"], index), f.read())
+        self._write(os.path.join(self.root, "manifest.json"), json.dumps(manifest).encode())
+
+    def append(self, did: str, record: Optional[dict]) -> str:
+        key = new_delta_key()
+        body = json.dumps({"did": did, "record": record}).encode()
+        self._write(os.path.join(self.root, "delta", f"{key}.json"), body)
+        return key
+
+    def read_deltas(self, after: Optional[str], skip: frozenset = frozenset()) -> List[Delta]:
+        directory = os.path.join(self.root, "delta")
+        try:
+            names = sorted(os.listdir(directory))
+        except FileNotFoundError:
+            return []
+        deltas = []
+        for name in names:
+            key = name.removesuffix(".json")
+            if not name.endswith(".json") or (after and key <= after) or key in skip:
+                continue
+            with open(os.path.join(directory, name)) as f:
+                body = json.load(f)
+            deltas.append(Delta(key, body["did"], body["record"]))
+        return deltas
+
+    def prune(self, before_version: int, delta_until: Optional[str]) -> int:
+        deleted = 0
+        for name in os.listdir(self.root):
+            version = _parse_snapshot_version(name)
+            if version is not None and version < before_version:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+                deleted += 1
+        if delta_until is None:
+            return deleted
+        directory = os.path.join(self.root, "delta")
+        for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else ():
+            if name.removesuffix(".json") > delta_until:
+                break
+            os.remove(os.path.join(directory, name))
+            deleted += 1
+        return deleted
+
+
+class S3RegistryStore(RegistryStore):
+    """Registry under an S3 prefix, the shards being downloaded to a local cache"""
+
+    def __init__(self, bucket: str, prefix: str, cache_dir: str = "/tmp/registry"):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.cache_dir = cache_dir
+        self._s3 = boto3.client("s3")
+
+    def _key(self, *parts: str) -> str:
+        return "/".join((self.prefix, *parts)) if self.prefix else "/".join(parts)
+
+    def load_manifest(self) -> Optional[dict]:
+        try:
+            body = self._s3.get_object(Bucket=self.bucket, Key=self._key("manifest.json"))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return json.loads(body["Body"].read())
+
+    def fetch_shard(self, version: int, index: int) -> str:
+        name = f"{index:04d}.shard"
+        path = os.path.join(self.cache_dir, f"snapshot-{version}", name)
+        # snapshot versions are immutable, a warm container keeps its copy
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}"
+            self._s3.download_file(self.bucket, self._key(f"snapshot-{version}", name), tmp_path)
+            os.replace(tmp_path, path)
+        return path
+
+    def publish(self, manifest: dict, paths: List[str]) -> None:
+        for index, path in enumerate(paths):
+            key = self._key(f"snapshot-{manifest['version']}", f"{index:04d}.shard")
+            self._s3.upload_file(path, self.bucket, key)
+        self._s3.put_object(
+            Bucket=self.bucket, Key=self._key("manifest.json"), Body=json.dumps(manifest).encode()
+        )
+
+    def append(self, did: str, record: Optional[dict]) -> str:
+        key = new_delta_key()
+        body = json.dumps({"did": did, "record": record}).encode()
+        self._s3.put_object(Bucket=self.bucket, Key=self._key("delta", f"{key}.json"), Body=body)
+        return key
+
+    def read_deltas(self, after: Optional[str], skip: frozenset = frozenset()) -> List[Delta]:
+        prefix = self._key("delta", "")
+        params = {"Bucket": self.bucket, "Prefix": prefix}
+        if after:
+            params["StartAfter"] = f"{prefix}{after}.json"
+        keys = []
+        for page in self._s3.get_paginator("list_objects_v2").paginate(**params):
+            for obj in page.get("Contents", ()):
+                key = obj["Key"][len(prefix) :].removesuffix(".json")
+                if key not in skip:
+                    keys.append(key)
+
+        def fetch(key: str) -> Delta:
+            body = self._s3.get_object(Bucket=self.bucket, Key=f"{prefix}{key}.json")
+            data = json.loads(body["Body"].read())
+            return Delta(key, data["did"], data["record"])
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            return sorted(executor.map(fetch, keys), key=lambda delta: delta.key)
+
+    def _delete(self, keys: List[str]) -> None:
+        # DeleteObjects takes up to 1000 keys
+        for i in range(0, len(keys), 1000):
+            self._s3.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": key} for key in keys[i : i + 1000]], "Quiet": True},
+            )
+
+    def prune(self, before_version: int, delta_until: Optional[str]) -> int:
+        paginator = self._s3.get_paginator("list_objects_v2")
+        keys = []
+        versions = set()
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key("snapshot-")):
+            for obj in page.get("Contents", ()):
+                name = obj["Key"][len(self._key("")) :].split("/", 1)[0]
+                version = _parse_snapshot_version(name)
+                if version is not None and version < before_version:
+                    keys.append(obj["Key"])
+                    versions.add(version)
+        deltas = 0
+        if delta_until is not None:
+            prefix = self._key("delta", "")
+            # the listing is sorted by key, it stops at the first delta not compacted
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                contents = page.get("Contents", ())
+                compacted = [
+                    obj["Key"]
+                    for obj in contents
+                    if obj["Key"][len(prefix) :].removesuffix(".json") <= delta_until
+                ]
+                keys.extend(compacted)
+                deltas += len(compacted)
+                if len(compacted) < len(contents):
+                    break
+        self._delete(keys)
+        return len(versions) + deltas
+
+    def release(self, version: int) -> None:
+        shutil.rmtree(os.path.join(self.cache_dir, f"snapshot-{version}"), ignore_errors=True)
+
+
+def _parse_snapshot_version(name: str) -> Optional[int]:
+    """Get the version of a `snapshot-<version>` directory, None for the other names"""
+    version = name.removeprefix("snapshot-")
+    return int(version) if version != name and version.isdigit() else None
+
+
+def get_registry_store(url: str, cache_dir: str = "/tmp/registry") -> RegistryStore:
+    """Get the registry store for the URL
+
+    Args:
+        url (str): `file://<path>` or `s3://<bucket>/<prefix>`
+        cache_dir (str): Local cache of the shards of an S3 store
+
+    Returns:
+        RegistryStore: Registry store
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "s3":
+        return S3RegistryStore(parsed.netloc, parsed.path, cache_dir)
+    if parsed.scheme in ("file", ""):
+        return FileRegistryStore(parsed.netloc + parsed.path)
+    raise ValueError(f"Unsupported registry: `{url}`")
+
+
+class Snapshot:
+    """Snapshot version, its shards being opened on their first lookup"""
+
+    def __init__(self, store: RegistryStore, manifest: Optional[dict]):
+        self.store = store
+        self.manifest = manifest
+        self._shards: Dict[int, Shard] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> Optional[int]:
+        return self.manifest["version"] if self.manifest else None
+
+    def __len__(self) -> int:
+        return sum(self.manifest["counts"]) if self.manifest else 0
+
+    def shard(self, index: int) -> Shard:
+        shard = self._shards.get(index)
+        if shard is None:
+            with self._lock:
+                shard = self._shards.get(index)
+                if shard is None:
+                    path = self.store.fetch_shard(self.manifest["version"], index)
+                    shard = self._shards[index] = Shard(path)
+        return shard
+
+    def load_all(self) -> None:
+        """Open all the shards, downloading them concurrently"""
+        if self.manifest is None:
+            return
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(self.shard, range(self.manifest["shards"])))
+
+    def get(self, did: str) -> Optional[bytes]:
+        """Get the encoded record of a DID, None if it is not in the snapshot"""
+        if self.manifest is None:
+            return None
+        return self.shard(get_shard(did, self.manifest["shards"])).get(did)
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        if self.manifest is None:
+            return
+        for index in range(self.manifest["shards"]):
+            yield from self.shard(index).items()
+
+    def close(self) -> None:
+        """Unmap the shards and drop their local copies"""
+        with self._lock:
+            shards, self._shards = self._shards, {}
+        for shard in shards.values():
+            shard.close()
+        if self.manifest is not None:
+            self.store.release(self.manifest["version"])
+
+
+def merge_deltas(overlay: Dict[str, Delta], deltas: Iterable[Delta]) -> bool:
+    """Apply deltas to an overlay, keeping the latest delta of each DID
+
+    Args:
+        overlay (Dict[str, Delta]): Deltas by DID, updated in place
+        deltas (Iterable[Delta]): Deltas to apply
+
+    Returns:
+        bool: True if the overlay changed
+    """
+    changed = False
+    for delta in deltas:
+        current = overlay.get(delta.did)
+        # a delta put late with an older key does not override a newer one
+        if current is None or current.key < delta.key:
+            overlay[delta.did] = delta
+            changed = True
+    return changed
+
+
+class UserRegistry:
+    """Users and their watermark settings, from the snapshot and the delta log
+
+    Shards are opened on their first lookup unless `start` is used, so that a Lambda handling a
+    few users downloads only their shards. Lookups do no network I/O once the shard is open.
+    `reload` picks a new snapshot version and the new deltas up. The replaced snapshot is closed
+    on the next version change, so that a lookup still running on it never reads a closed shard.
+    """
+
+    def __init__(self, store: RegistryStore, reload_interval: float = 30.0):
+        """
+        Args:
+            store (RegistryStore): Registry store
+            reload_interval (float): Seconds between two reloads of `start` and
+                `reload_if_stale`
+        """
+        self.store = store
+        self.reload_interval = reload_interval
+        self.snapshot = Snapshot(store, None)
+        self._retired: Optional[Snapshot] = None
+        """Snapshot replaced by the last version change, closed by the next one"""
+        self._overlay: Dict[str, Delta] = {}
+        self._seen: frozenset = frozenset()
+        """Keys of the deltas read since the snapshot, not fetched again"""
+        self._preload = False
+        self._loaded_at: Optional[float] = None
+        self.lookups = 0
+        self.hits = 0
+        self.reload_latency_ms = 0.0
+        """Latency of the last reload"""
+
+    @property
+    def version(self) -> Optional[int]:
+        return self.snapshot.version
+
+    def reload(self) -> bool:
+        """Load the current snapshot version and the deltas not yet applied
+
+        Returns:
+            bool: True if the snapshot version or the overlay changed
+        """
+        started = time.perf_counter()
+        manifest = self.store.load_manifest()
+        snapshot = self.snapshot
+        overlay = self._overlay
+        seen = self._seen
+        changed = manifest != snapshot.manifest
+        if changed:
+            snapshot = Snapshot(self.store, manifest)
+            if self._preload:
+                # the readers keep the previous snapshot until the new one is ready
+                snapshot.load_all()
+            # the overlay is rebuilt from the deltas after the new snapshot
+            overlay = {}
+            seen = frozenset()
+        after = manifest["delta_after"] if manifest else None
+        deltas = self.store.read_deltas(after, seen)
+        overlay = dict(overlay)
+        changed = merge_deltas(overlay, deltas) or changed
+        # replacing the references is atomic, readers never see a partially built state
+        previous, self.snapshot, self._overlay = self.snapshot, snapshot, overlay
+        if previous is not snapshot:
+            if self._retired is not None:
+                self._retired.close()
+            self._retired = previous
+        self._seen = seen | {delta.key for delta in deltas}
+        self._loaded_at = time.monotonic()
+        self.reload_latency_ms = (time.perf_counter() - started) * 1000
+        if changed:
+            logger.info(
+                f"Loaded registry version {self.version} with {len(overlay)} deltas "
+                f"in {self.reload_latency_ms:.1f}ms"
+            )
+        return changed
+
+    def reload_if_stale(self) -> bool:
+        """Reload once `reload_interval` elapsed since the last reload, e.g. per invocation
+
+        Returns:
+            bool: True if the snapshot version or the overlay changed
+        """
+        if self._loaded_at is not None and (
+            time.monotonic() - self._loaded_at < self.reload_interval
+        ):
+            return False
+        return self.reload()
+
+    def get(self, did: str) -> Optional[dict]:
+        """Get the watermark settings of a user
+
+        Args:
+            did (str): DID of the user
+
+        Returns:
+            Optional[dict]: Settings, None if the user is not signed up
+        """
+        self.lookups += 1
+        delta = self._overlay.get(did)
+        if delta is not None:
+            record = delta.record
+        else:
+            data = self.snapshot.get(did)
+            record = decode_record(data) if data is not None else None
+        if record is not None:
+            self.hits += 1
+        return record
+
+    def __contains__(self, did: str) -> bool:
+        return self.get(did) is not None
+
+    def __len__(self) -> int:
+        snapshot = self.snapshot
+        count = len(snapshot)
+        for did, delta in self._overlay.items():
+            count += (delta.record is not None) - (snapshot.get(did) is not None)
+        return count
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        """Iterate all the users and their settings, snapshot and deltas merged"""
+        overlay = self._overlay
+        for did, record in self.snapshot.items():
+            if did not in overlay:
+                yield did, record
+        for did, delta in overlay.items():
+            if delta.record is not None:
+                yield did, delta.record
+
+    def start(self) -> threading.Thread:
+        """Load the registry with all its shards and start the reload thread
+
+        Call it in the process which uses the registry, threads do not survive a fork.
+
+        Returns:
+            threading.Thread: Started thread
+        """
+        self._preload = True
+        self.reload()
+        self.snapshot.load_all()
+
+        def run() -> None:
+            while True:
+                time.sleep(self.reload_interval)
+                try:
+                    self.reload()
+                except Exception as e:
+                    logger.error(f"Failed to reload the registry: {e}")
+
+        thread = threading.Thread(target=run, name="registry-reloader", daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self) -> str:
+        """Build a stats line and reset the lookup counters"""
+        ratio = self.hits / self.lookups if self.lookups else 0.0
+        line = (
+            f"registry_version={self.version} deltas={len(self._overlay)}"
+            f" lookups={self.lookups} hit_ratio={ratio:.4f}"
+            f" last_reload={self.reload_latency_ms:.1f}ms"
+        )
+        self.lookups = 0
+        self.hits = 0
+        return line
+
+
+def compact(
+    store: RegistryStore,
+    shards: int = SHARDS,
+    lag: float = COMPACTION_LAG,
+    now: Optional[float] = None,
+) -> Optional[dict]:
+    """Merge the snapshot and the delta log into a new snapshot version
+
+    The snapshots older than the previous version and the deltas compacted into the previous
+    version are deleted once the new version is published.
+
+    Args:
+        store (RegistryStore): Registry store
+        shards (int): Shard count of the new snapshot
+        lag (float): Seconds a delta stays in the log before it is compacted
+        now (Optional[float]): Epoch seconds of the compaction
+
+    Returns:
+        Optional[dict]: Manifest of the current snapshot, unchanged if there was no delta to
+            merge, None if there is no snapshot yet
+    """
+    now = time.time() if now is None else now
+    # deltas up to the cutoff are merged, the readers replay the ones after it
+    cutoff = f"{int((now - lag) * 1e9):020d}"
+    manifest = store.load_manifest()
+    snapshot = Snapshot(store, manifest)
+    after = manifest["delta_after"] if manifest else None
+    overlay: Dict[str, Delta] = {}
+    merge_deltas(overlay, (d for d in store.read_deltas(after) if d.key <= cutoff))
+    if not overlay:
+        logger.info(f"No delta to compact into registry version {snapshot.version}")
+        return manifest
+
+    buckets: List[List[Tuple[str, dict]]] = [[] for _ in range(shards)]
+    for did, record in snapshot.items():
+        if did not in overlay:
+            buckets[get_shard(did, shards)].append((did, record))
+    for did, delta in overlay.items():
+        if delta.record is not None:
+            buckets[get_shard(did, shards)].append((did, delta.record))
+
+    new_manifest = {
+        "version": (manifest["version"] + 1) if manifest else 1,
+        "shards": shards,
+        "counts": [],
+        "delta_after": max(cutoff, after or ""),
+        "created_at": now,
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for index, records in enumerate(buckets):
+            path = os.path.join(directory, f"{index:04d}.shard")
+            new_manifest["counts"].append(write_shard(path, records))
+            paths.append(path)
+        store.publish(new_manifest, paths)
+    snapshot.close()
+    # the readers which have not reloaded yet still use the previous version and its deltas
+    pruned = store.prune(manifest["version"], after) if manifest else 0
+    logger.info(
+        f"Compacted registry version {new_manifest['version']} with "
+        f"{sum(new_manifest['counts'])} users and {len(overlay)} deltas, pruned {pruned} objects"
+    )
+    return new_manifest
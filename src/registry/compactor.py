@@ -0,0 +1,28 @@
+import os
+
+from lib.log import get_logger
+from lib.registry import SHARDS, compact, get_registry_store
+
+logger = get_logger(__name__)
+
+USER_REGISTRY_URL = os.getenv("USER_REGISTRY_URL")
+REGISTRY_SHARDS = int(os.getenv("USER_REGISTRY_SHARDS", SHARDS))
+
+
+def handler(event, context):
+    """Lambda handler.
+
+    Merges the signups and signouts of the delta log into a new snapshot of the user registry,
+    keeps the current snapshot if there is none.
+    """
+    manifest = compact(get_registry_store(USER_REGISTRY_URL), REGISTRY_SHARDS)
+    return {
+        "message": "OK",
+        "status": 200,
+        "version": manifest["version"] if manifest else None,
+        "users": sum(manifest["counts"]) if manifest else 0,
+    }
+
+
+if __name__ == "__main__":
+    print(handler({}, {}))
@@ -1,6 +1,7 @@
-from atproto import IdResolver, models
+from atproto import models
 
 from lib.bs.client import get_dm_client
+from lib.bs.resolver import get_resolver
 from settings import settings
 
 USERNAME = settings.BOT_USERID
@@ -24,10 +25,10 @@ def main() -> None:
         member = convo.members[0]
         print(f"convo-id=`{convo.id}`, did=`{member.did}`")
 
-    # create resolver instance with in-memory cache
-    id_resolver = IdResolver()
+    # resolver with the in-process cache, shared by the calls
+    resolver = get_resolver()
     # resolve DID
-    chat_to = id_resolver.handle.resolve(member.handle)
+    chat_to = resolver.resolve_handle(member.handle)
 
     # create or get conversation with chat_to
     convo = dm.get_convo_for_members(
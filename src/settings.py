@@ -1,20 +1,50 @@
+"""Settings of the application
+
+Importing this module costs no I/O, so that the handlers that don't use the secrets pay nothing
+on their cold start:
+* the plain settings are read from the environment. `SRC_VERSION` is baked in the image at build
+  time (`docker build --build-arg SRC_VERSION=...`).
+* the secrets are fetched from Secrets Manager on the first access to one of them, and kept by
+  the warm container for `SETTINGS_TTL` seconds. An access after the TTL returns the cached
+  values and refreshes them in the background. If the refresh fails, the cached values are kept
+  and the next access retries.
+"""
+
 import os
-import subprocess
-from dataclasses import dataclass
+import threading
+import time
 from logging import DEBUG, INFO
+from typing import Callable, Dict, Optional
+
+from lib.log import get_logger
+
+logger = get_logger(__name__)
+
+SETTINGS_TTL = float(os.getenv("SETTINGS_TTL", 15 * 60))
+"""Seconds for which the secrets are used before being refreshed"""
+
+SECRET_KEYS = {
+    "FERNET_KEY": "fernet_key",
+    "BOT_USERID": "bot_userid",
+    "BOT_APP_PASSWORD": "bot_app_password",
+}
+"""Key in the secret of each secret setting"""
+
 
-from lib.aws.secrets_manager import get_secret
+def _get_secret(secret_name: str) -> dict:
+    # boto3 is only imported by the handlers using the secrets
+    from lib.aws.secrets_manager import get_secret
 
-print("Loading settings...")
+    return get_secret(secret_name)
 
 
-@dataclass
 class Settings:
     SRC_VERSION: str
     STAGE: str
     APP_NAME: str
     LOGLEVEL: int
     TIMEZONE: str
+    SECRET_NAME: str
     FERNET_KEY: str
     """A URL-safe base64-encoded 32-byte key. Use Fernet.generate_key().decode() to generate a new key."""
     BOT_USERID: str
@@ -26,25 +56,80 @@ class Settings:
             cls._instance = super(Settings, cls).__new__(cls)
         return cls._instance
 
-    def __init__(self):
-        """設定を読み込む"""
-        _secrets = get_secret(f"{os.getenv('')}")
-        self.FERNET_KEY = _secrets.get("fernet_key")
-        self.BOT_USERID = _secrets.get("bot_userid")
-        self.BOT_APP_PASSWORD = _secrets.get("bot_app_password")
+    def __init__(
+        self,
+        ttl: float = SETTINGS_TTL,
+        loader: Callable[[str], dict] = _get_secret,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """設定を読み込む。シークレットは最初に参照されたときに読み込む
+
+        Args:
+            ttl (float): Seconds for which the secrets are used before being refreshed
+            loader (Callable[[str], dict]): Gets the secret of the given name
+            clock (Callable[[], float]): Seconds
+        """
         self.APP_NAME = os.getenv("APP_NAME", default="wmput")
-        self.LOGLEVEL = INFO if self.STAGE.lower == "prod" else DEBUG
         self.STAGE = os.getenv("STAGE", default="dev")
-        self.SRC_VERSION = self._get_src_version()
-        print(f"Application Version: {self.SRC_VERSION}")
+        self.LOGLEVEL = INFO if self.STAGE.lower() == "prod" else DEBUG
+        self.TIMEZONE = os.getenv("TIMEZONE", default="Asia/Tokyo")
+        self.SRC_VERSION = os.getenv("SRC_VERSION", default="0.0.0")
+        self.SECRET_NAME = os.getenv(
+            "SECRET_NAME", default=f"{self.APP_NAME}-secrets-{self.STAGE}".lower()
+        )
+        self.ttl = ttl
+        self._loader = loader
+        self._clock = clock
+        self._secrets: Optional[Dict[str, str]] = None
+        self._loaded_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def __getattr__(self, name: str):
+        # only called for the attributes not set by __init__
+        if name in SECRET_KEYS:
+            return self.get_secrets().get(SECRET_KEYS[name])
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def _load(self) -> Dict[str, str]:
+        secrets = self._loader(self.SECRET_NAME)
+        self.loads += 1
+        logger.debug(f"Loaded the secrets of version {self.SRC_VERSION}")
+        return secrets
 
-    def _get_src_version(self) -> str:
-        """ソースコードのcommit hashをバージョンとして取得する"""
+    def _refresh(self) -> None:
         try:
-            revparsed: str = subprocess.check_output("git rev-parse --short HEAD").decode("utf-8")
-            return revparsed.strip()
-        except BaseException:
-            return "0.0.0"
+            secrets = self._load()
+        except BaseException as e:
+            logger.error(f"Failed to refresh the secrets: {e}")
+            with self._lock:
+                self._refreshing = False
+            return
+        with self._lock:
+            self._secrets = secrets
+            self._loaded_at = self._clock()
+            self._refreshing = False
+
+    def get_secrets(self) -> Dict[str, str]:
+        """Get the secrets, fetching them on the first call
+
+        Returns:
+            Dict[str, str]: Pairs of Key and Value of the secrets, possibly stale by a refresh
+        """
+        with self._lock:
+            if self._secrets is None:
+                self._secrets = self._load()
+                self._loaded_at = self._clock()
+            elif not self._refreshing and self._clock() - self._loaded_at >= self.ttl:
+                self._refreshing = True
+                threading.Thread(target=self._refresh, name="settings", daemon=True).start()
+            return self._secrets
+
+    def invalidate(self) -> None:
+        """Drop the secrets, the next access fetching them again, e.g. after a rotation"""
+        with self._lock:
+            self._secrets = None
 
 
 settings = Settings()
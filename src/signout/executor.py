@@ -1,11 +1,16 @@
-from lib.log import get_logger
+import os
 
-logger = get_logger(__name__)
+from lib.bs.dms import SIGNOUT
+from lib.bs.flows import execute
 
 
 def handler(event, context):
-    """Lambda handler."""
-    return {"message": "OK", "status": 200}
+    """Lambda handler.
+
+    Reads the DMs received since the previous run and starts the signout flow with the signout
+    commands among them, see `lib.bs.flows.execute`.
+    """
+    return execute(SIGNOUT, os.getenv("STATE_MACHINE_ARN"), os.getenv("DM_CURSOR_URL"))
 
 
 if __name__ == "__main__":
@@ -1,11 +1,31 @@
+import os
+
 from lib.log import get_logger
+from lib.registry import get_registry_store
 
 logger = get_logger(__name__)
 
+_registry_url = os.getenv("USER_REGISTRY_URL")
+
+store = get_registry_store(_registry_url) if _registry_url else None
+"""Delta log of the user registry, read by the firehose listener and the watermarking getter"""
+
 
 def handler(event, context):
-    """Lambda handler."""
-    return {"message": "OK", "status": 200}
+    """Lambda handler.
+
+    event:
+        items: batch of the signout commands, passed on to the notifier
+
+    Writes a signout delta to the user registry per command, the user being dropped by the
+    readers on their next reload.
+    """
+    if store is None:
+        raise ValueError("USER_REGISTRY_URL is not set")
+    for item in event["items"]:
+        store.append(item["did"], None)
+    logger.info(f"Unregistered {len(event['items'])} signouts")
+    return {**event, "message": "OK", "status": 200}
 
 
 if __name__ == "__main__":
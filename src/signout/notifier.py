@@ -1,11 +1,17 @@
-from lib.log import get_logger
+from lib.bs.flows import notify
 
-logger = get_logger(__name__)
+MESSAGE = "ウォーターマークの登録を解除しました。ご利用ありがとうございました。"
 
 
 def handler(event, context):
-    """Lambda handler."""
-    return {"message": "OK", "status": 200}
+    """Lambda handler.
+
+    event:
+        items: batch of {did, convo_id} of the users who signed out, see `signout.executor`
+
+    The users who could not be notified are returned in `failed_dids`, see `lib.bs.flows.notify`.
+    """
+    return notify(event["items"], MESSAGE)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,16 @@
-from lib.log import get_logger
+import os
 
-logger = get_logger(__name__)
+from lib.bs.dms import SIGNUP
+from lib.bs.flows import execute
 
 
 def handler(event, context):
-    """Lambda handler."""
-    return {"message": "OK", "status": 200}
+    """Lambda handler.
+
+    Reads the DMs received since the previous run and starts the signup flow with the signup
+    commands among them, see `lib.bs.flows.execute`.
+    """
+    return execute(SIGNUP, os.getenv("STATE_MACHINE_ARN"), os.getenv("DM_CURSOR_URL"))
 
 
 if __name__ == "__main__":
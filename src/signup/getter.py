@@ -1,11 +1,57 @@
+import os
+
+from lib.bs.dms import get_argument
+from lib.bs.resolver import get_resolver
 from lib.log import get_logger
+from lib.registry import get_registry_store
 
 logger = get_logger(__name__)
 
+_registry_url = os.getenv("USER_REGISTRY_URL")
+
+# the clients and the DID documents are kept across the warm invocations
+store = get_registry_store(_registry_url) if _registry_url else None
+"""Delta log of the user registry, read by the firehose listener and the watermarking getter"""
+resolver = get_resolver(os.getenv("RESOLVER_CACHE_URL"))
+
+
+def build_record(item: dict) -> dict:
+    """Build the watermark settings of a user who signed up
+
+    Args:
+        item (dict): Signup command, {did, text} for a DM, {did, uri} for a follow
+
+    Returns:
+        dict: Watermark settings, the text following the command or `@<handle>` of the user.
+            A follow also saves its `follow_uri`, so that the listener recognizes its delete.
+    """
+    text = get_argument(item.get("text") or "")
+    if text is None:
+        data = resolver.resolve_atproto_data(item["did"])
+        text = f"@{data.handle}" if data is not None and data.handle else item["did"]
+    record = {"text": text}
+    if item.get("uri"):
+        record["follow_uri"] = item["uri"]
+    return record
+
 
 def handler(event, context):
-    """Lambda handler."""
-    return {"message": "OK", "status": 200}
+    """Lambda handler.
+
+    event:
+        items: batch of the signup commands, passed on to the notifier
+
+    Writes a signup delta to the user registry per command, which the readers apply on their
+    next reload and the compactor merges into the next snapshot.
+    """
+    if store is None:
+        raise ValueError("USER_REGISTRY_URL is not set")
+    for item in event["items"]:
+        store.append(item["did"], build_record(item))
+    # the resolutions of this container are shared with the next cold starts
+    resolver.flush()
+    logger.info(f"Registered {len(event['items'])} signups, resolver {resolver.stats()}")
+    return {**event, "message": "OK", "status": 200}
 
 
 if __name__ == "__main__":
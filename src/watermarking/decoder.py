@@ -0,0 +1,96 @@
+"""Reduced-resolution decode of the source images
+
+Artists often upload originals much larger than what Bluesky displays. The decoder reads the
+header first and refuses the images over the byte and pixel caps, then decodes directly at the
+target resolution when the format allows it: JPEG is decoded with DCT scaling (`Image.draft`,
+1/2, 1/4 or 1/8 of the size) so that a 6000x4000 original never exists in memory at full size.
+Other formats are decoded fully and downscaled right after, within the pixel cap.
+"""
+
+import io
+from dataclasses import dataclass
+from typing import Tuple
+
+from PIL import Image
+
+MAX_SOURCE_BYTES = 50 * 1024 * 1024
+MAX_SOURCE_PIXELS = 64_000_000
+MAX_SIDE = 2000
+"""Long side of the decoded images, Bluesky displays images up to 2000 px"""
+
+
+class ImageTooLargeError(ValueError):
+    """The source image is over the byte or pixel cap"""
+
+
+DECODE_ERRORS = (ImageTooLargeError, Image.DecompressionBombError, OSError, SyntaxError)
+"""Errors of a source image which cannot be watermarked: over the caps, corrupt, truncated or
+of an unsupported format (`UnidentifiedImageError` is an `OSError`, a broken PNG raises
+`SyntaxError`)"""
+
+
+@dataclass
+class DecodeInfo:
+    """Stats of a decode"""
+
+    format: str
+    source_size: Tuple[int, int]
+    draft_size: Tuple[int, int]
+    """Size decoded by the loader, smaller than the source for scaled JPEG decoding"""
+    size: Tuple[int, int]
+
+    def stats(self) -> dict:
+        """Stats reported in the handler responses"""
+        return {
+            "format": self.format,
+            "source_size": list(self.source_size),
+            "draft_size": list(self.draft_size),
+            "size": list(self.size),
+        }
+
+
+def _target_size(size: Tuple[int, int], max_side: int) -> Tuple[int, int]:
+    width, height = size
+    ratio = min(max_side / max(width, height), 1.0)
+    return max(round(width * ratio), 1), max(round(height * ratio), 1)
+
+
+def decode(
+    data: bytes,
+    max_side: int = MAX_SIDE,
+    max_pixels: int = MAX_SOURCE_PIXELS,
+    max_bytes: int = MAX_SOURCE_BYTES,
+) -> Tuple[Image.Image, DecodeInfo]:
+    """Decode an image at most `max_side` pixels on its long side
+
+    Args:
+        data (bytes): Encoded image
+        max_side (int): Max long side of the decoded image
+        max_pixels (int): Pixel cap of the source image
+        max_bytes (int): Byte cap of the source image
+
+    Raises:
+        ImageTooLargeError: The source image is over a cap
+
+    Returns:
+        Tuple[Image.Image, DecodeInfo]: Decoded image, RGB or RGBA, and the decode stats
+    """
+    if len(data) > max_bytes:
+        raise ImageTooLargeError(f"Image of {len(data)} bytes over the cap of {max_bytes}")
+    # only the header is read until the image is loaded
+    image = Image.open(io.BytesIO(data))
+    source_format = image.format or ""
+    source_size = image.size
+    if image.width * image.height > max_pixels:
+        raise ImageTooLargeError(f"Image of {image.width}x{image.height} over the pixel cap")
+
+    target = _target_size(source_size, max_side)
+    if source_format == "JPEG" and target != source_size:
+        image.draft("RGB", target)
+    draft_size = image.size
+    image.load()
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+    if image.size != target:
+        image = image.resize(target, Image.LANCZOS, reducing_gap=2.0)
+    return image, DecodeInfo(source_format, source_size, draft_size, image.size)
@@ -0,0 +1,207 @@
+"""Size-targeted encoder of the watermarked images
+
+Bluesky rejects image blobs over `MAX_BLOB_BYTES`. Re-encoding a big illustration at
+decreasing qualities until it fits takes many encodes, so the encoder:
+
+1. picks the format: PNG for line art (few colors) if it fits, otherwise JPEG, or WebP when
+   the image has transparency
+2. predicts the starting quality from the pixel count and the bytes per pixel of the source,
+   relative to a typical illustration
+3. binary searches the quality, and the downscale factor when even the lowest quality does not
+   fit, within `max_attempts` encodes.
+
+Everything is encoded into in-memory buffers.
+"""
+
+import io
+import math
+from dataclasses import dataclass
+from typing import Optional
+
+from PIL import Image
+
+MAX_BLOB_BYTES = 1_000_000
+"""Size limit of the images of `app.bsky.embed.images`"""
+
+MIN_QUALITY = 50
+MAX_QUALITY = 95
+
+QUALITY_BYTES_PER_PIXEL = [
+    (95, 0.34),
+    (90, 0.25),
+    (85, 0.20),
+    (80, 0.18),
+    (75, 0.16),
+    (70, 0.15),
+    (60, 0.13),
+    (50, 0.11),
+]
+"""JPEG bytes per pixel of a typical illustration by quality, highest quality first"""
+
+REFERENCE_BYTES_PER_PIXEL = {"JPEG": 0.25, "PNG": 1.5, "WEBP": 0.15}
+"""Bytes per pixel of a typical illustration in the source formats"""
+
+WEBP_RATIO = 0.75
+"""Size of WebP relative to JPEG at the same quality"""
+
+GOOD_ENOUGH_RATIO = 0.8
+"""Share of the size limit above which a fitting encode is not improved further"""
+
+LINE_ART_MAX_COLORS = 256
+"""Max colors of a thumbnail for the image to be considered line art"""
+
+
+@dataclass
+class EncodeResult:
+    """Encoded image and the stats of its encoding"""
+
+    data: bytes
+    format: str
+    quality: Optional[int]
+    """None for PNG"""
+    scale: float
+    """Downscale factor applied to the image"""
+    width: int
+    height: int
+    attempts: int
+    """Number of encodes"""
+
+    @property
+    def mime_type(self) -> str:
+        return Image.MIME[self.format]
+
+    @property
+    def bytes_per_pixel(self) -> float:
+        return len(self.data) / (self.width * self.height)
+
+    def stats(self) -> dict:
+        """Stats reported in the handler responses"""
+        return {
+            "format": self.format,
+            "quality": self.quality,
+            "scale": round(self.scale, 3),
+            "width": self.width,
+            "height": self.height,
+            "attempts": self.attempts,
+            "bytes": len(self.data),
+            "bytes_per_pixel": round(self.bytes_per_pixel, 4),
+        }
+
+
+def is_line_art(image: Image.Image) -> bool:
+    """Check whether the image has few colors, i.e. compresses better losslessly"""
+    thumbnail = image.copy()
+    thumbnail.thumbnail((256, 256), Image.NEAREST)
+    return thumbnail.getcolors(maxcolors=LINE_ART_MAX_COLORS) is not None
+
+
+def predict_quality(
+    pixels: int, max_bytes: int, lossy_format: str, source_format: str, source_size: int
+) -> int:
+    """Predict the highest quality fitting the size limit
+
+    Args:
+        pixels (int): Pixel count of the image to encode
+        max_bytes (int): Size limit
+        lossy_format (str): JPEG or WEBP
+        source_format (str): Format of the source image
+        source_size (int): Bytes of the source image, for its pixel count
+
+    Returns:
+        int: Quality, MIN_QUALITY if none is expected to fit
+    """
+    reference = REFERENCE_BYTES_PER_PIXEL.get(source_format)
+    complexity = 1.0
+    if reference and source_size:
+        # detailed images take more bytes in any format, clamped against unusual sources
+        complexity = min(max(source_size / pixels / reference, 0.25), 4.0)
+    if lossy_format == "WEBP":
+        complexity *= WEBP_RATIO
+    for quality, bytes_per_pixel in QUALITY_BYTES_PER_PIXEL:
+        if pixels * bytes_per_pixel * complexity <= max_bytes:
+            return quality
+    return MIN_QUALITY
+
+
+def _encode(image: Image.Image, image_format: str, quality: Optional[int]) -> bytes:
+    buffer = io.BytesIO()
+    if quality is None:
+        image.save(buffer, format=image_format)
+    else:
+        image.save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def _resize(image: Image.Image, scale: float) -> Image.Image:
+    if scale >= 1.0:
+        return image
+    size = (max(round(image.width * scale), 1), max(round(image.height * scale), 1))
+    return image.resize(size, Image.LANCZOS)
+
+
+def encode(
+    image: Image.Image,
+    source_format: str = "",
+    source_size: int = 0,
+    max_bytes: int = MAX_BLOB_BYTES,
+    max_attempts: int = 6,
+) -> EncodeResult:
+    """Encode the image under the size limit
+
+    Args:
+        image (Image.Image): RGB or RGBA image
+        source_format (str): Format of the source image, PNG is kept for line art
+        source_size (int): Bytes of the source image, used to predict the quality
+        max_bytes (int): Size limit
+        max_attempts (int): Encodes of the search. When nothing fits after them, the image is
+            downscaled at the lowest quality until it fits.
+
+    Returns:
+        EncodeResult: Encoded image
+    """
+    attempts = 0
+    has_alpha = image.mode == "RGBA" and image.getextrema()[3][0] < 255
+    if source_format == "PNG" and is_line_art(image):
+        data = _encode(image, "PNG", None)
+        attempts += 1
+        if len(data) <= max_bytes:
+            return EncodeResult(data, "PNG", None, 1.0, image.width, image.height, attempts)
+
+    lossy_format = "WEBP" if has_alpha else "JPEG"
+    if lossy_format == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+    pixels = image.width * image.height
+    quality = predict_quality(pixels, max_bytes, lossy_format, source_format, source_size)
+    scale = 1.0
+    low, high = MIN_QUALITY, MAX_QUALITY
+    best: Optional[EncodeResult] = None
+    scaled = image
+
+    while True:
+        data = _encode(scaled, lossy_format, quality)
+        attempts += 1
+        if len(data) <= max_bytes:
+            best = EncodeResult(
+                data, lossy_format, quality, scale, scaled.width, scaled.height, attempts
+            )
+            low = quality + 1
+        else:
+            high = quality - 1
+            if quality == MIN_QUALITY or (attempts >= max_attempts and best is None):
+                # the size is roughly proportional to the pixel count, at the same quality
+                scale *= math.sqrt(max_bytes / len(data)) * 0.95
+                scaled = _resize(image, scale)
+                low, high = MIN_QUALITY, quality
+                continue
+        # a step under 5 does not change the size enough to be worth an encode
+        if best is not None and (
+            attempts >= max_attempts
+            or high - low < 5
+            or len(best.data) >= max_bytes * GOOD_ENOUGH_RATIO
+        ):
+            best.attempts = attempts
+            return best
+        if low > high:
+            quality = MIN_QUALITY
+        else:
+            quality = (low + high + 1) // 2
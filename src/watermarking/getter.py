@@ -1,11 +1,162 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.aws.s3 import get_s3_client
+from lib.bs.resolver import get_resolver
+from lib.http import download
 from lib.log import get_logger
+from lib.registry import UserRegistry, get_registry_store
+from watermarking.renderer import WatermarkSettings
+from watermarking.result_cache import ResultCache
 
 logger = get_logger(__name__)
 
+ORG_IMAGE_BUCKET = os.getenv("ORG_IMAGE_BUCKET")
+WATERMARKED_IMAGE_BUCKET = os.getenv("WATERMARKED_IMAGE_BUCKET")
+MAX_BLOB_BYTES = int(os.getenv("WATERMARK_MAX_SOURCE_BYTES", 50 * 1024 * 1024))
+_registry_url = os.getenv("USER_REGISTRY_URL")
+
+# clients, threads and the DID documents are kept across the warm invocations
+s3 = get_s3_client()
+result_cache = ResultCache(s3, WATERMARKED_IMAGE_BUCKET)
+resolver = get_resolver(os.getenv("RESOLVER_CACHE_URL"))
+registry = UserRegistry(get_registry_store(_registry_url)) if _registry_url else None
+"""Watermark settings of the users, for the events without `watermark`"""
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="getter")
+
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def download_blob(did: str, cid: str) -> bytes:
+    """Download a blob from the PDS of its repository
+
+    Args:
+        did (str): DID of the repository
+        cid (str): Blob CID
+
+    Raises:
+        ValueError: The DID does not resolve to a PDS
+
+    Returns:
+        bytes: Blob
+    """
+    data = resolver.resolve_atproto_data(did)
+    if data is None or data.pds is None:
+        raise ValueError(f"No PDS found for {did}")
+    pds = data.pds
+    return download(
+        f"{pds}/xrpc/com.atproto.sync.getBlob",
+        params={"did": did, "cid": cid},
+        max_bytes=MAX_BLOB_BYTES,
+    )
+
+
+def fetch_image(image: dict, did: str, settings: WatermarkSettings) -> dict:
+    """Store an image of the post in the original images bucket, unless already watermarked
+
+    Args:
+        image (dict): {cid, mime_type, size, alt} of the image
+        did (str): DID of the author of the post
+        settings (WatermarkSettings): Watermark settings
+
+    Returns:
+        dict: The image with its `result` if cached, its {bucket, key} otherwise, and the
+            timings in milliseconds
+    """
+    started = time.perf_counter()
+    result = result_cache.lookup(image["cid"], settings)
+    timings = {"lookup_ms": _elapsed_ms(started)}
+    if result is not None:
+        return {**image, "result": result, "bytes": 0, "timings": timings}
+
+    download_started = time.perf_counter()
+    data = download_blob(did, image["cid"])
+    timings["download_ms"] = _elapsed_ms(download_started)
+
+    upload_started = time.perf_counter()
+    key = f"{did}/{image['cid']}"
+    s3.put_object(
+        Bucket=ORG_IMAGE_BUCKET,
+        Key=key,
+        Body=data,
+        ContentType=image.get("mime_type") or "application/octet-stream",
+    )
+    timings["upload_ms"] = _elapsed_ms(upload_started)
+    return {
+        **image,
+        "bucket": ORG_IMAGE_BUCKET,
+        "key": key,
+        "result": None,
+        "bytes": len(data),
+        "timings": timings,
+    }
+
+
+def get_watermark(did: str) -> dict:
+    """Get the watermark settings of a user from the registry
+
+    Args:
+        did (str): DID of the user
+
+    Raises:
+        ValueError: The user is not signed up, or no registry is configured
+
+    Returns:
+        dict: Watermark settings
+    """
+    if registry is None:
+        raise ValueError("No watermark settings given and USER_REGISTRY_URL is not set")
+    # the snapshot and the new deltas are checked at most once per reload interval
+    registry.reload_if_stale()
+    settings = registry.get(did)
+    if settings is None:
+        raise ValueError(f"{did} is not signed up")
+    return settings
+
 
 def handler(event, context):
-    """Lambda handler."""
-    return {"message": "OK", "status": 200}
+    """Lambda handler.
+
+    event:
+        did: DID of the author of the post
+        images: list of {cid, mime_type, size, alt} of the post images
+        watermark: watermark settings, see `WatermarkSettings`. Looked up in the user registry
+            by DID if missing
+
+    The images already watermarked with the same settings are not downloaded, they get
+    the {bucket, key} of the watermarked image as `result`.
+    """
+    started = time.perf_counter()
+    if "watermark" not in event:
+        event = {**event, "watermark": get_watermark(event["did"])}
+    settings = WatermarkSettings.from_dict(event["watermark"])
+    images = list(
+        executor.map(lambda image: fetch_image(image, event["did"], settings), event["images"])
+    )
+    elapsed = time.perf_counter() - started
+    # the resolutions of this container are shared with the next cold starts
+    resolver.flush()
+    downloaded = sum(image["bytes"] for image in images)
+    mb_per_second = round(downloaded / 1024 / 1024 / elapsed, 2) if elapsed else 0.0
+    resolver_stats = resolver.stats()
+    logger.info(
+        f"Stored {downloaded} bytes of {len(images)} images in {elapsed * 1000:.1f} ms "
+        f"({mb_per_second} MB/s), result cache {result_cache.stats()}, "
+        f"resolver {resolver_stats}"
+    )
+    return {
+        **event,
+        "images": images,
+        "output_bucket": WATERMARKED_IMAGE_BUCKET,
+        "getter": {
+            "elapsed_ms": round(elapsed * 1000, 1),
+            "mb_per_second": mb_per_second,
+            "resolver": resolver_stats,
+        },
+    }
 
 
 if __name__ == "__main__":
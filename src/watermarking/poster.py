@@ -1,11 +1,98 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from atproto import Client, models
+
+from lib.aws.s3 import get_s3_client
+from lib.bs.client import drop_refused_session, get_bot_client
 from lib.log import get_logger
 
 logger = get_logger(__name__)
 
+# clients and threads are kept across the warm invocations of the Lambda container
+s3 = get_s3_client()
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="poster")
+
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def upload_image(client: Client, image: dict) -> dict:
+    """Upload a watermarked image as a blob
+
+    Args:
+        client (Client): Bluesky client
+        image (dict): {bucket, key, alt} of the watermarked image, with its `encode` stats
+
+    Returns:
+        dict: `embed` image and its `bytes`, with the timings in milliseconds
+    """
+    started = time.perf_counter()
+    data = s3.get_object(Bucket=image["bucket"], Key=image["key"])["Body"].read()
+    download_ms = _elapsed_ms(started)
+
+    upload_started = time.perf_counter()
+    blob = client.upload_blob(data).blob
+    aspect_ratio = None
+    encode = image.get("encode")
+    if encode:
+        aspect_ratio = models.AppBskyEmbedDefs.AspectRatio(
+            width=encode["width"], height=encode["height"]
+        )
+    embed = models.AppBskyEmbedImages.Image(
+        alt=image.get("alt", ""), image=blob, aspect_ratio=aspect_ratio
+    )
+    return {
+        "embed": embed,
+        "bytes": len(data),
+        "timings": {"download_ms": download_ms, "upload_ms": _elapsed_ms(upload_started)},
+    }
+
 
 def handler(event, context):
-    """Lambda handler."""
-    return {"message": "OK", "status": 200}
+    """Lambda handler.
+
+    event:
+        uri: URI of the original post
+        cid: CID of the original post
+        images: list of {bucket, key, alt} of the watermarked images, the ones with an `error`
+            are left out
+
+    The watermarked images are posted by the bot, quoting the original post.
+    """
+    started = time.perf_counter()
+    images = [image for image in event["images"] if not image.get("error")]
+    if not images:
+        logger.info(f"No image to post for {event['uri']}")
+        return {"message": "OK", "status": 200, "uri": None}
+
+    with drop_refused_session():
+        client = get_bot_client()
+        uploads = list(executor.map(lambda image: upload_image(client, image), images))
+        record = models.AppBskyEmbedRecord.Main(
+            record=models.ComAtprotoRepoStrongRef.Main(uri=event["uri"], cid=event["cid"])
+        )
+        media = models.AppBskyEmbedImages.Main(images=[upload["embed"] for upload in uploads])
+        post = client.send_post(
+            text="", embed=models.AppBskyEmbedRecordWithMedia.Main(record=record, media=media)
+        )
+
+    elapsed = time.perf_counter() - started
+    uploaded = sum(upload["bytes"] for upload in uploads)
+    mb_per_second = round(uploaded / 1024 / 1024 / elapsed, 2) if elapsed else 0.0
+    logger.info(
+        f"Posted {post.uri} with {len(uploads)} images, {uploaded} bytes in "
+        f"{elapsed * 1000:.1f} ms ({mb_per_second} MB/s)"
+    )
+    return {
+        "message": "OK",
+        "status": 200,
+        "uri": post.uri,
+        "timings": [upload["timings"] for upload in uploads],
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "mb_per_second": mb_per_second,
+    }
 
 
 if __name__ == "__main__":
@@ -0,0 +1,261 @@
+"""Watermark renderer
+
+The watermark of a user is rasterized once into an overlay and composited onto the images with
+NumPy alpha blending. Overlays are kept in an LRU keyed by the settings hash and the size bucket
+of the target image, so warm invocations skip the font rasterization entirely.
+
+Size buckets round the image dimensions up to `SIZE_BUCKET` pixels. An overlay is rendered for
+the bucket dimensions, with a font size derived from the bucket, and cropped to the image around
+its anchor (i.e. the bottom-right corner stays at the bottom-right of the image).
+
+Blending is done on uint16 with the alpha scaled to 0..256:
+    out = (image * (256 - alpha) + color * alpha) >> 8
+which keeps the pixels without watermark unchanged.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+SIZE_BUCKET = 256
+"""Granularity in pixels of the overlay sizes"""
+
+POSITIONS = {
+    "tile": (0.0, 0.0),
+    "top-left": (0.0, 0.0),
+    "top-right": (1.0, 0.0),
+    "center": (0.5, 0.5),
+    "bottom-left": (0.0, 1.0),
+    "bottom-right": (1.0, 1.0),
+}
+"""Anchor of each position, as ratios of the free space on x and y"""
+
+
+@dataclass(frozen=True)
+class WatermarkSettings:
+    """Watermark settings of a user"""
+
+    text: str
+    position: str = "bottom-right"
+    opacity: float = 0.5
+    color: Tuple[int, int, int] = (255, 255, 255)
+    scale: float = 0.04
+    """Font size as a ratio of the short side of the image"""
+    angle: float = 30.0
+    """Rotation of the text in degrees, tile position only"""
+    font_path: Optional[str] = None
+    """TrueType font, the Pillow default font if None"""
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "WatermarkSettings":
+        """Build the settings from a JSON object, unknown keys are ignored"""
+        fields = {k: v for k, v in data.items() if k in cls.__dataclass_fields__}
+        if "color" in fields:
+            fields["color"] = tuple(fields["color"])
+        return cls(**fields)
+
+    def digest(self) -> str:
+        """Stable hash of the settings, used in cache keys"""
+        return hashlib.sha256(json.dumps(asdict(self), sort_keys=True).encode()).hexdigest()
+
+
+@dataclass
+class Overlay:
+    """Pre-rendered watermark of one size bucket"""
+
+    premultiplied: np.ndarray
+    """color * alpha, uint16 (h, w, 3)"""
+    inverse_alpha: np.ndarray
+    """256 - alpha, uint16 (h, w, 1)"""
+    anchor: Tuple[float, float]
+
+    @property
+    def nbytes(self) -> int:
+        return self.premultiplied.nbytes + self.inverse_alpha.nbytes
+
+
+def get_size_bucket(width: int, height: int) -> Tuple[int, int]:
+    """Round the image size up to the size bucket
+
+    Args:
+        width (int): Image width
+        height (int): Image height
+
+    Returns:
+        Tuple[int, int]: Bucket width and height
+    """
+    return (
+        -(-width // SIZE_BUCKET) * SIZE_BUCKET,
+        -(-height // SIZE_BUCKET) * SIZE_BUCKET,
+    )
+
+
+def _load_font(settings: WatermarkSettings, size: int) -> ImageFont.FreeTypeFont:
+    if settings.font_path:
+        return ImageFont.truetype(settings.font_path, size)
+    return ImageFont.load_default(size)
+
+
+def _render_text(settings: WatermarkSettings, font_size: int) -> Image.Image:
+    """Rasterize the text as an RGBA stamp fitted to its bounding box"""
+    font = _load_font(settings, font_size)
+    left, top, right, bottom = font.getbbox(settings.text)
+    # a margin of half the font size keeps the stamp away from the borders
+    margin = font_size // 2
+    # the transparent pixels have the text color, so that resampling does not darken the edges
+    size = (right - left + margin * 2, bottom - top + margin * 2)
+    stamp = Image.new("RGBA", size, (*settings.color, 0))
+    ImageDraw.Draw(stamp).text(
+        (margin - left, margin - top), settings.text, font=font, fill=(*settings.color, 255)
+    )
+    return stamp
+
+
+def render_overlay(settings: WatermarkSettings, bucket: Tuple[int, int]) -> Overlay:
+    """Render the overlay of a size bucket
+
+    Args:
+        settings (WatermarkSettings): Watermark settings
+        bucket (Tuple[int, int]): Bucket width and height, see `get_size_bucket`
+
+    Returns:
+        Overlay: Overlay, sized to the bucket for the tile position, to the stamp otherwise
+    """
+    font_size = max(round(min(bucket) * settings.scale), 8)
+    stamp = _render_text(settings, font_size)
+    anchor = POSITIONS[settings.position]
+
+    if settings.position == "tile":
+        stamp = stamp.rotate(
+            settings.angle,
+            expand=True,
+            resample=Image.BICUBIC,
+            fillcolor=(*settings.color, 0),
+        )
+        tile = np.asarray(stamp)
+        reps = (-(-bucket[1] // tile.shape[0]), -(-bucket[0] // tile.shape[1]), 1)
+        rgba = np.tile(tile, reps)[: bucket[1], : bucket[0]]
+    else:
+        rgba = np.asarray(stamp)
+
+    # alpha 0..255 scaled to 0..256 with the opacity, so that a full alpha replaces the pixel
+    alpha = rgba[..., 3:4].astype(np.uint16)
+    alpha += alpha >> 7
+    alpha = np.round(alpha * settings.opacity).astype(np.uint16)
+    premultiplied = rgba[..., :3].astype(np.uint16) * alpha
+    return Overlay(premultiplied, 256 - alpha, anchor)
+
+
+class OverlayCache:
+    """LRU of the rendered overlays, bounded by their total size
+
+    Thread safe. Overlays missing in concurrent calls are rendered outside of the lock, the
+    images of a post being of different size buckets most of the time.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        """
+        Args:
+            max_bytes (int): Max total size of the cached overlays
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._overlays: OrderedDict[Tuple[str, Tuple[int, int]], Overlay] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, settings: WatermarkSettings, bucket: Tuple[int, int]) -> Overlay:
+        """Get the overlay of the size bucket, rendering it on a miss
+
+        Args:
+            settings (WatermarkSettings): Watermark settings
+            bucket (Tuple[int, int]): Bucket width and height
+
+        Returns:
+            Overlay: Overlay
+        """
+        key = (settings.digest(), bucket)
+        with self._lock:
+            overlay = self._overlays.get(key)
+            if overlay is not None:
+                self._overlays.move_to_end(key)
+                self.hits += 1
+                return overlay
+            self.misses += 1
+
+        overlay = render_overlay(settings, bucket)
+        with self._lock:
+            if key in self._overlays:
+                # rendered by a concurrent call meanwhile
+                return self._overlays[key]
+            self._overlays[key] = overlay
+            self.size += overlay.nbytes
+            while self.size > self.max_bytes and len(self._overlays) > 1:
+                _, evicted = self._overlays.popitem(last=False)
+                self.size -= evicted.nbytes
+        return overlay
+
+
+def composite(image: np.ndarray, overlay: Overlay) -> np.ndarray:
+    """Blend the overlay onto the image in place
+
+    Args:
+        image (np.ndarray): uint8 (h, w, 3) or (h, w, 4) pixels, the alpha channel is kept as is
+        overlay (Overlay): Overlay
+
+    Returns:
+        np.ndarray: The image
+    """
+    height, width = image.shape[:2]
+    overlay_height, overlay_width = overlay.inverse_alpha.shape[:2]
+    # the overlay is cropped around its anchor when it is larger than the image,
+    # and placed at its anchor when it is smaller
+    ax, ay = overlay.anchor
+    ox = round((overlay_width - width) * ax) if overlay_width > width else 0
+    oy = round((overlay_height - height) * ay) if overlay_height > height else 0
+    ix = round((width - overlay_width) * ax) if overlay_width < width else 0
+    iy = round((height - overlay_height) * ay) if overlay_height < height else 0
+    w = min(width, overlay_width)
+    h = min(height, overlay_height)
+
+    region = image[iy : iy + h, ix : ix + w, :3]
+    blended = region.astype(np.uint16)
+    blended *= overlay.inverse_alpha[oy : oy + h, ox : ox + w]
+    blended += overlay.premultiplied[oy : oy + h, ox : ox + w]
+    blended >>= 8
+    region[...] = blended
+    return image
+
+
+class WatermarkRenderer:
+    """Apply the watermark of a user to images"""
+
+    def __init__(self, cache: Optional[OverlayCache] = None):
+        """
+        Args:
+            cache (Optional[OverlayCache]): Overlay cache, shared by the invocations
+        """
+        self.cache = cache or OverlayCache()
+
+    def apply(self, image: Image.Image, settings: WatermarkSettings) -> Image.Image:
+        """Watermark the image
+
+        Args:
+            image (Image.Image): Image to watermark
+            settings (WatermarkSettings): Watermark settings
+
+        Returns:
+            Image.Image: Watermarked image, RGB or RGBA
+        """
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        pixels = np.array(image)
+        overlay = self.cache.get(settings, get_size_bucket(image.width, image.height))
+        return Image.fromarray(composite(pixels, overlay), image.mode)
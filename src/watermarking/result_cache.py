@@ -0,0 +1,107 @@
+"""Content-addressed cache of the watermarked images
+
+Blobs are immutable and identified by their CID, so the watermarked image of a blob only
+depends on the CID, the watermark settings and the limits of the encoded image. Results are
+stored in the watermarked images bucket under `results/<blob CID>/<settings hash>`, the hash
+covering the settings and `ENCODE_LIMITS`, and looked up with a HEAD request before anything is
+downloaded or rendered. Re-posted and duplicated images cost one HEAD request. Changing a limit
+makes the previous results misses, instead of serving images over the new limits.
+
+The limits are read from the environment here, so that the getter and the watermarker build
+the same keys.
+
+Entries are evicted by the lifecycle rule of the bucket (`image_expiration_days`).
+"""
+
+import hashlib
+import json
+import os
+import threading
+from typing import Optional
+
+from botocore.exceptions import ClientError
+
+from watermarking import decoder
+from watermarking.encoder import MAX_BLOB_BYTES, MAX_QUALITY, MIN_QUALITY
+from watermarking.renderer import WatermarkSettings
+
+PREFIX = "results"
+
+MAX_BYTES = int(os.getenv("WATERMARK_MAX_BYTES", MAX_BLOB_BYTES))
+"""Size limit of the watermarked images"""
+MAX_SIDE = int(os.getenv("WATERMARK_MAX_SIDE", decoder.MAX_SIDE))
+"""Long side of the watermarked images, larger sources are decoded at a reduced resolution"""
+ENCODE_LIMITS = {
+    "max_bytes": MAX_BYTES,
+    "max_side": MAX_SIDE,
+    "min_quality": MIN_QUALITY,
+    "max_quality": MAX_QUALITY,
+}
+"""Limits the watermarked images are encoded within, part of the result keys"""
+
+SETTINGS_HASH_LENGTH = 16
+"""Hex characters of the settings hash kept in the keys"""
+
+
+def get_result_key(cid: str, settings: WatermarkSettings, limits: dict = ENCODE_LIMITS) -> str:
+    """Get the key of the watermarked image of a blob
+
+    Args:
+        cid (str): Blob CID
+        settings (WatermarkSettings): Watermark settings
+        limits (dict): Limits of the encoded image
+
+    Returns:
+        str: Object key
+    """
+    data = json.dumps({"settings": settings.digest(), "limits": limits}, sort_keys=True)
+    digest = hashlib.sha256(data.encode()).hexdigest()
+    return f"{PREFIX}/{cid}/{digest[:SETTINGS_HASH_LENGTH]}"
+
+
+class ResultCache:
+    """Lookup of the watermarked images by blob CID and settings"""
+
+    def __init__(self, s3, bucket: str):
+        """
+        Args:
+            s3: boto3 S3 client
+            bucket (str): Watermarked images bucket
+        """
+        self._s3 = s3
+        self.bucket = bucket
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        """Lookup counters, as reported in the handler responses"""
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hit_rate, 3)}
+
+    def lookup(self, cid: str, settings: WatermarkSettings) -> Optional[dict]:
+        """Check whether the blob has already been watermarked with the settings
+
+        Args:
+            cid (str): Blob CID
+            settings (WatermarkSettings): Watermark settings
+
+        Returns:
+            Optional[dict]: {bucket, key} of the watermarked image, None on a miss
+        """
+        key = get_result_key(cid, settings)
+        try:
+            self._s3.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                with self._lock:
+                    self.misses += 1
+                return None
+            raise
+        with self._lock:
+            self.hits += 1
+        return {"bucket": self.bucket, "key": key}
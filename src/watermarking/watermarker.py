@@ -1,11 +1,179 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+from lib.aws.s3 import get_s3_client
 from lib.log import get_logger
+from lib.memory import get_peak_rss_mb, reset_peak_rss
+from watermarking.decoder import (
+    MAX_SOURCE_BYTES,
+    MAX_SOURCE_PIXELS,
+    DECODE_ERRORS,
+    DecodeInfo,
+    decode,
+)
+from watermarking.encoder import EncodeResult, encode
+from watermarking.renderer import OverlayCache, WatermarkRenderer, WatermarkSettings
+from watermarking.result_cache import MAX_BYTES, MAX_SIDE, ResultCache, get_result_key
 
 logger = get_logger(__name__)
 
+MAX_WORKERS = int(os.getenv("WATERMARK_MAX_WORKERS", 4))
+"""Images of a post processed concurrently, a post carries up to 4 images"""
+MAX_SOURCE_PIXELS = int(os.getenv("WATERMARK_MAX_SOURCE_PIXELS", MAX_SOURCE_PIXELS))
+MAX_SOURCE_BYTES = int(os.getenv("WATERMARK_MAX_SOURCE_BYTES", MAX_SOURCE_BYTES))
+
+# overlays, clients and threads are kept across the warm invocations of the Lambda container
+renderer = WatermarkRenderer(
+    OverlayCache(int(os.getenv("WATERMARK_OVERLAY_CACHE_BYTES", 256 * 1024 * 1024)))
+)
+s3 = get_s3_client()
+result_cache = ResultCache(s3, os.getenv("WATERMARKED_IMAGE_BUCKET"))
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="watermarker")
+
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def watermark_image(data: bytes, settings: WatermarkSettings) -> Tuple[EncodeResult, DecodeInfo]:
+    """Watermark an encoded image
+
+    Args:
+        data (bytes): Encoded image
+        settings (WatermarkSettings): Watermark settings
+
+    Raises:
+        ImageTooLargeError: The image is over the source caps
+        OSError: The image is corrupt or of an unsupported format, see `DECODE_ERRORS`
+
+    Returns:
+        Tuple[EncodeResult, DecodeInfo]: Watermarked image encoded under the size limit, and
+            the decode stats
+    """
+    image, decoded = decode(data, MAX_SIDE, MAX_SOURCE_PIXELS, MAX_SOURCE_BYTES)
+    watermarked = renderer.apply(image, settings)
+    return encode(watermarked, decoded.format, len(data), MAX_BYTES), decoded
+
+
+def process_image(image: dict, settings: WatermarkSettings, output_bucket: str) -> dict:
+    """Download, watermark and upload an image
+
+    Images with a `cid` are looked up in the result cache first, unless the getter did already
+    (`result` key), and are written under their content-addressed key.
+
+    Args:
+        image (dict): {bucket, key} of the source image, optionally {cid, result}
+        settings (WatermarkSettings): Watermark settings
+        output_bucket (str): Bucket of the watermarked image, written under the same key as the
+            source image when it has no CID
+
+    Returns:
+        dict: {bucket, key} of the watermarked image with the {cid, alt} of the source, whether
+            it was `cached`, the `bytes` downloaded, its `decode` and `encode` stats and its
+            timings in milliseconds. The images refused by the decoder, over the caps or
+            corrupt, get the source {bucket, key} and an `error`, the other images of the post
+            being posted without them.
+    """
+    started = time.perf_counter()
+    cid = image.get("cid")
+    # kept for the poster
+    meta = {k: image[k] for k in ("cid", "alt") if k in image}
+    if cid is not None:
+        result = image["result"] if "result" in image else result_cache.lookup(cid, settings)
+        if result is not None:
+            timings = {"total_ms": _elapsed_ms(started)}
+            return {**meta, **result, "cached": True, "bytes": 0, "timings": timings}
+
+    data = s3.get_object(Bucket=image["bucket"], Key=image["key"])["Body"].read()
+    download_ms = _elapsed_ms(started)
+
+    render_started = time.perf_counter()
+    try:
+        encoded, decoded = watermark_image(data, settings)
+    except DECODE_ERRORS as e:
+        logger.warning(f"Skipped {image['key']}: {type(e).__name__}: {e}")
+        return {
+            **meta,
+            "bucket": image["bucket"],
+            "key": image["key"],
+            "cached": False,
+            "bytes": len(data),
+            "error": f"{type(e).__name__}: {e}",
+            "timings": {"download_ms": download_ms, "total_ms": _elapsed_ms(started)},
+        }
+    render_ms = _elapsed_ms(render_started)
+
+    upload_started = time.perf_counter()
+    key = image["key"] if cid is None else get_result_key(cid, settings)
+    s3.put_object(Bucket=output_bucket, Key=key, Body=encoded.data, ContentType=encoded.mime_type)
+    upload_ms = _elapsed_ms(upload_started)
+    return {
+        **meta,
+        "bucket": output_bucket,
+        "key": key,
+        "cached": False,
+        "bytes": len(data),
+        "decode": decoded.stats(),
+        "encode": encoded.stats(),
+        "timings": {
+            "download_ms": download_ms,
+            "render_ms": render_ms,
+            "upload_ms": upload_ms,
+            "total_ms": _elapsed_ms(started),
+        },
+    }
+
 
 def handler(event, context):
-    """Lambda handler."""
-    return {"message": "OK", "status": 200}
+    """Lambda handler.
+
+    event:
+        watermark: watermark settings, see `WatermarkSettings`
+        images: list of {bucket, key} of the source images, with {cid, result} when they come
+            from the getter
+        output_bucket: bucket of the watermarked images
+    """
+    started = time.perf_counter()
+    reset_peak_rss()
+    settings = WatermarkSettings.from_dict(event["watermark"])
+    # Pillow and NumPy release the GIL while decoding, compositing and encoding,
+    # so the post takes about as long as its slowest image
+    outputs = list(
+        executor.map(
+            lambda image: process_image(image, settings, event["output_bucket"]),
+            event["images"],
+        )
+    )
+    elapsed_ms = _elapsed_ms(started)
+    downloaded = sum(output["bytes"] for output in outputs)
+    mb_per_second = round(downloaded / 1024 / 1024 / elapsed_ms * 1000, 2) if elapsed_ms else 0.0
+    # to size the memory of the Lambda
+    peak_rss_mb = round(get_peak_rss_mb(), 1)
+    hits = sum(output["cached"] for output in outputs)
+    cache = renderer.cache
+    logger.info(
+        f"Watermarked {len(outputs) - hits} images and reused {hits} in {elapsed_ms} ms "
+        f"({mb_per_second} MB/s), "
+        f"peak RSS {peak_rss_mb} MiB, "
+        f"slowest {max((o['timings']['total_ms'] for o in outputs), default=0)} ms, "
+        f"overlay cache {cache.hits=} {cache.misses=}, result cache {result_cache.stats()}"
+    )
+    return {
+        **event,
+        "message": "OK",
+        "status": 200,
+        "images": outputs,
+        "elapsed_ms": elapsed_ms,
+        "mb_per_second": mb_per_second,
+        "peak_rss_mb": peak_rss_mb,
+        "result_cache": {
+            "hits": hits,
+            "misses": len(outputs) - hits,
+            "hit_rate": round(hits / len(outputs), 3) if outputs else 0.0,
+        },
+    }
 
 
 if __name__ == "__main__":
@@ -0,0 +1,211 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import boto3
+from atproto import models
+from moto import mock_aws
+
+from src.lib.bs.dms import (
+    SIGNOUT,
+    SIGNUP,
+    CursorStore,
+    DmLogReader,
+    S3CursorStore,
+    get_command,
+    read_dm_log,
+)
+from src.lib.bs import flows
+
+BOT_DID = "did:plc:bot"
+
+
+def _message(rev: int, sender: str, text: str):
+    return models.ChatBskyConvoDefs.LogCreateMessage(
+        convo_id=f"convo-{sender}",
+        rev=str(rev),
+        message=models.ChatBskyConvoDefs.MessageView(
+            id=f"msg-{rev}",
+            rev=str(rev),
+            sender=models.ChatBskyConvoDefs.MessageViewSender(did=sender),
+            sent_at="2024-01-01T00:00:00Z",
+            text=text,
+        ),
+    )
+
+
+class FakeChatLog:
+    """Stand-in of the chat service serving `getLog` pages after a cursor"""
+
+    def __init__(self, page_size: int = 2):
+        self.page_size = page_size
+        self.events = []
+        self.requests = 0
+        self.chat = SimpleNamespace(
+            bsky=SimpleNamespace(convo=SimpleNamespace(get_log=self.get_log))
+        )
+
+    def add(self, event) -> None:
+        self.events.append(event)
+
+    def get_log(self, params):
+        self.requests += 1
+        cursor = int(params.cursor) if params.cursor else 0
+        logs = [e for e in self.events if int(e.rev) > cursor][: self.page_size]
+        return SimpleNamespace(logs=logs, cursor=logs[-1].rev if logs else params.cursor)
+
+
+class MemoryStore(CursorStore):
+    def __init__(self, cursor=None):
+        self.cursor = cursor
+
+    def load(self):
+        return self.cursor
+
+    def save(self, cursor):
+        self.cursor = cursor
+
+
+class TestGetCommand(unittest.TestCase):
+    def test_commands(self):
+        self.assertEqual(get_command("signup"), SIGNUP)
+        self.assertEqual(get_command("  Sign  Up please"), SIGNUP)
+        self.assertEqual(get_command("登録"), SIGNUP)
+        self.assertEqual(get_command("SIGNOUT"), SIGNOUT)
+        self.assertEqual(get_command("解除"), SIGNOUT)
+
+    def test_other_messages(self):
+        self.assertIsNone(get_command("hello"))
+        self.assertIsNone(get_command("signups are open?"))
+        self.assertIsNone(get_command(""))
+
+
+class TestReadDmLog(unittest.TestCase):
+    def setUp(self):
+        self.chat = FakeChatLog()
+        self.chat.add(_message(1, "did:plc:alice", "signup"))
+        self.chat.add(_message(2, BOT_DID, "welcome"))
+        self.chat.add(models.ChatBskyConvoDefs.LogBeginConvo(convo_id="convo-bob", rev="3"))
+        self.chat.add(_message(4, "did:plc:bob", "signout"))
+
+    def test_reads_all_pages(self):
+        log = read_dm_log(self.chat, None, BOT_DID)
+        self.assertEqual([m.sender_did for m in log.messages], ["did:plc:alice", "did:plc:bob"])
+        self.assertEqual(log.scanned, 4)
+        self.assertEqual(log.cursor, "4")
+        self.assertTrue(log.complete)
+
+    def test_resumes_from_cursor(self):
+        log = read_dm_log(self.chat, "2", BOT_DID)
+        self.assertEqual([m.message_id for m in log.messages], ["msg-4"])
+        self.assertEqual(log.scanned, 2)
+
+    def test_max_pages(self):
+        log = read_dm_log(self.chat, None, BOT_DID, max_pages=1)
+        self.assertFalse(log.complete)
+        self.assertEqual(log.cursor, "2")
+        self.assertEqual(log.scanned, 2)
+
+    def test_skips_deleted_messages(self):
+        self.chat.add(
+            models.ChatBskyConvoDefs.LogCreateMessage(
+                convo_id="convo-carol",
+                rev="5",
+                message=models.ChatBskyConvoDefs.DeletedMessageView(
+                    id="msg-5",
+                    rev="5",
+                    sender=models.ChatBskyConvoDefs.MessageViewSender(did="did:plc:carol"),
+                    sent_at="2024-01-01T00:00:00Z",
+                ),
+            )
+        )
+        log = read_dm_log(self.chat, "4", BOT_DID)
+        self.assertEqual(log.messages, [])
+        self.assertEqual(log.scanned, 1)
+
+
+class TestDmLogReader(unittest.TestCase):
+    def test_scans_only_new_events(self):
+        chat = FakeChatLog(page_size=50)
+        reader = DmLogReader(MemoryStore())
+        for rev in range(1, 201):
+            chat.add(_message(rev, f"did:plc:user{rev}", "hello"))
+        reader.commit(reader.read(chat, BOT_DID))
+
+        chat.add(_message(201, "did:plc:new", "signup"))
+        log = reader.read(chat, BOT_DID)
+        self.assertEqual(log.scanned, 1)
+        self.assertEqual(log.messages[0].to_item(SIGNUP)["did"], "did:plc:new")
+
+    def test_cursor_is_saved_on_commit_only(self):
+        chat = FakeChatLog()
+        chat.add(_message(1, "did:plc:alice", "signup"))
+        store = MemoryStore()
+        reader = DmLogReader(store)
+        log = reader.read(chat, BOT_DID)
+        self.assertIsNone(store.cursor)
+        reader.commit(log)
+        self.assertEqual(store.cursor, "1")
+
+
+class TestS3CursorStore(unittest.TestCase):
+    @mock_aws
+    def test_load_save(self):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="userinfo")
+        store = S3CursorStore("userinfo", "dms/signup-cursor")
+        self.assertIsNone(store.load())
+        store.save("abc")
+        self.assertEqual(store.load(), "abc")
+
+
+class TestExecute(unittest.TestCase):
+    def _patch(self, chat, store: CursorStore, start_batches: mock.Mock) -> None:
+        client = mock.Mock()
+        client.me.did = BOT_DID
+        client.with_bsky_chat_proxy.return_value = chat
+        for patch in (
+            mock.patch.object(flows, "get_bot_client", return_value=client),
+            mock.patch.object(flows, "get_cursor_store", return_value=store),
+            mock.patch.object(flows, "start_batches", start_batches),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_hands_off_commands(self):
+        chat = FakeChatLog()
+        chat.add(_message(1, "did:plc:alice", "signup"))
+        chat.add(_message(2, "did:plc:bob", "signout"))
+        chat.add(_message(3, "did:plc:carol", "hello"))
+        start_batches = mock.Mock(
+            side_effect=lambda arn, items, *args: "arn:execution" if items else None
+        )
+        store = MemoryStore()
+        self._patch(chat, store, start_batches)
+
+        result = flows.execute(SIGNUP, "arn:signup", "s3://userinfo/dms/signup-cursor")
+        self.assertEqual(result["items"], 1)
+        self.assertEqual((result["batches"], result["execution_arn"]), (1, "arn:execution"))
+        self.assertEqual(result["dm_log"]["scanned"], 3)
+        arn, items = start_batches.call_args.args[:2]
+        self.assertEqual(arn, "arn:signup")
+        self.assertEqual([(i["command"], i["did"]) for i in items], [(SIGNUP, "did:plc:alice")])
+        self.assertEqual(store.cursor, "3")
+
+        # nothing new, no execution
+        result = flows.execute(SIGNUP, "arn:signup", "s3://userinfo/dms/signup-cursor")
+        self.assertEqual(result["dm_log"]["scanned"], 0)
+        self.assertEqual((result["batches"], result["execution_arn"]), (0, None))
+
+    def test_cursor_kept_when_handoff_fails(self):
+        chat = FakeChatLog()
+        chat.add(_message(1, "did:plc:bob", "signout"))
+        store = MemoryStore()
+
+        self._patch(chat, store, mock.Mock(side_effect=RuntimeError("throttled")))
+        with self.assertRaises(RuntimeError):
+            flows.execute(SIGNOUT, "arn:signout", "s3://userinfo/dms/signout-cursor")
+        self.assertIsNone(store.cursor)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import random
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest import mock
+
+from atproto_client.exceptions import UnauthorizedError
+
+from src.lib.bs import flows
+from src.lib.bs.notifier import FAILED, SENT, SKIPPED, ConvoCache, DmNotifier, count_statuses
+
+
+class FakeChat:
+    """Stand-in of the chat service recording the sent messages"""
+
+    def __init__(self, delay: float = 0.0, failing: set = frozenset()):
+        self.delay = delay
+        self.failing = failing
+        self.sent = []
+        self.lookups = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(
+            bsky=SimpleNamespace(
+                convo=SimpleNamespace(
+                    get_convo_for_members=self.get_convo_for_members,
+                    send_message=self.send_message,
+                )
+            )
+        )
+
+    def get_convo_for_members(self, params):
+        did = params.members[0]
+        with self._lock:
+            self.lookups.append(did)
+        if did == "did:plc:blocked":
+            raise RuntimeError("blocked")
+        return SimpleNamespace(convo=SimpleNamespace(id=f"convo-{did}"))
+
+    def send_message(self, data):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        # random delays would reorder the messages of a conversation if it was not sequential
+        time.sleep(self.delay * random.random())
+        with self._lock:
+            self.active -= 1
+            if data.message.text in self.failing:
+                raise RuntimeError("rate limited")
+            self.sent.append((data.convo_id, data.message.text))
+            return SimpleNamespace(id=f"msg-{len(self.sent)}")
+
+
+class TestDmNotifier(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_order_within_conversations(self):
+        chat = FakeChat(delay=0.01)
+        notifier = DmNotifier(chat, ConvoCache(), self.executor)
+        messages = [{"did": f"did:plc:user{i % 4}", "text": str(i)} for i in range(20)]
+        results = notifier.send(messages)
+
+        self.assertEqual(count_statuses(results), {SENT: 20, FAILED: 0, SKIPPED: 0})
+        self.assertEqual([r["text"] for r in results], [str(i) for i in range(20)])
+        for user in range(4):
+            texts = [text for convo, text in chat.sent if convo == f"convo-did:plc:user{user}"]
+            self.assertEqual(texts, [str(i) for i in range(user, 20, 4)])
+        self.assertGreater(chat.max_active, 1)
+        # one lookup per user
+        self.assertEqual(sorted(chat.lookups), [f"did:plc:user{i}" for i in range(4)])
+
+    def test_convo_cache_and_known_convos(self):
+        chat = FakeChat()
+        cache = ConvoCache()
+        notifier = DmNotifier(chat, cache, self.executor)
+        notifier.send([{"did": "did:plc:alice", "text": "1"}])
+        notifier.send(
+            [
+                {"did": "did:plc:alice", "text": "2"},
+                {"did": "did:plc:bob", "convo_id": "convo-from-log", "text": "3"},
+            ]
+        )
+        self.assertEqual(chat.lookups, ["did:plc:alice"])
+        self.assertEqual(cache.hits, 1)
+        self.assertIn(("convo-from-log", "3"), chat.sent)
+
+    def test_failures_keep_the_order(self):
+        chat = FakeChat(failing={"2"})
+        notifier = DmNotifier(chat, ConvoCache(), self.executor)
+        results = notifier.send(
+            [
+                {"did": "did:plc:alice", "text": "1"},
+                {"did": "did:plc:alice", "text": "2"},
+                {"did": "did:plc:alice", "text": "3"},
+                {"did": "did:plc:bob", "text": "4"},
+                {"did": "did:plc:blocked", "text": "5"},
+            ]
+        )
+        self.assertEqual([r["status"] for r in results], [SENT, FAILED, SKIPPED, SENT, FAILED])
+        self.assertNotIn(("convo-did:plc:alice", "3"), chat.sent)
+
+    def test_refused_session_fails_the_batch(self):
+        chat = FakeChat()
+        chat.chat.bsky.convo.send_message = mock.Mock(side_effect=UnauthorizedError())
+        notifier = DmNotifier(chat, ConvoCache(), self.executor)
+        with self.assertRaises(UnauthorizedError):
+            notifier.send([{"did": "did:plc:alice", "text": "1"}])
+
+
+class TestNotify(unittest.TestCase):
+    def _notify(self, chat: FakeChat, items: list):
+        client = mock.Mock()
+        client.with_bsky_chat_proxy.return_value = chat
+        with mock.patch.object(flows, "get_bot_client", return_value=client) as get_bot_client:
+            result = flows.notify(items, "welcome")
+        get_bot_client.assert_called_once()
+        return result
+
+    def test_one_login_per_batch(self):
+        chat = FakeChat()
+        items = [{"did": f"did:plc:user{i}", "convo_id": None} for i in range(25)]
+        result = self._notify(chat, items)
+        self.assertEqual(result["sent"], 25)
+        self.assertEqual(len(chat.sent), 25)
+        self.assertNotIn("text", result["results"][0])
+
+    def test_returns_the_users_not_notified(self):
+        chat = FakeChat()
+        items = [{"did": "did:plc:alice"}, {"did": "did:plc:blocked"}]
+        with self.assertLogs(flows.logger, "ERROR") as logs:
+            result = self._notify(chat, items)
+        self.assertEqual((result["status"], result["sent"]), (200, 1))
+        self.assertEqual(result["failed_dids"], ["did:plc:blocked"])
+        self.assertTrue(logs.output[0].split(":", 2)[2].startswith(flows.NOTIFY_FAILED))
+        self.assertEqual(chat.sent, [("convo-did:plc:alice", "welcome")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import time
+import unittest
+from unittest import mock
+
+import httpx
+from atproto_client.client.base import ClientBase
+from atproto_client.exceptions import BadRequestError, NetworkError, RequestException
+from atproto_client.request import Response
+
+from src.lib.bs.ratelimit import (
+    CHAT,
+    DEFAULT,
+    WRITE,
+    RateLimitedClient,
+    RateLimiter,
+    TokenBucket,
+    get_endpoint_class,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+def _response(status: int, headers: dict = None) -> Response:
+    return Response(success=status < 300, status_code=status, content={}, headers=headers or {})
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst_then_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2.0, 2, clock=clock, sleep=clock.sleep)
+        self.assertEqual([bucket.acquire() for _ in range(2)], [0.0, 0.0])
+        self.assertAlmostEqual(bucket.acquire(), 0.5)
+
+    def test_observe_spreads_remaining_until_reset(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10.0, 10, clock=clock, sleep=clock.sleep)
+        bucket.observe(remaining=2, reset=clock.now + 10)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertAlmostEqual(bucket.acquire(), 5.0)
+        # the configured rate is back after the reset
+        clock.now += 10
+        bucket.acquire()
+        self.assertEqual(bucket._current_rate(clock.now), 10.0)
+
+
+class TestRateLimitedClient(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.client = RateLimitedClient()
+        self.client.limiter = RateLimiter(clock=self.clock, sleep=self.clock.sleep)
+        patch = mock.patch("src.lib.bs.ratelimit.time.sleep")
+        self.sleep = patch.start()
+        self.addCleanup(patch.stop)
+
+    def _invoke(self, responses: list, nsid: str = "com.atproto.repo.createRecord"):
+        with mock.patch.object(ClientBase, "_invoke", side_effect=responses) as invoke:
+            try:
+                return self.client.invoke_procedure(nsid)
+            finally:
+                self.calls = invoke.call_count
+
+    def test_endpoint_classes(self):
+        self.assertEqual(get_endpoint_class("com.atproto.repo.createRecord"), WRITE)
+        self.assertEqual(get_endpoint_class("chat.bsky.convo.sendMessage"), CHAT)
+        self.assertEqual(get_endpoint_class("app.bsky.actor.getProfile"), DEFAULT)
+
+    def test_retry_after_reset_on_429(self):
+        reset = str(time.time() + 2)
+        limited = _response(429, {"ratelimit-remaining": "0", "ratelimit-reset": reset})
+        response = self._invoke([RequestException(limited), _response(200)])
+        self.assertEqual((response.status_code, self.calls), (200, 2))
+        delay = self.sleep.call_args.args[0]
+        self.assertTrue(1.0 < delay <= 2.5)
+
+    def test_retries_exhausted(self):
+        self.client.max_retries = 2
+        with self.assertRaises(RequestException):
+            self._invoke([RequestException(_response(503))] * 3, "app.bsky.actor.getProfile")
+        self.assertEqual(self.calls, 3)
+
+    def test_writes_not_retried_on_5xx_or_lost_response(self):
+        with self.assertRaises(RequestException):
+            self._invoke([RequestException(_response(502)), _response(200)])
+        self.assertEqual(self.calls, 1)
+
+        lost = NetworkError()
+        lost.__cause__ = httpx.ReadError("connection reset")
+        with self.assertRaises(NetworkError):
+            self._invoke([lost, _response(200)], "com.atproto.repo.uploadBlob")
+        self.assertEqual(self.calls, 1)
+
+    def test_writes_retried_when_not_sent(self):
+        refused = NetworkError()
+        refused.__cause__ = httpx.ConnectError("connection refused")
+        response = self._invoke([refused, _response(200)])
+        self.assertEqual((response.status_code, self.calls), (200, 2))
+
+    def test_client_errors_not_retried(self):
+        with self.assertRaises(BadRequestError):
+            self._invoke([BadRequestError(_response(400))])
+        self.assertEqual(self.calls, 1)
+
+    def test_headers_throttle_the_bucket(self):
+        reset = str(self.clock.now + 100)
+        self._invoke([_response(200, {"ratelimit-remaining": "10", "ratelimit-reset": reset})])
+        bucket = self.client.limiter.buckets[WRITE]
+        self.assertAlmostEqual(bucket._current_rate(self.clock.now), 0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+import boto3
+from moto import mock_aws
+
+from src.lib.bs.resolver import CachingResolver, S3ResolverStore, SqliteResolverStore
+
+_DOCUMENT = {
+    "id": "did:plc:alice",
+    "alsoKnownAs": ["at://alice.example"],
+    "verificationMethod": [],
+    "service": [
+        {
+            "id": "#atproto_pds",
+            "type": "AtprotoPersonalDataServer",
+            "serviceEndpoint": "https://pds.example",
+        }
+    ],
+}
+
+
+class FakeIdResolver:
+    """Stand-in of `IdResolver` counting the network resolutions"""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+        self.handle = SimpleNamespace(resolve=self._resolve_handle)
+        self.did = SimpleNamespace(resolve_without_validation=self._resolve_did)
+
+    def _record(self, identifier):
+        with self._lock:
+            self.calls.append(identifier)
+        time.sleep(self.delay)
+
+    def _resolve_handle(self, handle):
+        self._record(handle)
+        if handle == "broken.example":
+            raise ConnectionError("timeout")
+        return "did:plc:alice" if handle == "alice.example" else None
+
+    def _resolve_did(self, did):
+        self._record(did)
+        return _DOCUMENT if did == "did:plc:alice" else None
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCachingResolver(unittest.TestCase):
+    def setUp(self):
+        self.network = FakeIdResolver()
+        self.clock = FakeClock()
+        self.resolver = CachingResolver(
+            id_resolver=self.network, ttl=3600, negative_ttl=60, clock=self.clock
+        )
+
+    def test_memory_layer(self):
+        self.assertEqual(self.resolver.resolve_handle("Alice.example"), "did:plc:alice")
+        self.assertEqual(self.resolver.resolve_handle("alice.example"), "did:plc:alice")
+        self.assertEqual(self.network.calls, ["alice.example"])
+        stats = self.resolver.stats()
+        self.assertEqual((stats["memory_hits"], stats["misses"]), (1, 1))
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+    def test_atproto_data(self):
+        data = self.resolver.resolve_atproto_data("did:plc:alice")
+        self.assertEqual(data.pds, "https://pds.example")
+        self.assertEqual(data.handle, "alice.example")
+        self.assertIsNone(self.resolver.resolve_atproto_data("did:plc:unknown"))
+
+    def test_negative_caching(self):
+        self.assertIsNone(self.resolver.resolve_handle("nobody.example"))
+        self.assertIsNone(self.resolver.resolve_handle("nobody.example"))
+        self.assertEqual(len(self.network.calls), 1)
+        self.assertEqual(self.resolver.stats()["negative_hits"], 1)
+
+        # not found expires sooner than found
+        self.resolver.resolve_handle("alice.example")
+        self.clock.now += 120
+        self.resolver.resolve_handle("nobody.example")
+        self.resolver.resolve_handle("alice.example")
+        self.assertEqual(self.network.calls.count("nobody.example"), 2)
+        self.assertEqual(self.network.calls.count("alice.example"), 1)
+
+    def test_errors_are_not_cached(self):
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.resolver.resolve_handle("broken.example")
+        self.assertEqual(len(self.network.calls), 2)
+        self.assertEqual(self.resolver.stats()["errors"], 2)
+
+    def test_resolve_many(self):
+        network = FakeIdResolver(delay=0.05)
+        resolver = CachingResolver(id_resolver=network)
+        identifiers = ["alice.example", "did:plc:alice", "nobody.example"] * 3
+        started = time.perf_counter()
+        results = resolver.resolve_many(identifiers)
+        elapsed = time.perf_counter() - started
+        self.assertEqual(results["alice.example"], "did:plc:alice")
+        self.assertEqual(results["did:plc:alice"], _DOCUMENT)
+        self.assertIsNone(results["nobody.example"])
+        self.assertEqual(len(network.calls), 3)
+        # resolved concurrently
+        self.assertLess(elapsed, 0.14)
+
+
+class TestSharedStores(unittest.TestCase):
+    def test_sqlite_store_is_shared_by_the_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "resolver.db")
+            network = FakeIdResolver()
+            CachingResolver(SqliteResolverStore(path), network).resolve_did("did:plc:alice")
+            CachingResolver(SqliteResolverStore(path), network).resolve_handle("nobody.example")
+
+            # a new process, e.g. a restarted task
+            resolver = CachingResolver(SqliteResolverStore(path), network)
+            self.assertEqual(resolver.resolve_did("did:plc:alice"), _DOCUMENT)
+            self.assertIsNone(resolver.resolve_handle("nobody.example"))
+            self.assertEqual(len(network.calls), 2)
+            self.assertEqual(resolver.stats()["store_hits"], 2)
+
+    @mock_aws
+    def test_s3_store_survives_cold_starts(self):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="userinfo")
+        network = FakeIdResolver()
+        first = CachingResolver(S3ResolverStore("userinfo", "resolver/cache.json"), network)
+        second = CachingResolver(S3ResolverStore("userinfo", "resolver/cache.json"), network)
+        # both containers load the object before the other flushes
+        first.resolve_did("did:plc:alice")
+        second.resolve_handle("alice.example")
+        first.flush()
+        second.flush()
+
+        cold = CachingResolver(S3ResolverStore("userinfo", "resolver/cache.json"), network)
+        self.assertEqual(cold.resolve_did("did:plc:alice"), _DOCUMENT)
+        self.assertEqual(cold.resolve_handle("alice.example"), "did:plc:alice")
+        self.assertEqual(len(network.calls), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+import base64
+import inspect
+import itertools
+import json
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import boto3
+from atproto import Session, SessionEvent
+from atproto_client.exceptions import BadRequestError, NetworkError, UnauthorizedError
+from cryptography.fernet import Fernet
+from moto import mock_aws
+
+from src.lib.bs import client as bs_client
+from src.lib.bs.ratelimit import RateLimitedClient
+from src.lib.bs.session import (
+    S3SessionStore,
+    SessionManager,
+    SessionStore,
+    is_session_refused,
+)
+
+_ids = itertools.count()
+
+
+def _jwt(expires_in: float) -> str:
+    def encode(data: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b"=").decode()
+
+    payload = {"exp": int(time.time() + expires_in), "sub": "did:plc:bot", "jti": str(next(_ids))}
+    return f"{encode({'alg': 'HS256'})}.{encode(payload)}.sig"
+
+
+class FakeClient:
+    """Stand-in of `atproto.Client` counting the createSession calls"""
+
+    refused: set = set()
+
+    def __init__(self):
+        self._session = None
+        self._callbacks = []
+
+    def on_session_change(self, callback):
+        # like atproto, which only registers plain functions
+        if inspect.isfunction(callback):
+            self._callbacks.append(callback)
+
+    def login(self, login=None, password=None, session_string=None):
+        if session_string:
+            if session_string in self.refused:
+                raise UnauthorizedError()
+            self._session = Session.decode(session_string)
+            event = SessionEvent.IMPORT
+        else:
+            self._session = Session("bot.test", "did:plc:bot", _jwt(7200), _jwt(60 * 86400))
+            event = SessionEvent.CREATE
+        for callback in self._callbacks:
+            callback(event, self._session)
+
+
+class MemoryStore(SessionStore):
+    def __init__(self, session_string=None):
+        self.session_string = session_string
+
+    def load(self):
+        return self.session_string
+
+    def save(self, session_string):
+        self.session_string = session_string
+
+
+def _manager(store=None) -> SessionManager:
+    return SessionManager("bot.test", "password", store, client_factory=FakeClient)
+
+
+class TestSessionManager(unittest.TestCase):
+    def test_warm_container_reuses_client(self):
+        manager = _manager()
+        self.assertIs(manager.get_client(), manager.get_client())
+        self.assertEqual(manager.logins, 1)
+
+    def test_cold_start_imports_stored_session(self):
+        store = MemoryStore()
+        _manager(store).get_client()
+        manager = _manager(store)
+        client = manager.get_client()
+        self.assertEqual((manager.logins, manager.imports), (0, 1))
+        self.assertEqual(client._session.export(), store.session_string)
+
+    def test_login_when_stored_session_unusable(self):
+        expiring = Session("bot.test", "did:plc:bot", _jwt(0), _jwt(3600)).export()
+        manager = _manager(MemoryStore(expiring))
+        manager.get_client()
+        self.assertEqual((manager.logins, manager.imports), (1, 0))
+
+        store = MemoryStore()
+        _manager(store).get_client()
+        FakeClient.refused = {store.session_string}
+        self.addCleanup(setattr, FakeClient, "refused", set())
+        manager = _manager(store)
+        manager.get_client()
+        self.assertEqual((manager.logins, manager.imports), (1, 0))
+        # the new session replaces the refused one
+        self.assertNotIn(store.session_string, FakeClient.refused)
+
+    def test_refreshed_session_of_a_real_client_is_saved(self):
+        store = MemoryStore()
+        manager = SessionManager("bot.test", "password", store, client_factory=RateLimitedClient)
+        client = manager._new_client()
+        dispatcher = client._session_dispatcher
+        self.assertEqual(len(dispatcher._on_session_change_callbacks), 1)
+
+        session = Session("bot.test", "did:plc:bot", _jwt(7200), _jwt(60 * 86400))
+        dispatcher.set_session(session)
+        dispatcher.dispatch_session_change(SessionEvent.REFRESH)
+        self.assertEqual(store.session_string, session.export())
+
+
+def _bad_request(error: str) -> BadRequestError:
+    return BadRequestError(SimpleNamespace(content=SimpleNamespace(error=error)))
+
+
+class TestRefusedSession(unittest.TestCase):
+    def test_is_session_refused(self):
+        self.assertTrue(is_session_refused(UnauthorizedError()))
+        self.assertTrue(is_session_refused(_bad_request("ExpiredToken")))
+        self.assertFalse(is_session_refused(_bad_request("InvalidRequest")))
+        self.assertFalse(is_session_refused(NetworkError()))
+
+    def test_refused_session_drops_the_client(self):
+        with mock.patch.object(bs_client, "invalidate_bot_client") as invalidate:
+            with self.assertRaises(BadRequestError):
+                with bs_client.drop_refused_session():
+                    raise _bad_request("ExpiredToken")
+            invalidate.assert_called_once()
+
+            with self.assertRaises(NetworkError):
+                with bs_client.drop_refused_session():
+                    raise NetworkError()
+            invalidate.assert_called_once()
+
+
+class TestS3SessionStore(unittest.TestCase):
+    @mock_aws
+    def test_encrypted_round_trip(self):
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="userinfo")
+        store = S3SessionStore("userinfo", "sessions/bot.fernet", Fernet.generate_key().decode())
+        self.assertIsNone(store.load())
+        store.save("bot.test:::did:plc:bot:::access:::refresh")
+        body = s3.get_object(Bucket="userinfo", Key="sessions/bot.fernet")["Body"].read()
+        self.assertNotIn(b"refresh", body)
+        self.assertEqual(store.load(), "bot.test:::did:plc:bot:::access:::refresh")
+
+
+if __name__ == "__main__":
+    unittest.main()
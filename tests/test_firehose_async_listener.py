@@ -0,0 +1,80 @@
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+from atproto import firehose_models, models
+
+from src.firehose import async_listener
+from src.firehose.async_listener import AsyncPipeline
+from src.firehose.synthetic import build_commit_frame
+
+
+class TestAsyncPipeline(unittest.IsolatedAsyncioTestCase):
+    async def test_pipeline_dispatches_interested_commits(self):
+        dispatched = []
+
+        async def dispatch(ops):
+            dispatched.append(ops)
+
+        pipeline = AsyncPipeline(None, lanes_count=2, dispatch=dispatch)
+        pipeline.start()
+        follow = {"$type": "app.bsky.graph.follow", "subject": "did:plc:bot", "createdAt": "now"}
+        raw_frames = [
+            build_commit_frame(1, "did:plc:a", "app.bsky.feed.like", {"$type": "x"}),
+            build_commit_frame(2, "did:plc:b", "app.bsky.graph.follow", follow),
+            build_commit_frame(3, "did:plc:c", "app.bsky.feed.repost", {"$type": "x"}),
+        ]
+        for raw_frame in raw_frames:
+            await pipeline.receive(firehose_models.Frame.from_bytes(raw_frame))
+        await pipeline.stop()
+
+        self.assertEqual(len(dispatched), 1)
+        (created,) = dispatched[0][models.ids.AppBskyGraphFollow]["created"]
+        self.assertEqual(created["author"], "did:plc:b")
+        self.assertEqual(pipeline.safe_cursor(), 3)
+
+    async def test_authors_dispatched_concurrently_in_order(self):
+        started = {"did:plc:a": asyncio.Event(), "did:plc:b": asyncio.Event()}
+        dispatched = []
+
+        async def dispatch(ops):
+            (created,) = ops[models.ids.AppBskyGraphFollow]["created"]
+            author = created["author"]
+            started[author].set()
+            # deadlocks unless the other author is dispatched at the same time
+            other = "did:plc:b" if author == "did:plc:a" else "did:plc:a"
+            await asyncio.wait_for(started[other].wait(), 5)
+            dispatched.append((author, created["uri"]))
+
+        pipeline = AsyncPipeline(None, lanes_count=1, dispatch=dispatch)
+        follow = {"$type": "app.bsky.graph.follow", "subject": "did:plc:bot", "createdAt": "now"}
+        for seq, author in enumerate(["did:plc:a", "did:plc:a", "did:plc:b"], 1):
+            frame = build_commit_frame(seq, author, "app.bsky.graph.follow", follow)
+            await pipeline.lanes[0].put(firehose_models.Frame.from_bytes(frame))
+        pipeline.start()
+        await pipeline.stop()
+
+        a_uris = [uri for author, uri in dispatched if author == "did:plc:a"]
+        self.assertEqual(len(dispatched), 3)
+        self.assertEqual(a_uris, sorted(a_uris))
+
+    async def test_dispatch_runs_off_the_event_loop(self):
+        threads = []
+        with (
+            mock.patch.object(
+                async_listener, "handle_ops", lambda ops: threads.append(threading.current_thread())
+            ),
+            mock.patch.object(async_listener, "drop_duplicates", lambda ops: ops),
+        ):
+            await async_listener._dispatch_ops({})
+        self.assertNotEqual(threads, [threading.main_thread()])
+
+    async def test_follow_flush_runs_off_the_event_loop(self):
+        coalescer = mock.Mock()
+        threads = []
+        coalescer.flush_if_due.side_effect = lambda: threads.append(threading.current_thread())
+        with mock.patch.object(async_listener, "follow_coalescer", coalescer):
+            await async_listener._flush_follows_if_due()
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
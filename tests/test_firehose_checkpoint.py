@@ -0,0 +1,39 @@
+import os
+import tempfile
+import unittest
+
+from src.firehose.checkpoint import (
+    Checkpointer,
+    FileCheckpointStore,
+    S3CheckpointStore,
+    get_checkpoint_store,
+)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "cursor")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_file_store_keeps_64bit_seq(self):
+        store = FileCheckpointStore(self.path)
+        self.assertIsNone(store.load())
+        store.save(2**40 + 1)
+        self.assertEqual(store.load(), 2**40 + 1)
+
+    def test_get_checkpoint_store(self):
+        self.assertEqual(get_checkpoint_store(f"file://{self.path}").path, self.path)
+        store = get_checkpoint_store("s3://bucket/firehose/cursor")
+        self.assertIsInstance(store, S3CheckpointStore)
+        self.assertEqual((store.bucket, store.key), ("bucket", "firehose/cursor"))
+
+    def test_checkpointer_saves_latest_seq_on_stop(self):
+        checkpointer = Checkpointer(FileCheckpointStore(self.path), interval=60)
+        checkpointer.start()
+        checkpointer.update(10)
+        checkpointer.update(20)
+        checkpointer.stop()
+        self.assertEqual(FileCheckpointStore(self.path).load(), 20)
@@ -0,0 +1,145 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from atproto import models
+
+from src.firehose import listener
+from src.firehose.coalesce import FOLLOW, UNFOLLOW, FollowCoalescer
+
+_URI = "at://did:plc:alice/app.bsky.graph.follow/1"
+_CAROL = {"text": "@carol", "follow_uri": "at://did:plc:carol/app.bsky.graph.follow/1"}
+"""Registry record of a user who signed up by following the bot"""
+
+
+class TestFollowCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.coalescer = FollowCoalescer(self.batches.append, window=60)
+
+    def test_follow_then_unfollow_cancels_out(self):
+        self.coalescer.follow(_URI, "cid", "did:plc:alice", "did:plc:bot", "now")
+        self.coalescer.unfollow(_URI)
+        self.coalescer.flush()
+        self.assertEqual(self.batches, [])
+
+    def test_refollow_dispatches_the_last_follow_once(self):
+        self.coalescer.follow(_URI, "cid1", "did:plc:alice", "did:plc:bot", "now")
+        self.coalescer.unfollow(_URI)
+        self.coalescer.follow(f"{_URI}2", "cid2", "did:plc:alice", "did:plc:bot", "now")
+        self.coalescer.follow(_URI, "cid3", "did:plc:bob", "did:plc:bot", "now")
+        self.coalescer.flush()
+
+        (batch,) = self.batches
+        self.assertEqual(
+            [(c["follower_did"], c["cid"]) for c in batch],
+            [
+                ("did:plc:alice", "cid2"),
+                ("did:plc:bob", "cid3"),
+            ],
+        )
+        self.assertTrue(all(c["action"] == FOLLOW for c in batch))
+
+    def test_unfollow_of_an_older_follow(self):
+        self.coalescer.unfollow(_URI)
+        self.coalescer.flush_if_due()
+        self.assertEqual(self.batches, [])
+
+        self.coalescer.flush()
+        (change,) = self.batches[0]
+        self.assertEqual(change["action"], UNFOLLOW)
+        self.assertEqual(change["follower_did"], "did:plc:alice")
+        self.assertIsNone(change["followed_did"])
+
+
+def _follow_ops(created=(), deleted=()) -> dict:
+    return {
+        models.ids.AppBskyGraphFollow: {
+            "created": [
+                {
+                    "uri": uri,
+                    "cid": "cid",
+                    "author": author,
+                    "record": SimpleNamespace(subject=subject, created_at="now"),
+                }
+                for uri, author, subject in created
+            ],
+            "deleted": [{"uri": uri, "author": author} for uri, author in deleted],
+        }
+    }
+
+
+class TestFollowDispatch(unittest.TestCase):
+    def setUp(self):
+        self.started = []
+        self.coalescer = FollowCoalescer(listener.dispatch_follow_changes, window=60)
+        patches = [
+            mock.patch.object(listener, "BOT_DID", "did:plc:bot"),
+            mock.patch.object(listener, "follow_coalescer", self.coalescer),
+            mock.patch.object(listener, "subscribers", {"did:plc:carol": _CAROL}),
+            mock.patch.object(listener, "_signup_state_machine_arn", "arn:signup"),
+            mock.patch.object(listener, "_signout_state_machine_arn", "arn:signout"),
+            mock.patch.object(listener, "FOLLOW_BATCH_SIZE", 2),
+            mock.patch.object(listener, "start_batches", side_effect=self._start_batches),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _start_batches(self, arn, items, batch_size):
+        self.started.append((arn, items, batch_size))
+        return f"{arn}:execution"
+
+    def test_only_follows_of_the_bot_are_coalesced(self):
+        listener.handle_ops(
+            _follow_ops(
+                created=[
+                    (f"at://did:plc:{name}/app.bsky.graph.follow/1", f"did:plc:{name}", subject)
+                    for name, subject in [("alice", "did:plc:bot"), ("bob", "did:plc:other")]
+                ],
+                deleted=[
+                    ("at://did:plc:dave/app.bsky.graph.follow/1", "did:plc:dave"),
+                    ("at://did:plc:carol/app.bsky.graph.follow/1", "did:plc:carol"),
+                ],
+            )
+        )
+        self.assertEqual(
+            sorted(key[0] for key in self.coalescer._pending), ["did:plc:alice", "did:plc:carol"]
+        )
+
+    def test_unfollow_of_another_account_keeps_the_subscriber(self):
+        listener.handle_ops(
+            _follow_ops(deleted=[("at://did:plc:carol/app.bsky.graph.follow/2", "did:plc:carol")])
+        )
+        self.coalescer.flush()
+        self.assertEqual(self.started, [])
+
+    def test_set_of_subscribers_cannot_tell_the_follows_apart(self):
+        with mock.patch.object(listener, "subscribers", {"did:plc:carol"}):
+            listener.handle_ops(
+                _follow_ops(
+                    deleted=[("at://did:plc:carol/app.bsky.graph.follow/1", "did:plc:carol")]
+                )
+            )
+        self.coalescer.flush()
+        self.assertEqual(self.started, [])
+
+    def test_changes_are_dispatched_in_batches_to_the_flows(self):
+        listener.handle_ops(
+            _follow_ops(
+                created=[
+                    (f"at://did:plc:u{i}/app.bsky.graph.follow/1", f"did:plc:u{i}", "did:plc:bot")
+                    for i in range(3)
+                ],
+                deleted=[("at://did:plc:carol/app.bsky.graph.follow/1", "did:plc:carol")],
+            )
+        )
+        self.coalescer.flush()
+
+        signup, signout = self.started
+        self.assertEqual(signup[0], "arn:signup")
+        self.assertEqual([item["did"] for item in signup[1]], [f"did:plc:u{i}" for i in range(3)])
+        self.assertTrue(all(item["command"] == "signup" for item in signup[1]))
+        self.assertEqual(signup[2], 2)
+        self.assertEqual(signout[0], "arn:signout")
+        self.assertEqual([item["did"] for item in signout[1]], ["did:plc:carol"])
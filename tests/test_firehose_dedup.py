@@ -0,0 +1,42 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from src.firehose.dedup import DedupCache, get_dedup_store
+
+
+class TestDedupCache(unittest.TestCase):
+    def test_duplicates_within_ttl(self):
+        cache = DedupCache(ttl=60)
+        self.assertTrue(cache.first_seen("at://a/app.bsky.feed.post/1", "cid1"))
+        self.assertFalse(cache.first_seen("at://a/app.bsky.feed.post/1", "cid1"))
+        # a new version of the record is not a duplicate
+        self.assertTrue(cache.first_seen("at://a/app.bsky.feed.post/1", "cid2"))
+
+    def test_expired_entries_are_not_duplicates(self):
+        cache = DedupCache(ttl=60)
+        with mock.patch("time.monotonic", return_value=0):
+            cache.first_seen("at://a/1", "cid")
+        with mock.patch("time.monotonic", return_value=61):
+            self.assertTrue(cache.first_seen("at://a/1", "cid"))
+        self.assertEqual(len(cache), 1)
+
+    def test_memory_cap_evicts_least_recently_used(self):
+        cache = DedupCache(max_bytes=600)
+        for i in range(10):
+            cache.first_seen(f"at://a/{i}", "cid")
+        self.assertLessEqual(cache.size, 600)
+        self.assertLess(len(cache), 10)
+        self.assertFalse(cache.first_seen("at://a/9", "cid"))
+        self.assertTrue(cache.first_seen("at://a/0", "cid"))
+
+    def test_sqlite_store_catches_duplicates_after_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            url = f"file://{directory}/dedup.sqlite3"
+            cache = DedupCache(store=get_dedup_store(url, 0, 60))
+            self.assertTrue(cache.first_seen("at://a/1", "cid"))
+
+            restarted = DedupCache(store=get_dedup_store(url, 0, 60))
+            self.assertFalse(restarted.first_seen("at://a/1", "cid"))
+            self.assertTrue(os.path.exists(f"{directory}/dedup-0.sqlite3"))
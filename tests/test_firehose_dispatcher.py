@@ -0,0 +1,28 @@
+import unittest
+
+from src.firehose.dispatcher import ShardedDispatcher, get_shard
+
+
+def _noop_worker(*args):
+    pass
+
+
+class TestShardedDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = ShardedDispatcher(_noop_worker, workers_count=2, max_queue_size=10)
+
+    def test_get_shard_is_stable(self):
+        self.assertEqual(get_shard("did:plc:abc", 4), get_shard("did:plc:abc", 4))
+        self.assertIn(get_shard("did:plc:abc", 4), range(4))
+
+    def test_safe_cursor_waits_for_slowest_shard(self):
+        self.dispatcher.put(0, "a", 10)
+        self.dispatcher.put(1, "b", 11)
+        self.dispatcher.put(0, "c", 12)
+        self.assertEqual(self.dispatcher.safe_cursor(), 9)
+
+        self.dispatcher.done_seqs[0] = 12
+        self.assertEqual(self.dispatcher.safe_cursor(), 10)
+
+        self.dispatcher.done_seqs[1] = 11
+        self.assertEqual(self.dispatcher.safe_cursor(), 12)
@@ -0,0 +1,50 @@
+import unittest
+
+import libipld
+from atproto import firehose_models, models
+
+from src.firehose.images import ImageBlob, extract_images, get_embed_type
+from src.firehose.listener import decode_commit
+from src.firehose.synthetic import build_commit_frame
+
+_CID = "bafkreie5737gdxlw5i64vzichcalba3z2v5n6icifvx5xytvske7mr3hpm"
+_CID_BYTES = b"\x01\x55\x12\x20" + libipld.decode_cid(_CID)["hash"]["digest"]
+
+
+def _images_embed(ref) -> dict:
+    blob = {"$type": "blob", "ref": ref, "mimeType": "image/png", "size": 10}
+    return {"$type": "app.bsky.embed.images", "images": [{"alt": "cat", "image": blob}]}
+
+
+class TestExtractImages(unittest.TestCase):
+    def test_blob_ref_representations(self):
+        expected = [ImageBlob(cid=_CID, mime_type="image/png", size=10, alt="cat")]
+        for ref in (_CID, _CID_BYTES, {"$link": _CID}):
+            self.assertEqual(extract_images({"embed": _images_embed(ref)}), expected)
+
+    def test_record_with_media(self):
+        embed = {"$type": "app.bsky.embed.recordWithMedia", "media": _images_embed(_CID)}
+        self.assertEqual(len(extract_images({"embed": embed})), 1)
+
+    def test_legacy_blob(self):
+        image = {"alt": "", "image": {"cid": _CID, "mimeType": "image/jpeg"}}
+        embed = {"$type": "app.bsky.embed.images", "images": [image]}
+        self.assertEqual(extract_images({"embed": embed})[0].cid, _CID)
+
+    def test_posts_without_images(self):
+        self.assertEqual(extract_images({"text": "hello"}), [])
+        embed = {"$type": "app.bsky.embed.external", "external": {"uri": "https://example.com"}}
+        self.assertEqual(extract_images({"embed": embed}), [])
+        self.assertEqual(get_embed_type({"embed": embed}), "app.bsky.embed.external")
+
+    def test_decode_commit_keeps_image_posts_only(self):
+        post = {"$type": "app.bsky.feed.post", "text": "hi", "createdAt": "now"}
+        image_post = {**post, "embed": _images_embed(_CID)}
+        text_frame = build_commit_frame(1, "did:plc:a", "app.bsky.feed.post", post)
+        image_frame = build_commit_frame(2, "did:plc:a", "app.bsky.feed.post", image_post)
+
+        self.assertEqual(decode_commit(firehose_models.Frame.from_bytes(text_frame)), {})
+        ops = decode_commit(firehose_models.Frame.from_bytes(image_frame))
+        (created,) = ops[models.ids.AppBskyFeedPost]["created"]
+        self.assertEqual(created["images"][0].cid, _CID)
+        self.assertEqual(created["record"].text, "hi")
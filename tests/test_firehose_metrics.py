@@ -0,0 +1,62 @@
+import threading
+import unittest
+
+from src.firehose.metrics import MetricsExporter, MetricsRegistry
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.registry.counter("frames_total", "Frames").inc(3)
+        self.registry.gauge("fill_ratio", "Fill").set(0.5)
+        self.registry.histogram("parse_seconds", "Parse").observe(0.003)
+
+    def test_snapshot_deltas_and_merge(self):
+        snapshot = self.registry.snapshot(deltas=True)
+        # the values are not reset, the next deltas are computed against them
+        self.assertEqual(self.registry.counters["frames_total"].value, 3)
+        deltas = self.registry.snapshot(deltas=True)
+        self.assertEqual(deltas["counters"]["frames_total"][1], 0)
+        self.assertEqual(deltas["histograms"]["parse_seconds"][3], 0)
+
+        total = MetricsRegistry()
+        total.merge(snapshot)
+        total.merge(snapshot)
+        self.assertEqual(total.counters["frames_total"].value, 6)
+        self.assertEqual(total.histograms["parse_seconds"].count, 2)
+        self.assertAlmostEqual(total.histograms["parse_seconds"].quantile(0.5), 0.004096)
+
+    def test_to_prometheus(self):
+        text = self.registry.to_prometheus()
+        self.assertIn("frames_total 3", text)
+        self.assertIn('parse_seconds_bucket{le="+Inf"} 1', text)
+
+    def test_to_emf(self):
+        document = self.registry.to_emf("ns", {"Service": "firehose"})
+        self.assertEqual(document["frames_total"], 3)
+        self.assertEqual(document["parse_seconds"]["Counts"], [1])
+        (directive,) = document["_aws"]["CloudWatchMetrics"]
+        self.assertEqual(directive["Dimensions"], [["Service"]])
+
+    def test_exporter_collects_deltas(self):
+        exporter = MetricsExporter(self.registry)
+        self.assertEqual(exporter.collect().counters["frames_total"].value, 3)
+        self.registry.counter("frames_total").inc()
+        self.assertEqual(exporter.collect().counters["frames_total"].value, 1)
+        self.assertIn("frames_total 4", exporter.prometheus())
+
+    def test_deltas_lose_no_increment(self):
+        counter = self.registry.counter("frames_total")
+        collected = [self.registry.snapshot(deltas=True)["counters"]["frames_total"][1]]
+
+        def increment():
+            for _ in range(200000):
+                counter.inc()
+
+        thread = threading.Thread(target=increment)
+        thread.start()
+        while thread.is_alive():
+            collected.append(self.registry.snapshot(deltas=True)["counters"]["frames_total"][1])
+        thread.join()
+        collected.append(self.registry.snapshot(deltas=True)["counters"]["frames_total"][1])
+        self.assertEqual(sum(collected), 200003)
@@ -0,0 +1,95 @@
+import os
+import queue
+import tempfile
+import unittest
+
+from atproto import firehose_models
+
+from src.firehose.dispatcher import PendingSeqs
+from src.firehose.overload import OverloadPolicy, ShedPolicy, SpillBuffer, SpillPolicy
+from src.firehose.synthetic import build_commit_frame
+
+
+def _message(seq: int, collection: str) -> firehose_models.MessageFrame:
+    raw_frame = build_commit_frame(seq, "did:plc:a", collection, {"$type": collection})
+    return firehose_models.Frame.from_bytes(raw_frame)
+
+
+class TestOverloadPolicies(unittest.TestCase):
+    def test_block_sheds_after_timeout(self):
+        policy = OverloadPolicy(timeout=0.01)
+        policy.attach([queue.Queue(maxsize=1)], 1)
+        self.assertTrue(policy.put(0, "a"))
+        self.assertFalse(policy.put(0, "b"))
+
+    def test_shed_drops_non_interesting_above_watermark(self):
+        policy = ShedPolicy({"app.bsky.feed.post"}, high_watermark=0.5)
+        shard_queue = queue.Queue(maxsize=2)
+        policy.attach([shard_queue], 2)
+        like = _message(1, "app.bsky.feed.like")
+        self.assertTrue(policy.admit(0, like))
+
+        shard_queue.put("queued")
+        self.assertFalse(policy.admit(0, like))
+        self.assertTrue(policy.admit(0, _message(2, "app.bsky.feed.post")))
+
+    def test_spill_keeps_order_and_drains(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            policy = SpillPolicy(spill_dir)
+            shard_queue = queue.Queue(maxsize=1)
+            policy.attach([shard_queue], 1)
+            for item in ("a", "b", "c"):
+                self.assertTrue(policy.put(0, item))
+            self.assertFalse(policy.empty())
+
+            drained = []
+            while not (policy.empty() and shard_queue.empty()):
+                drained.append(shard_queue.get())
+                policy.drain()
+            self.assertEqual(drained, ["a", "b", "c"])
+
+    def test_spill_sheds_above_max_bytes(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            policy = SpillPolicy(spill_dir, max_spill_bytes=1)
+            policy.attach([queue.Queue(maxsize=1)], 1)
+            self.assertTrue(policy.put(0, "a"))
+            self.assertTrue(policy.put(0, "b"))
+            self.assertFalse(policy.put(0, "c"))
+
+    def test_spill_deletes_drained_segments(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            buffer = SpillBuffer(os.path.join(spill_dir, "shard-0.spill"), segment_bytes=100)
+            # the reader never catches up, one item stays behind
+            buffer.append(b"x" * 60)
+            for i in range(20):
+                buffer.append(b"x" * 60)
+                self.assertEqual(buffer.peek(), b"x" * 60)
+                buffer.pop()
+                self.assertLessEqual(buffer.segments, 2)
+            self.assertEqual(len(os.listdir(spill_dir)), buffer.segments)
+            self.assertLess(buffer.disk_size, 300)
+            self.assertEqual(buffer.peek(), b"x" * 60)
+
+    def test_spill_cap_on_disk_size(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            policy = SpillPolicy(spill_dir, max_spill_bytes=150, segment_bytes=1000)
+            shard_queue = queue.Queue(maxsize=1)
+            policy.attach([shard_queue], 1)
+            self.assertTrue(policy.put(0, "queued"))
+            self.assertTrue(policy.put(0, b"x" * 100))
+            shard_queue.get()
+            policy.drain()
+            # drained, but still on disk in the current segment until it is truncated
+            self.assertTrue(policy.put(0, b"x" * 100))
+            self.assertTrue(policy.put(0, b"x" * 100))
+            self.assertFalse(policy.put(0, b"x" * 100))
+
+
+class TestPendingSeqs(unittest.TestCase):
+    def test_discarded_seqs_release_the_cursor(self):
+        pending = PendingSeqs(1)
+        for seq in (1, 2, 3):
+            pending.add(0, seq)
+        pending.discard(0, (2, 3))
+        self.assertEqual(pending.safe_cursor([0]), 0)
+        self.assertEqual(pending.safe_cursor([1]), 3)
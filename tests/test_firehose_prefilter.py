@@ -0,0 +1,42 @@
+import unittest
+
+from src.firehose.prefilter import CollectionPreFilter, get_collection
+
+
+class TestCollectionPreFilter(unittest.TestCase):
+    def setUp(self):
+        self.pre_filter = CollectionPreFilter(
+            ["app.bsky.feed.post", "app.bsky.graph.follow"], report_interval=0
+        )
+
+    def test_get_collection(self):
+        self.assertEqual(get_collection("app.bsky.feed.like/3kq2abc"), "app.bsky.feed.like")
+
+    def test_match(self):
+        body = {
+            "ops": [
+                {"action": "create", "path": "app.bsky.feed.like/1"},
+                {"action": "create", "path": "app.bsky.feed.post/2"},
+            ]
+        }
+        self.assertTrue(self.pre_filter.match(body))
+        self.assertEqual(self.pre_filter.matched["app.bsky.feed.post"], 1)
+        self.assertEqual(self.pre_filter.skipped["app.bsky.feed.like"], 1)
+
+    def test_skip(self):
+        body = {"ops": [{"action": "create", "path": "app.bsky.feed.repost/1"}]}
+        self.assertFalse(self.pre_filter.match(body))
+        self.assertFalse(self.pre_filter.match({"ops": []}))
+        self.assertEqual(self.pre_filter.commits_skipped, 2)
+
+    def test_skip_updates(self):
+        body = {"ops": [{"action": "update", "path": "app.bsky.feed.post/1"}]}
+        self.assertFalse(self.pre_filter.match(body))
+        self.assertEqual(self.pre_filter.matched["app.bsky.feed.post"], 0)
+        self.assertEqual(self.pre_filter.skipped["app.bsky.feed.post"], 1)
+
+    def test_report_resets_counters(self):
+        self.pre_filter.match({"ops": [{"action": "delete", "path": "app.bsky.feed.like/1"}]})
+        self.assertIn("skipped=1", self.pre_filter.report())
+        self.assertEqual(self.pre_filter.commits_skipped, 0)
+        self.assertFalse(self.pre_filter.skipped)
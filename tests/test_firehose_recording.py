@@ -0,0 +1,43 @@
+import os
+import tempfile
+import unittest
+
+from src.firehose.recording import FrameRecorder, read_recording, write_synthetic_recording
+from src.firehose.replay import replay
+
+
+class TestRecording(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "firehose.bin")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read_returns_written_frames(self):
+        with FrameRecorder(self.path) as recorder:
+            recorder.write(b"first", received_at=10.0)
+            recorder.write(b"second", received_at=10.5)
+
+        self.assertEqual(list(read_recording(self.path)), [(0.0, b"first"), (0.5, b"second")])
+
+    def test_read_rejects_truncated_recording(self):
+        with FrameRecorder(self.path) as recorder:
+            recorder.write(b"frame")
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+
+        with self.assertRaises(ValueError):
+            list(read_recording(self.path))
+
+    def test_replay_synthetic_recording(self):
+        write_synthetic_recording(self.path, 300, rate=10000)
+
+        report = replay(
+            self.path, workers=1, batch_options={"max_frames": 50, "flush_interval": 0.01}
+        )
+
+        self.assertEqual(report.frames, 300)
+        self.assertEqual(report.commits, 300)
+        self.assertEqual(report.errors, 0)
+        self.assertIn("parse", report.latencies)
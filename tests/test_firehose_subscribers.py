@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+
+from src.firehose.prefilter import CollectionPreFilter
+from src.firehose.subscribers import FileSnapshotSource, SubscriberSet
+
+
+class TestSubscriberSet(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "dids.txt")
+        self._write("did:plc:alice\ndid:plc:bob\n")
+        self.subscribers = SubscriberSet(FileSnapshotSource(self.path))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write(self, content):
+        with open(self.path, "w") as f:
+            f.write(content)
+
+    def test_reload_only_when_changed(self):
+        self.assertTrue(self.subscribers.reload())
+        self.assertFalse(self.subscribers.reload())
+        self.assertIn("did:plc:alice", self.subscribers)
+
+        self._write("did:plc:carol\n")
+        os.utime(self.path, ns=(0, 1))
+        self.assertTrue(self.subscribers.reload())
+        self.assertNotIn("did:plc:alice", self.subscribers)
+        self.assertIn("hit_ratio=0.5000", self.subscribers.stats())
+
+    def test_pre_filter_drops_posts_of_non_subscribers(self):
+        self.subscribers.reload()
+        pre_filter = CollectionPreFilter(
+            ["app.bsky.feed.post", "app.bsky.graph.follow"],
+            subscribers=self.subscribers,
+            subscriber_only=["app.bsky.feed.post"],
+        )
+        post = {"action": "create", "path": "app.bsky.feed.post/1"}
+        follow = {"action": "create", "path": "app.bsky.graph.follow/1"}
+
+        self.assertTrue(pre_filter.match({"repo": "did:plc:alice", "ops": [post]}))
+        self.assertFalse(pre_filter.match({"repo": "did:plc:eve", "ops": [post]}))
+        self.assertTrue(pre_filter.match({"repo": "did:plc:eve", "ops": [follow]}))
+        self.assertEqual(pre_filter.not_subscribed["app.bsky.feed.post"], 1)
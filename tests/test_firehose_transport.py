@@ -0,0 +1,29 @@
+import unittest
+
+from src.firehose.transport import FrameBatcher, pack_frames, unpack_frames
+
+
+class TestTransport(unittest.TestCase):
+    def test_pack_and_unpack(self):
+        frames = [b"first", b"", b"\x00" * 1000]
+        self.assertEqual(list(unpack_frames(pack_frames(frames))), frames)
+
+    def test_batcher_flushes_on_max_frames(self):
+        batches = []
+        batcher = FrameBatcher(
+            lambda *batch: batches.append(batch), max_frames=2, flush_interval=60
+        )
+        for seq, frame in enumerate((b"a", b"b", b"c"), 1):
+            batcher.add(frame, seq)
+        self.assertEqual([list(unpack_frames(b)) for b, _ in batches], [[b"a", b"b"]])
+        self.assertEqual(batches[0][1], [1, 2])
+
+        batcher.flush()
+        self.assertEqual(list(unpack_frames(batches[-1][0])), [b"c"])
+
+    def test_batcher_flushes_on_interval(self):
+        batches = []
+        batcher = FrameBatcher(lambda *batch: batches.append(batch), flush_interval=0)
+        batcher.add(b"a")
+        batcher.flush_if_due()
+        self.assertEqual(len(batches), 1)
@@ -0,0 +1,208 @@
+import os
+import tempfile
+import unittest
+
+import boto3
+from moto import mock_aws
+
+from src.lib.registry import (
+    FileRegistryStore,
+    S3RegistryStore,
+    Shard,
+    UserRegistry,
+    compact,
+    new_delta_key,
+    write_shard,
+)
+
+
+class TestShard(unittest.TestCase):
+    def test_lookup(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "0000.shard")
+            records = [(f"did:plc:user{i:05d}", {"text": f"@user{i}"}) for i in range(1000)]
+            self.assertEqual(write_shard(path, reversed(records)), 1000)
+            shard = Shard(path)
+            self.assertEqual(len(shard), 1000)
+            self.assertEqual(shard.get("did:plc:user00000"), b'{"text":"@user0"}')
+            self.assertEqual(shard.get("did:plc:user00999"), b'{"text":"@user999"}')
+            self.assertIsNone(shard.get("did:plc:missing"))
+            self.assertEqual(list(shard.items()), records)
+            shard.close()
+
+    def test_empty(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "0000.shard")
+            write_shard(path, [])
+            self.assertIsNone(Shard(path).get("did:plc:alice"))
+
+
+class TestUserRegistry(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = FileRegistryStore(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_deltas_without_snapshot(self):
+        self.store.append("did:plc:alice", {"text": "@alice"})
+        registry = UserRegistry(self.store)
+        self.assertTrue(registry.reload())
+        self.assertEqual(registry.get("did:plc:alice"), {"text": "@alice"})
+        self.assertNotIn("did:plc:bob", registry)
+        self.assertFalse(registry.reload())
+
+        self.store.append("did:plc:alice", None)
+        self.assertTrue(registry.reload())
+        self.assertNotIn("did:plc:alice", registry)
+        self.assertEqual(len(registry), 0)
+
+    def test_compaction(self):
+        for i in range(100):
+            self.store.append(f"did:plc:user{i}", {"text": f"@user{i}"})
+        self.store.append("did:plc:user0", None)
+        manifest = compact(self.store, shards=4, lag=0)
+        self.assertEqual(manifest["version"], 1)
+        self.assertEqual(sum(manifest["counts"]), 99)
+
+        registry = UserRegistry(self.store)
+        registry.reload()
+        self.assertEqual(registry.version, 1)
+        self.assertEqual(registry.get("did:plc:user42"), {"text": "@user42"})
+        self.assertNotIn("did:plc:user0", registry)
+        self.assertEqual(len(registry), 99)
+
+        # deltas after the snapshot take precedence
+        self.store.append("did:plc:user42", None)
+        self.store.append("did:plc:new", {"text": "@new"})
+        registry.reload()
+        self.assertNotIn("did:plc:user42", registry)
+        self.assertIn("did:plc:new", registry)
+        self.assertEqual(len(registry), 99)
+
+        manifest = compact(self.store, shards=4, lag=0)
+        self.assertEqual(manifest["version"], 2)
+        registry.reload()
+        self.assertEqual(registry.version, 2)
+        self.assertEqual(len(registry), 99)
+        self.assertIn("did:plc:new", registry)
+        self.assertIn("registry_version=2", registry.stats())
+
+    def test_shards_are_opened_on_lookup(self):
+        for i in range(20):
+            self.store.append(f"did:plc:user{i}", {"text": f"@user{i}"})
+        compact(self.store, shards=8, lag=0)
+        registry = UserRegistry(self.store)
+        registry.reload()
+        registry.get("did:plc:user1")
+        self.assertEqual(len(registry.snapshot._shards), 1)
+
+    def test_recent_deltas_are_not_compacted(self):
+        self.store.append("did:plc:alice", {"text": "@alice"})
+        self.assertIsNone(compact(self.store, shards=2, lag=3600))
+        registry = UserRegistry(self.store)
+        registry.reload()
+        self.assertIn("did:plc:alice", registry)
+
+    def test_no_version_without_deltas(self):
+        self.store.append("did:plc:alice", {"text": "@alice"})
+        manifest = compact(self.store, shards=2, lag=0)
+        self.assertEqual(compact(self.store, shards=2, lag=0), manifest)
+        self.assertEqual(self.store.load_manifest()["version"], 1)
+
+    def test_prune(self):
+        self.store.append("did:plc:alice", {"text": "@alice"})
+        compact(self.store, shards=2, lag=0)
+        self.store.append("did:plc:bob", {"text": "@bob"})
+        compact(self.store, shards=2, lag=0)
+        # the readers of the previous version still replay the deltas after it
+        self.assertEqual([d.did for d in self.store.read_deltas(None)], ["did:plc:bob"])
+        self.store.append("did:plc:carol", {"text": "@carol"})
+        compact(self.store, shards=2, lag=0)
+
+        names = sorted(os.listdir(self.tmpdir.name))
+        self.assertEqual(names, ["delta", "manifest.json", "snapshot-2", "snapshot-3"])
+        self.assertEqual([d.did for d in self.store.read_deltas(None)], ["did:plc:carol"])
+        registry = UserRegistry(self.store)
+        registry.reload()
+        self.assertEqual(len(registry), 3)
+
+    def test_replaced_snapshot_is_closed(self):
+        self.store.append("did:plc:alice", {"text": "@alice"})
+        compact(self.store, shards=2, lag=0)
+        registry = UserRegistry(self.store)
+        registry.reload()
+        registry.get("did:plc:alice")
+        first = registry.snapshot
+        shard = next(iter(first._shards.values()))
+
+        for did in ("did:plc:bob", "did:plc:carol"):
+            self.store.append(did, {"text": did})
+            compact(self.store, shards=2, lag=0)
+            registry.reload()
+            # kept open for the lookups running on it until the next version change
+            self.assertEqual(shard._mm.closed, did == "did:plc:carol")
+        self.assertEqual(first._shards, {})
+
+    def test_late_delta_does_not_override_newer_one(self):
+        registry = UserRegistry(self.store)
+        self.store.append("did:plc:alice", None)
+        registry.reload()
+        # a writer which built its key earlier puts its delta after the reload
+        old_key = new_delta_key(0)
+        path = os.path.join(self.tmpdir.name, "delta", f"{old_key}.json")
+        with open(path, "w") as f:
+            f.write('{"did": "did:plc:alice", "record": {"text": "@alice"}}')
+        registry.reload()
+        self.assertNotIn("did:plc:alice", registry)
+
+
+class TestS3RegistryStore(unittest.TestCase):
+    @mock_aws
+    def test_round_trip(self):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="userinfo")
+        with tempfile.TemporaryDirectory() as cache_dir:
+            store = S3RegistryStore("userinfo", "/registry", cache_dir)
+            self.assertIsNone(store.load_manifest())
+            store.append("did:plc:alice", {"text": "@alice"})
+            store.append("did:plc:bob", {"text": "@bob"})
+            compact(store, shards=2, lag=0)
+            store.append("did:plc:carol", {"text": "@carol"})
+
+            registry = UserRegistry(store)
+            registry.start()
+            self.assertEqual(len(registry), 3)
+            self.assertEqual(registry.get("did:plc:bob"), {"text": "@bob"})
+            self.assertTrue(os.path.exists(os.path.join(cache_dir, "snapshot-1", "0001.shard")))
+            self.assertEqual([d.did for d in store.read_deltas(None)][-1], "did:plc:carol")
+
+    @mock_aws
+    def test_prune(self):
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="userinfo")
+        with tempfile.TemporaryDirectory() as cache_dir:
+            store = S3RegistryStore("userinfo", "/registry", cache_dir)
+            # the compactor runs in its own container, with its own cache
+            compactor_store = S3RegistryStore("userinfo", "/registry", f"{cache_dir}/compactor")
+            registry = UserRegistry(store)
+            for i in range(3):
+                store.append(f"did:plc:user{i}", {"text": f"@user{i}"})
+                compact(compactor_store, shards=2, lag=0)
+                registry.reload()
+                registry.snapshot.load_all()
+
+            keys = [obj["Key"] for obj in s3.list_objects_v2(Bucket="userinfo")["Contents"]]
+            self.assertEqual(len([k for k in keys if k.startswith("registry/delta/")]), 1)
+            self.assertFalse([k for k in keys if k.startswith("registry/snapshot-1/")])
+            self.assertEqual(len([k for k in keys if k.startswith("registry/snapshot-3/")]), 2)
+            # the cache keeps the current version and the one replaced last
+            self.assertEqual(
+                sorted(os.listdir(cache_dir)), ["compactor", "snapshot-2", "snapshot-3"]
+            )
+            self.assertEqual(os.listdir(f"{cache_dir}/compactor"), [])
+            self.assertEqual(len(registry), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
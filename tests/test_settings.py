@@ -0,0 +1,134 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import unittest
+from unittest import mock
+
+import boto3
+from moto import mock_aws
+
+from src.settings import Settings
+
+SECRETS = {"fernet_key": "key", "bot_userid": "bot.bsky.social", "bot_app_password": "pass"}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FakeLoader:
+    """Stand-in of `get_secret` counting the calls"""
+
+    def __init__(self, *values):
+        self.values = list(values)
+        self.names = []
+
+    def __call__(self, secret_name: str) -> dict:
+        self.names.append(secret_name)
+        value = self.values.pop(0) if len(self.values) > 1 else self.values[0]
+        if isinstance(value, BaseException):
+            raise value
+        return value
+
+
+class TestSettings(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        # the instance is a singleton, shared with `src.settings.settings`
+        Settings()
+
+    def _settings(self, loader: FakeLoader) -> Settings:
+        return Settings(ttl=60, loader=loader, clock=self.clock)
+
+    def _wait_refresh(self) -> None:
+        for thread in threading.enumerate():
+            if thread.name == "settings":
+                thread.join(5)
+
+    def test_plain_settings_do_not_load_secrets(self):
+        loader = FakeLoader(SECRETS)
+        with mock.patch.dict(os.environ, {"STAGE": "prod", "SRC_VERSION": "abc1234"}):
+            settings = self._settings(loader)
+        self.assertEqual(settings.SRC_VERSION, "abc1234")
+        self.assertEqual(settings.LOGLEVEL, 20)
+        self.assertEqual(settings.SECRET_NAME, "wmput-secrets-prod")
+        self.assertEqual(loader.names, [])
+
+    def test_secrets_loaded_once_on_first_access(self):
+        loader = FakeLoader(SECRETS)
+        with mock.patch.dict(os.environ, {"SECRET_NAME": "wmput-secrets-test"}):
+            settings = self._settings(loader)
+        self.assertEqual(settings.BOT_USERID, "bot.bsky.social")
+        self.assertEqual(settings.BOT_APP_PASSWORD, "pass")
+        self.assertEqual(settings.FERNET_KEY, "key")
+        self.assertEqual(loader.names, ["wmput-secrets-test"])
+
+    def test_unknown_attribute(self):
+        settings = self._settings(FakeLoader(SECRETS))
+        with self.assertRaises(AttributeError):
+            settings.UNKNOWN
+
+    def test_refreshed_in_background_after_ttl(self):
+        loader = FakeLoader(SECRETS, {**SECRETS, "bot_app_password": "rotated"})
+        settings = self._settings(loader)
+        self.assertEqual(settings.BOT_APP_PASSWORD, "pass")
+        self.clock.now = 30
+        self.assertEqual(settings.BOT_APP_PASSWORD, "pass")
+        self.assertEqual(len(loader.names), 1)
+
+        self.clock.now = 61
+        # the stale value is returned while the refresh runs
+        self.assertEqual(settings.BOT_APP_PASSWORD, "pass")
+        self._wait_refresh()
+        self.assertEqual(settings.BOT_APP_PASSWORD, "rotated")
+        self.assertEqual(len(loader.names), 2)
+
+    def test_failed_refresh_keeps_secrets(self):
+        loader = FakeLoader(SECRETS, RuntimeError("throttled"), SECRETS)
+        settings = self._settings(loader)
+        settings.get_secrets()
+        self.clock.now = 61
+        self.assertEqual(settings.BOT_USERID, "bot.bsky.social")
+        self._wait_refresh()
+        self.assertEqual(settings.BOT_USERID, "bot.bsky.social")
+        # retried on the next access
+        settings.get_secrets()
+        self._wait_refresh()
+        self.assertEqual(len(loader.names), 3)
+
+    def test_invalidate(self):
+        loader = FakeLoader(SECRETS)
+        settings = self._settings(loader)
+        settings.get_secrets()
+        settings.invalidate()
+        settings.get_secrets()
+        self.assertEqual(len(loader.names), 2)
+
+    @mock_aws
+    def test_secrets_manager(self):
+        client = boto3.client("secretsmanager", region_name="ap-northeast-1")
+        client.create_secret(Name="wmput-secrets-dev", SecretString=json.dumps(SECRETS))
+        with mock.patch.dict(os.environ, {"SECRET_NAME": "wmput-secrets-dev"}):
+            settings = Settings(ttl=60, clock=self.clock)
+        self.assertEqual(settings.BOT_USERID, "bot.bsky.social")
+        self.assertEqual(settings.loads, 1)
+
+
+class TestColdStart(unittest.TestCase):
+    def test_import_does_not_import_boto3(self):
+        code = "import sys, settings, hello; assert 'boto3' not in sys.modules"
+        src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+        env = {**os.environ, "PYTHONPATH": src}
+        subprocess.run([sys.executable, "-c", code], check=True, env=env)
+
+
+if __name__ == "__main__":
+    unittest.main()
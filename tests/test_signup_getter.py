@@ -0,0 +1,96 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from src.lib.bs.dms import get_argument
+from src.lib.bs.resolver import CachingResolver
+from src.lib.registry import FileRegistryStore, UserRegistry, compact
+from src.signout import getter as signout_getter
+from src.signup import getter as signup_getter
+from src.watermarking import getter as watermarking_getter
+
+
+def _did_document(did: str, handle: str) -> dict:
+    return {"id": did, "alsoKnownAs": [f"at://{handle}"], "verificationMethod": [], "service": []}
+
+
+class TestGetArgument(unittest.TestCase):
+    def test_argument(self):
+        self.assertEqual(get_argument("signup  ©alice   2025"), "©alice 2025")
+        self.assertEqual(get_argument("登録 アリス"), "アリス")
+        self.assertIsNone(get_argument("signup"))
+        self.assertIsNone(get_argument("hello world"))
+
+
+class TestRegistration(unittest.TestCase):
+    """Signup and signout commands through the registry, up to the watermarking getter"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.store = FileRegistryStore(self.tmpdir.name)
+        id_resolver = mock.Mock()
+        id_resolver.did.resolve_without_validation.return_value = _did_document(
+            "did:plc:bob", "bob.example"
+        )
+        self.registry = UserRegistry(self.store, reload_interval=0)
+        self.resolver_store = mock.Mock()
+        self.resolver_store.get.return_value = None
+        for patch in (
+            mock.patch.object(signup_getter, "store", self.store),
+            mock.patch.object(
+                signup_getter,
+                "resolver",
+                CachingResolver(self.resolver_store, id_resolver=id_resolver),
+            ),
+            mock.patch.object(signout_getter, "store", self.store),
+            mock.patch.object(watermarking_getter, "registry", self.registry),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _signup(self, *items: dict) -> dict:
+        return signup_getter.handler({"items": [{"command": "signup", **i} for i in items]}, {})
+
+    def test_signup_and_signout(self):
+        event = self._signup(
+            {"did": "did:plc:alice", "convo_id": "c1", "text": "signup ©alice"},
+            {"did": "did:plc:bob", "uri": "at://did:plc:bob/app.bsky.graph.follow/1"},
+        )
+        # the handle resolved for the default text is shared with the next cold starts
+        self.resolver_store.flush.assert_called_once()
+        # the items are passed on to the notifier
+        self.assertEqual(len(event["items"]), 2)
+        self.assertEqual(event["status"], 200)
+
+        # the readers see the deltas before the compaction
+        self.assertEqual(watermarking_getter.get_watermark("did:plc:alice"), {"text": "©alice"})
+        self.assertEqual(
+            watermarking_getter.get_watermark("did:plc:bob"),
+            {"text": "@bob.example", "follow_uri": "at://did:plc:bob/app.bsky.graph.follow/1"},
+        )
+
+        manifest = compact(self.store, lag=0)
+        self.assertEqual(sum(manifest["counts"]), 2)
+        reader = UserRegistry(self.store)
+        reader.reload()
+        self.assertEqual(reader.version, 1)
+        self.assertIn("did:plc:alice", reader)
+
+        signout_getter.handler({"items": [{"command": "signout", "did": "did:plc:alice"}]}, {})
+        with self.assertRaises(ValueError):
+            watermarking_getter.get_watermark("did:plc:alice")
+        compact(self.store, lag=0)
+        reader.reload()
+        self.assertEqual(reader.version, 2)
+        self.assertNotIn("did:plc:alice", reader)
+        self.assertIn("did:plc:bob", reader)
+
+    def test_no_registry(self):
+        with mock.patch.object(signup_getter, "store", None):
+            with self.assertRaises(ValueError):
+                self._signup({"did": "did:plc:alice"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import io
+import unittest
+
+from PIL import Image
+
+from src.watermarking.decoder import ImageTooLargeError, decode
+
+
+def _encode(size: tuple, image_format: str, mode: str = "RGB") -> bytes:
+    buffer = io.BytesIO()
+    Image.new(mode, size).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+class TestDecoder(unittest.TestCase):
+    def test_jpeg_draft(self):
+        image, info = decode(_encode((6000, 4000), "JPEG"), max_side=2000)
+        # decoded at 1/2 by the JPEG loader, then resized to the target
+        self.assertEqual(info.draft_size, (3000, 2000))
+        self.assertEqual((image.size, image.mode), ((2000, 1333), "RGB"))
+
+    def test_png_resized(self):
+        image, info = decode(_encode((3000, 1000), "PNG", "RGBA"), max_side=2000)
+        self.assertEqual(info.draft_size, (3000, 1000))
+        self.assertEqual((image.size, image.mode), ((2000, 667), "RGBA"))
+
+    def test_small_image_kept(self):
+        image, info = decode(_encode((800, 600), "JPEG"), max_side=2000)
+        self.assertEqual((info.format, image.size), ("JPEG", (800, 600)))
+
+    def test_caps(self):
+        data = _encode((4000, 4000), "PNG")
+        with self.assertRaises(ImageTooLargeError):
+            decode(data, max_pixels=10_000_000)
+        with self.assertRaises(ImageTooLargeError):
+            decode(data, max_bytes=len(data) - 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
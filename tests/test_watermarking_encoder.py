@@ -0,0 +1,51 @@
+import io
+import unittest
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+from src.watermarking.encoder import encode, predict_quality
+
+
+def _illustration(width: int, height: int) -> Image.Image:
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+    return (
+        Image.fromarray(noise)
+        .resize((width, height), Image.BICUBIC)
+        .filter(ImageFilter.GaussianBlur(3))
+    )
+
+
+class TestEncoder(unittest.TestCase):
+    def test_line_art_kept_as_png(self):
+        image = Image.new("RGB", (1000, 1000), "white")
+        ImageDraw.Draw(image).line((0, 0, 1000, 1000), fill="black", width=5)
+        result = encode(image, "PNG", 10000)
+        self.assertEqual((result.format, result.attempts, result.scale), ("PNG", 1, 1.0))
+
+    def test_fits_in_few_attempts(self):
+        image = _illustration(2000, 2000)
+        result = encode(image, "PNG", 6_000_000, max_bytes=300_000)
+        self.assertEqual(result.format, "JPEG")
+        self.assertLessEqual(len(result.data), 300_000)
+        self.assertLessEqual(result.attempts, 6)
+        self.assertLess(result.scale, 1.0)
+        with Image.open(io.BytesIO(result.data)) as decoded:
+            self.assertEqual(decoded.size, (result.width, result.height))
+
+    def test_transparency_encoded_as_webp(self):
+        image = _illustration(800, 800).convert("RGBA")
+        image.putalpha(Image.new("L", image.size, 128))
+        result = encode(image, "PNG", 1_000_000)
+        self.assertEqual((result.format, result.mime_type), ("WEBP", "image/webp"))
+        self.assertLessEqual(len(result.data), 1_000_000)
+
+    def test_predict_quality(self):
+        self.assertEqual(predict_quality(1000 * 1000, 1_000_000, "JPEG", "JPEG", 250_000), 95)
+        # a more detailed source than usual lowers the prediction
+        self.assertLess(predict_quality(2000 * 2000, 1_000_000, "JPEG", "JPEG", 2_000_000), 90)
+
+
+if __name__ == "__main__":
+    unittest.main()
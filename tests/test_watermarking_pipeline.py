@@ -0,0 +1,138 @@
+import io
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import boto3
+from atproto_client.models.blob_ref import BlobRef, IpldLink
+from moto import mock_aws
+from PIL import Image
+
+from src.lib.bs.resolver import CachingResolver
+from src.watermarking import getter, poster, watermarker
+from src.watermarking.result_cache import ResultCache
+
+_BLOB_CID = "bafkreie5737gdxlw5i64vzichcalba3z2v5n6icifvx5xytvske7mr3hpm"
+
+
+def _did_document(pds: str) -> dict:
+    return {
+        "id": "did:plc:a",
+        "alsoKnownAs": ["at://a.example"],
+        "verificationMethod": [],
+        "service": [
+            {"id": "#atproto_pds", "type": "AtprotoPersonalDataServer", "serviceEndpoint": pds}
+        ],
+    }
+
+
+def _encode(size: tuple, image_format: str) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (10, 20, 30)).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+class BlobHandler(BaseHTTPRequestHandler):
+    """Stand-in of `com.atproto.sync.getBlob` of a PDS"""
+
+    blobs: dict = {}
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        blob = self.blobs.get(query["cid"][0])
+        if blob is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(blob)))
+        self.end_headers()
+        self.wfile.write(blob)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestWatermarkingPipeline(unittest.TestCase):
+    def setUp(self):
+        BlobHandler.blobs = {
+            "bafy1": _encode((1200, 900), "JPEG"),
+            "bafy2": _encode((640, 640), "PNG"),
+        }
+        server = ThreadingHTTPServer(("127.0.0.1", 0), BlobHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        pds = f"http://127.0.0.1:{server.server_address[1]}"
+
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket="org")
+        self.s3.create_bucket(Bucket="watermarked")
+
+        id_resolver = mock.Mock()
+        id_resolver.did.resolve_without_validation.return_value = _did_document(pds)
+        self.client = mock.Mock()
+        blob = BlobRef(mime_type="image/jpeg", size=10, ref=IpldLink(link=_BLOB_CID))
+        self.client.upload_blob.return_value = SimpleNamespace(blob=blob)
+        self.client.send_post.return_value = SimpleNamespace(uri="at://bot/app.bsky.feed.post/1")
+        patches = [
+            mock.patch.object(getter, "s3", self.s3),
+            mock.patch.object(getter, "result_cache", ResultCache(self.s3, "watermarked")),
+            mock.patch.object(getter, "resolver", CachingResolver(id_resolver=id_resolver)),
+            mock.patch.object(getter, "ORG_IMAGE_BUCKET", "org"),
+            mock.patch.object(getter, "WATERMARKED_IMAGE_BUCKET", "watermarked"),
+            mock.patch.object(watermarker, "s3", self.s3),
+            mock.patch.object(watermarker, "result_cache", ResultCache(self.s3, "watermarked")),
+            mock.patch.object(poster, "s3", self.s3),
+            mock.patch.object(poster, "get_bot_client", return_value=self.client),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _run(self) -> tuple:
+        event = {
+            "did": "did:plc:a",
+            "uri": "at://did:plc:a/app.bsky.feed.post/1",
+            "cid": _BLOB_CID,
+            "images": [
+                {"cid": "bafy1", "mime_type": "image/jpeg", "alt": "one"},
+                {"cid": "bafy2", "mime_type": "image/png", "alt": "two"},
+            ],
+            "watermark": {"text": "@sheep.example"},
+        }
+        fetched = getter.handler(event, {})
+        watermarked = watermarker.handler(fetched, {})
+        return fetched, watermarked, poster.handler(watermarked, {})
+
+    def test_pipeline(self):
+        fetched, watermarked, posted = self._run()
+
+        self.assertEqual(
+            self.s3.get_object(Bucket="org", Key="did:plc:a/bafy1")["Body"].read(),
+            BlobHandler.blobs["bafy1"],
+        )
+        self.assertEqual([image["alt"] for image in watermarked["images"]], ["one", "two"])
+        for image in watermarked["images"]:
+            self.s3.head_object(Bucket="watermarked", Key=image["key"])
+        self.assertEqual(posted["uri"], "at://bot/app.bsky.feed.post/1")
+        self.assertEqual(self.client.upload_blob.call_count, 2)
+        embed = self.client.send_post.call_args.kwargs["embed"]
+        self.assertEqual(embed.record.record.uri, "at://did:plc:a/app.bsky.feed.post/1")
+        self.assertEqual([image.alt for image in embed.media.images], ["one", "two"])
+        self.assertEqual(embed.media.images[0].aspect_ratio.width, 1200)
+
+    def test_second_post_served_from_cache(self):
+        self._run()
+        BlobHandler.blobs = {}
+        fetched, watermarked, _ = self._run()
+        self.assertTrue(all(image["result"] for image in fetched["images"]))
+        self.assertEqual(watermarked["result_cache"]["hit_rate"], 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from src.watermarking.renderer import (
+    OverlayCache,
+    WatermarkRenderer,
+    WatermarkSettings,
+    get_size_bucket,
+)
+
+
+def _image(width: int, height: int, mode: str = "RGB") -> Image.Image:
+    return Image.new(mode, (width, height), (10, 20, 30, 200)[: len(mode)])
+
+
+class TestWatermarkRenderer(unittest.TestCase):
+    def test_size_bucket(self):
+        self.assertEqual(get_size_bucket(1, 256), (256, 256))
+        self.assertEqual(get_size_bucket(2000, 1025), (2048, 1280))
+
+    def test_bottom_right(self):
+        settings = WatermarkSettings(text="@sheep.example", opacity=1.0)
+        image = _image(800, 600)
+        pixels = np.asarray(WatermarkRenderer().apply(image, settings))
+        self.assertEqual(pixels.shape, (600, 800, 3))
+        changed = np.argwhere((pixels != (10, 20, 30)).any(axis=2))
+        self.assertGreater(len(changed), 0)
+        # the text is drawn in the bottom-right corner only
+        self.assertGreater(changed[:, 0].min(), 300)
+        self.assertGreater(changed[:, 1].min(), 400)
+        self.assertTrue((pixels.max(axis=(0, 1)) == 255).all())
+
+    def test_tile_keeps_alpha_channel(self):
+        settings = WatermarkSettings(text="@sheep.example", position="tile", opacity=0.5)
+        image = _image(300, 500, "RGBA")
+        pixels = np.asarray(WatermarkRenderer().apply(image, settings))
+        self.assertEqual(pixels.shape, (500, 300, 4))
+        self.assertTrue((pixels[..., 3] == 200).all())
+        # tiled over the whole image, blended at half opacity
+        self.assertTrue((pixels[:250, ..., 0] != 10).any())
+        self.assertTrue((pixels[250:, ..., 0] != 10).any())
+        self.assertLessEqual(pixels[..., 0].max(), 133)
+
+    def test_cache(self):
+        cache = OverlayCache()
+        renderer = WatermarkRenderer(cache)
+        settings = WatermarkSettings(text="@sheep.example", position="tile")
+        renderer.apply(_image(1000, 1000), settings)
+        renderer.apply(_image(1020, 990), settings)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        renderer.apply(_image(1000, 1000), WatermarkSettings(text="@other.example"))
+        self.assertEqual(cache.misses, 2)
+
+    def test_cache_eviction(self):
+        cache = OverlayCache(max_bytes=1)
+        settings = WatermarkSettings(text="@sheep.example", position="tile")
+        cache.get(settings, (256, 256))
+        cache.get(settings, (512, 512))
+        self.assertEqual(len(cache._overlays), 1)
+        self.assertEqual(cache.size, 512 * 512 * 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+import io
+import tempfile
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+from PIL import Image
+
+from src.lib.registry import FileRegistryStore, UserRegistry
+from src.watermarking import getter, watermarker
+from src.watermarking.result_cache import ENCODE_LIMITS, ResultCache, get_result_key
+
+
+class FakeS3:
+    def __init__(self, objects: dict):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self.objects[(Bucket, Key)] = Body
+
+
+def _encode(size: tuple, image_format: str) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (10, 20, 30)).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+class TestWatermarkerHandler(unittest.TestCase):
+    def test_handler(self):
+        s3 = FakeS3(
+            {
+                ("org", "post/0.jpg"): _encode((640, 480), "JPEG"),
+                ("org", "post/1.png"): _encode((300, 900), "PNG"),
+            }
+        )
+        event = {
+            "watermark": {"text": "@sheep.example", "position": "tile"},
+            "images": [
+                {"bucket": "org", "key": "post/0.jpg"},
+                {"bucket": "org", "key": "post/1.png"},
+            ],
+            "output_bucket": "watermarked",
+        }
+        with mock.patch.object(watermarker, "s3", s3):
+            response = watermarker.handler(event, {})
+
+        self.assertEqual(response["status"], 200)
+        # in the order of the event, with the timings of each image
+        self.assertEqual(
+            [image["key"] for image in response["images"]], ["post/0.jpg", "post/1.png"]
+        )
+        for image in response["images"]:
+            self.assertEqual(
+                set(image["timings"]), {"download_ms", "render_ms", "upload_ms", "total_ms"}
+            )
+        with Image.open(io.BytesIO(s3.objects[("watermarked", "post/0.jpg")])) as image:
+            self.assertEqual((image.format, image.size), ("JPEG", (640, 480)))
+        with Image.open(io.BytesIO(s3.objects[("watermarked", "post/1.png")])) as image:
+            self.assertEqual((image.format, image.size), ("PNG", (300, 900)))
+
+    def test_corrupt_image_does_not_fail_the_post(self):
+        png = _encode((300, 300), "PNG")
+        s3 = FakeS3(
+            {
+                ("org", "post/0.jpg"): b"not an image",
+                ("org", "post/1.png"): png[: len(png) // 2],
+                ("org", "post/2.png"): png,
+            }
+        )
+        event = {
+            "watermark": {"text": "@sheep.example"},
+            "images": [
+                {"bucket": "org", "key": f"post/{name}"} for name in ("0.jpg", "1.png", "2.png")
+            ],
+            "output_bucket": "watermarked",
+        }
+        with mock.patch.object(watermarker, "s3", s3):
+            response = watermarker.handler(event, {})
+
+        broken, truncated, valid = response["images"]
+        self.assertIn("UnidentifiedImageError", broken["error"])
+        self.assertEqual((truncated["bucket"], truncated["key"]), ("org", "post/1.png"))
+        self.assertIn("error", truncated)
+        self.assertNotIn("error", valid)
+        self.assertIn(("watermarked", "post/2.png"), s3.objects)
+
+    def test_result_cache(self):
+        s3 = FakeS3({("org", "did:plc:a/bafy1"): _encode((400, 400), "PNG")})
+        event = {
+            "watermark": {"text": "@sheep.example"},
+            "images": [{"bucket": "org", "key": "did:plc:a/bafy1", "cid": "bafy1"}],
+            "output_bucket": "watermarked",
+        }
+        with (
+            mock.patch.object(watermarker, "s3", s3),
+            mock.patch.object(watermarker, "result_cache", ResultCache(s3, "watermarked")),
+        ):
+            first = watermarker.handler(event, {})
+            del s3.objects[("org", "did:plc:a/bafy1")]
+            second = watermarker.handler(event, {})
+
+        key = first["images"][0]["key"]
+        self.assertTrue(key.startswith("results/bafy1/"))
+        self.assertEqual(first["result_cache"], {"hits": 0, "misses": 1, "hit_rate": 0.0})
+        # served from the cache without downloading the deleted source
+        self.assertEqual(second["images"][0]["key"], key)
+        self.assertEqual(second["result_cache"], {"hits": 1, "misses": 0, "hit_rate": 1.0})
+
+    def test_result_key_covers_the_encode_limits(self):
+        settings = watermarker.WatermarkSettings.from_dict({"text": "@sheep.example"})
+        key = get_result_key("bafy1", settings)
+        self.assertEqual(key, get_result_key("bafy1", settings, dict(ENCODE_LIMITS)))
+        # results encoded within other limits are not served
+        for name in ENCODE_LIMITS:
+            limits = {**ENCODE_LIMITS, name: ENCODE_LIMITS[name] // 2}
+            self.assertNotEqual(get_result_key("bafy1", settings, limits), key)
+
+    def test_getter_skips_cached_images(self):
+        s3 = FakeS3({})
+        event = {
+            "did": "did:plc:a",
+            "images": [{"cid": "bafy1"}, {"cid": "bafy2"}],
+            "watermark": {"text": "@sheep.example"},
+        }
+        cache = ResultCache(s3, "watermarked")
+        settings = watermarker.WatermarkSettings.from_dict(event["watermark"])
+        s3.objects[("watermarked", get_result_key("bafy1", settings))] = b"done"
+        with (
+            mock.patch.object(getter, "s3", s3),
+            mock.patch.object(getter, "result_cache", cache),
+            mock.patch.object(getter, "ORG_IMAGE_BUCKET", "org"),
+            mock.patch.object(getter, "download_blob", return_value=b"blob") as download_blob,
+        ):
+            response = getter.handler(event, {})
+
+        download_blob.assert_called_once_with("did:plc:a", "bafy2")
+        cached, downloaded = response["images"]
+        self.assertEqual(cached["result"]["key"], get_result_key("bafy1", settings))
+        self.assertIsNone(downloaded["result"])
+        self.assertEqual(s3.objects[("org", downloaded["key"])], b"blob")
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "hit_rate": 0.5})
+
+    def test_getter_looks_the_settings_up_in_the_registry(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = FileRegistryStore(directory)
+            store.append("did:plc:a", {"text": "@a.example", "opacity": 0.3})
+            event = {"did": "did:plc:a", "images": []}
+            with mock.patch.object(getter, "registry", UserRegistry(store)):
+                response = getter.handler(event, {})
+                self.assertEqual(response["watermark"], {"text": "@a.example", "opacity": 0.3})
+                with self.assertRaises(ValueError):
+                    getter.handler({"did": "did:plc:b", "images": []}, {})
+
+
+if __name__ == "__main__":
+    unittest.main()